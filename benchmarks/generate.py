@@ -0,0 +1,221 @@
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+from loguru import logger
+
+# The sources of a typical export, an Apple Watch and the iPhone it is paired with
+WATCH = "Jane’s Apple Watch"
+IPHONE = "Jane’s iPhone"
+TZ = "-0700"
+
+# Share of the daily quantity samples of every type, with at least one sample of each type per day. Heart rate is the
+# densest type of a real export, and of a generated one once a day has more samples than a night has sleep stages.
+QUANTITY_TYPES = {
+    # type: (unit, share, low value, high value, sample length in seconds, source)
+    "HKQuantityTypeIdentifierHeartRate": ("count/min", 0.50, 48, 165, 0, WATCH),
+    "HKQuantityTypeIdentifierStepCount": ("count", 0.15, 5, 900, 600, None),
+    "HKQuantityTypeIdentifierActiveEnergyBurned": ("Cal", 0.15, 0.05, 25, 60, WATCH),
+    "HKQuantityTypeIdentifierBasalEnergyBurned": ("Cal", 0.10, 0.5, 1.5, 60, WATCH),
+    "HKQuantityTypeIdentifierDistanceWalkingRunning": ("mi", 0.06, 0.001, 0.4, 600, None),
+}
+
+# Length of a night of sleep stages in seconds
+SLEEP_SECONDS = 7 * 3600
+
+# Sleep stages recorded by the Watch through a night, and how long each of them lasts in minutes
+SLEEP_STAGES = {
+    "HKCategoryValueSleepAnalysisAsleepCore": (15, 60),
+    "HKCategoryValueSleepAnalysisAsleepDeep": (5, 30),
+    "HKCategoryValueSleepAnalysisAsleepREM": (5, 35),
+    "HKCategoryValueSleepAnalysisAwake": (1, 5),
+}
+
+WORKOUTS = {
+    "Day A": [("Squat (Barbell)", 135), ("Bench Press (Barbell)", 115), ("Bent Over Row (Barbell)", 95)],
+    "Day B": [("Squat (Barbell)", 135), ("Overhead Press (Barbell)", 75), ("Trap Bar Deadlift", 185)],
+}
+
+
+def _format(timestamps: np.ndarray) -> list:
+    """Formats epoch seconds the way Apple Health does, e.g. "2023-09-05 08:00:00 -0700" """
+    return [f"{timestamp} {TZ}" for timestamp in pd.to_datetime(timestamps, unit="s").strftime("%Y-%m-%d %H:%M:%S")]
+
+
+def _records(kind: str, source: str, unit: str, start: np.ndarray, end: np.ndarray, values) -> list:
+    created = _format(end + 60)
+    start, end = _format(start), _format(end)
+    unit = f' unit="{unit}"' if unit else ""
+    return [f' <Record type="{kind}" sourceName="{source}" sourceVersion="10.0"{unit} creationDate="{c}" startDate="{s}" endDate="{e}" value="{v}"/>\n'
+            for c, s, e, v in zip(created, start, end, values)]
+
+
+def _other_records_per_day() -> int:
+    """The expected number of non-quantity Records of a day
+
+    That is the Watch's sleep stages (the last one runs past `SLEEP_SECONDS`), the iPhone's InBed sample, the wrist
+    temperature, the sleep goal and the two blood pressure readings.
+    """
+    # `rng.integers` excludes the upper bound
+    stage_seconds = 60 * np.mean([(low + high - 1) / 2 for low, high in SLEEP_STAGES.values()])
+    return round(SLEEP_SECONDS / stage_seconds + 1) + 5
+
+
+def _day(rng: np.random.Generator, midnight: int, per_day: int) -> list:
+    """Generates the XML elements of one day, sorted by element kind like a real export"""
+    lines = []
+    for kind, (unit, share, low, high, length, source) in QUANTITY_TYPES.items():
+        n = max(1, int(per_day * share))
+        start = midnight + np.sort(rng.integers(0, 86_400, n))
+        values = np.round(rng.uniform(low, high, n), 3 if high < 10 else 0)
+        if source is None:
+            sources = rng.choice([WATCH, IPHONE], n)
+            for name in (WATCH, IPHONE):
+                mask = sources == name
+                lines += _records(kind, name, unit, start[mask], start[mask] + length, values[mask])
+        else:
+            lines += _records(kind, source, unit, start, start + length, values)
+
+    # One night of sleep, starting the evening before: an InBed sample from the iPhone, stages from the Watch
+    bed_time = midnight - int(rng.integers(1, 3) * 3600)
+    stages, durations = [], []
+    elapsed = 0
+    while elapsed < SLEEP_SECONDS:
+        stage = rng.choice(list(SLEEP_STAGES))
+        low, high = SLEEP_STAGES[stage]
+        duration = int(rng.integers(low, high)) * 60
+        stages.append(stage)
+        durations.append(duration)
+        elapsed += duration
+    starts = bed_time + np.concatenate([[0], np.cumsum(durations)[:-1]])
+    lines += _records("HKCategoryTypeIdentifierSleepAnalysis", IPHONE, None,
+                      np.array([bed_time]), np.array([bed_time + elapsed]), ["HKCategoryValueSleepAnalysisInBed"])
+    lines += _records("HKCategoryTypeIdentifierSleepAnalysis", WATCH, None,
+                      starts, starts + np.array(durations), stages)
+    lines += _records("HKQuantityTypeIdentifierAppleSleepingWristTemperature", WATCH, "degF",
+                      np.array([bed_time]), np.array([bed_time + elapsed]), [round(rng.uniform(95, 97), 2)])
+    lines += _records("HKDataTypeSleepDurationGoal", IPHONE, "hr",
+                      np.array([midnight]), np.array([midnight]), [8])
+
+    # A blood pressure reading, whose Records are nested in a Correlation
+    reading = midnight + int(rng.integers(7, 22)) * 3600
+    (date,) = _format(np.array([reading]))
+    lines.append(
+        f' <Correlation type="HKCorrelationTypeIdentifierBloodPressure" sourceName="{IPHONE}" creationDate="{date}" startDate="{date}" endDate="{date}">\n')
+    for kind, value in [("HKQuantityTypeIdentifierBloodPressureSystolic", int(rng.integers(105, 135))),
+                        ("HKQuantityTypeIdentifierBloodPressureDiastolic", int(rng.integers(65, 88)))]:
+        lines += [" " + line for line in _records(kind, IPHONE, "mmHg",
+                                                  np.array([reading]), np.array([reading]), [value])]
+    lines.append(" </Correlation>\n")
+
+    # A strength workout every other day
+    if (midnight // 86_400) % 2 == 0:
+        start = midnight + 7 * 3600
+        end = start + int(rng.integers(45, 75)) * 60
+        start_date, end_date = _format(np.array([start, end]))
+        energy = round(rng.uniform(200, 400), 1)
+        lines.append(
+            f' <Workout workoutActivityType="HKWorkoutActivityTypeTraditionalStrengthTraining" duration="{(end - start) / 60:.1f}" durationUnit="min" sourceName="{WATCH}" sourceVersion="10.0" creationDate="{end_date}" startDate="{start_date}" endDate="{end_date}">\n'
+            f'  <WorkoutEvent type="HKWorkoutEventTypeSegment" date="{start_date}" duration="{(end - start) / 60:.1f}" durationUnit="min"/>\n'
+            f'  <WorkoutStatistics type="HKQuantityTypeIdentifierActiveEnergyBurned" startDate="{start_date}" endDate="{end_date}" sum="{energy}" unit="Cal"/>\n'
+            f'  <WorkoutStatistics type="HKQuantityTypeIdentifierHeartRate" startDate="{start_date}" endDate="{end_date}" average="{rng.integers(100, 130)}" minimum="{rng.integers(70, 90)}" maximum="{rng.integers(140, 170)}" unit="count/min"/>\n'
+            " </Workout>\n")
+
+    day = pd.Timestamp(midnight, unit="s").strftime("%Y-%m-%d")
+    lines.append(
+        f' <ActivitySummary dateComponents="{day}" activeEnergyBurned="{rng.uniform(300, 900):.3f}" activeEnergyBurnedGoal="600" activeEnergyBurnedUnit="Cal" appleMoveTime="0" appleMoveTimeGoal="0" appleExerciseTime="{rng.integers(10, 90)}" appleExerciseTimeGoal="30" appleStandHours="{rng.integers(6, 16)}" appleStandHoursGoal="12"/>\n')
+    return lines
+
+
+def generate_apple_health_export(path: str, records: int = 100_000, days: int = 730, start_date: str = "2022-01-01", seed: int = 0):
+    """Writes a synthetic Apple Health `export.xml` with roughly `records` records spread over `days` days
+
+    Every day has heart rate, steps, energy and distance samples from a Watch and an iPhone, a night of sleep stages, a
+    blood pressure `Correlation` and an `ActivitySummary`; every other day has a `Workout`. The file is written day by
+    day, so generating 10M records does not need 10M records in memory.
+
+    Args:
+        path (str): Where to write the export
+        records (int, optional): The approximate number of `Record` elements. Defaults to 100_000.
+        days (int, optional): The number of days the records cover. Defaults to 730.
+        start_date (str, optional): The first day. Defaults to "2022-01-01".
+        seed (int, optional): The random seed, the same seed always writes the same file. Defaults to 0.
+    """
+    rng = np.random.default_rng(seed)
+    # Quantity samples fill what the other records of a day leave of the daily share
+    per_day = max(1, round((records / days - _other_records_per_day()) /
+                           sum(share for _, share, *_ in QUANTITY_TYPES.values())))
+    first = int(pd.Timestamp(start_date).timestamp())
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<!DOCTYPE HealthData [\n<!ELEMENT HealthData (ExportDate,Me,(Record|Correlation|Workout|ActivitySummary|ClinicalRecord)*)>\n'
+                '<!ATTLIST HealthData\n  locale CDATA #REQUIRED\n>\n]>\n'
+                '<HealthData locale="en_US">\n'
+                f' <ExportDate value="{_format(np.array([first + days * 86_400]))[0]}"/>\n'
+                ' <Me HKCharacteristicTypeIdentifierDateOfBirth="1990-01-01" HKCharacteristicTypeIdentifierBiologicalSex="HKBiologicalSexNotSet"/>\n')
+        for day in range(days):
+            f.writelines(_day(rng, first + day * 86_400, per_day))
+        f.write("</HealthData>\n")
+    logger.success(
+        f"Generated an Apple Health export with ~{records} records over {days} days at {path} ({os.path.getsize(path) / 1e6:.0f} MB)")
+
+
+def generate_strong_export(path: str, sets: int = 10_000, start_date: str = "2022-01-01", seed: int = 0):
+    """Writes a synthetic Strong App `strong.csv` of a 5x5 program with roughly `sets` sets
+
+    Args:
+        path (str): Where to write the export
+        sets (int, optional): The approximate number of sets (rows). Defaults to 10_000.
+        start_date (str, optional): The day of the first workout. Defaults to "2022-01-01".
+        seed (int, optional): The random seed. Defaults to 0.
+    """
+    rng = np.random.default_rng(seed)
+    workouts = max(1, sets // 15)
+    names = list(WORKOUTS)
+    weights = {exercise: weight for lifts in WORKOUTS.values() for exercise, weight in lifts}
+
+    rows = []
+    for i in range(workouts):
+        date = (pd.Timestamp(start_date) + pd.Timedelta(days=2 * i, hours=7)
+                ).strftime("%Y-%m-%d %H:%M:%S")
+        minutes = int(rng.integers(40, 80))
+        duration = f"{minutes // 60}h {minutes % 60}m" if minutes >= 60 else f"{minutes}m"
+        workout_name = names[i % 2]
+        for exercise, _ in WORKOUTS[workout_name]:
+            # Deadlifts are a single set of five in the program
+            for set_order in range(1, 2 if "Deadlift" in exercise else 6):
+                reps = 5 if rng.random() > 0.1 else int(rng.integers(2, 5))
+                rows.append((date, workout_name, duration, exercise, set_order, weights[exercise], reps, 0, 0,
+                             "", "", ""))
+            # Progressive overload: add weight after every workout that hit all reps
+            weights[exercise] += 10 if exercise == "Trap Bar Deadlift" else 5
+
+    data = pd.DataFrame(rows, columns=["Date", "Workout Name", "Duration", "Exercise Name", "Set Order", "Weight",
+                                       "Reps", "Distance", "Seconds", "Notes", "Workout Notes", "RPE"])
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    data.to_csv(path, index=False)
+    logger.success(
+        f"Generated a Strong App export with {len(data)} sets over {workouts} workouts at {path}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Generates synthetic Apple Health and Strong App exports")
+    parser.add_argument("--records", type=int, default=100_000,
+                        help="Approximate number of Apple Health records")
+    parser.add_argument("--days", type=int, default=730,
+                        help="Number of days the Apple Health records cover")
+    parser.add_argument("--sets", type=int, default=10_000,
+                        help="Approximate number of Strong App sets")
+    parser.add_argument("--out", default="./benchmarks/data",
+                        help="Directory to write export.xml and strong.csv to")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    generate_apple_health_export(os.path.join(args.out, "export.xml"),
+                                 records=args.records, days=args.days, seed=args.seed)
+    generate_strong_export(os.path.join(args.out, "strong.csv"),
+                           sets=args.sets, seed=args.seed)
@@ -0,0 +1,257 @@
+import argparse
+import datetime
+import json
+import os
+import subprocess
+import time
+
+import pandas as pd
+from loguru import logger
+from sqlalchemy import text
+
+from benchmarks.generate import (generate_apple_health_export,
+                                 generate_strong_export)
+from datapipelines.dag import Stage, run_pipeline
+from datapipelines.downsample import downsample_apple_health_data
+from datapipelines.extract import (extract_apple_health_data,
+                                   extract_strong_app_data)
+from datapipelines.instrument import PeakRSS, rss_bytes
+from datapipelines.sleep import sessionize_sleep
+from datapipelines.transform import (split_apple_health_data,
+                                     transform_apple_health_data,
+                                     transform_strong_data)
+
+RESULTS_PATH = "./benchmarks/results/results.jsonl"
+
+# Stages that get slower than their previous run by more than this share are reported as regressions
+REGRESSION_THRESHOLD = 0.10
+
+
+def measure(stage: str, func, *args, rows=None, **kwargs) -> tuple:
+    """Runs `func` and measures its wall time, throughput and peak RSS
+
+    Peak RSS covers this process only, so the memory of process pool workers (e.g. sharded extraction) is not included.
+
+    Args:
+        stage (str): The name of the stage
+        func (callable): The stage function
+        rows (callable, optional): Maps the result of `func` to the number of rows processed. Defaults to None, which uses `len(result)`.
+
+    Returns:
+        tuple: The result of `func` and a dictionary of measurements
+    """
+    baseline = rss_bytes()
+    started_at = time.perf_counter()
+    with PeakRSS() as sampler:
+        result = func(*args, **kwargs)
+    seconds = time.perf_counter() - started_at
+
+    row_count = (rows or len)(result) if result is not None else None
+    measurement = {
+        "stage": stage,
+        "seconds": round(seconds, 4),
+        "rows": row_count,
+        "rows_per_sec": round(row_count / max(seconds, 1e-9)) if row_count is not None else None,
+        "peak_rss_mb": round(sampler.peak / 2**20, 1),
+        "rss_growth_mb": round((sampler.peak - baseline) / 2**20, 1),
+        "failed": result is None,
+    }
+    logger.info(
+        f"{stage}: {seconds:.2f}s, {measurement['rows_per_sec']} rows/sec, peak RSS {measurement['peak_rss_mb']} MB")
+    return result, measurement
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+def run_benchmarks(records: int = 100_000, sets: int = 10_000, workers: int = 1, db: bool = False,
+                   data_dir: str = "./benchmarks/data") -> list:
+    """Runs the pipeline stages against synthetic exports of the given scale
+
+    The exports are generated once per scale and reused by later runs.
+
+    Args:
+        records (int, optional): The approximate number of Apple Health records. Defaults to 100_000.
+        sets (int, optional): The approximate number of Strong App sets. Defaults to 10_000.
+        workers (int, optional): The number of processes that parse the Apple Health export. Defaults to 1.
+        db (bool, optional): True to also benchmark the loaders against the Postgres DB in `db/.env` (set POSTGRES_HOST for a local one). Defaults to False.
+        data_dir (str, optional): Where to keep the generated exports. Defaults to "./benchmarks/data".
+
+    Returns:
+        list: One measurement dictionary per stage
+    """
+    apple_path = os.path.join(data_dir, f"apple-{records}", "export.xml")
+    strong_path = os.path.join(data_dir, f"strong-{sets}", "strong.csv")
+    if not os.path.exists(apple_path):
+        generate_apple_health_export(apple_path, records=records)
+    if not os.path.exists(strong_path):
+        generate_strong_export(strong_path, sets=sets)
+
+    results = []
+    apple_data, measurement = measure("extract_apple_health_data", extract_apple_health_data,
+                                      apple_path, use_cache=False, workers=workers)
+    results.append(measurement)
+    transformed, measurement = measure("transform_apple_health_data", transform_apple_health_data, apple_data,
+                                       rows=lambda _: len(apple_data))
+    results.append(measurement)
+    (sleep_df, activity_df), measurement = measure("split_apple_health_data", split_apple_health_data, transformed,
+                                                   rows=lambda _: len(transformed))
+    results.append(measurement)
+    _, measurement = measure("downsample_apple_health_data", downsample_apple_health_data, activity_df,
+                             rows=lambda _: len(activity_df))
+    results.append(measurement)
+    nights, measurement = measure("sessionize_sleep", sessionize_sleep, apple_data,
+                                  rows=lambda _: len(apple_data))
+    results.append(measurement)
+
+    strong_data, measurement = measure("extract_strong_app_data", extract_strong_app_data,
+                                       strong_path, use_cache=False)
+    results.append(measurement)
+    strong_df, measurement = measure("transform_strong_data", transform_strong_data, strong_data)
+    results.append(measurement)
+
+    if db:
+        # Imported here, so benchmarks without a DB don't need a DB driver
+        from datapipelines.load import (create_pipeline_tables,
+                                        load_apple_health_data, load_env,
+                                        load_strong_app_data)
+        from db.readiness import wait_for_postgres
+
+        load_env()
+        if wait_for_postgres(timeout=30) and create_pipeline_tables():
+            for stage, func, data, kwargs in [
+                ("load_apple_activity", load_apple_health_data, activity_df, {"table_name": "apple_health_activity_raw"}),
+                ("load_apple_sleep", load_apple_health_data, nights, {"table_name": "apple_health_sleep_raw"}),
+                ("load_strong", load_strong_app_data, strong_df, {}),
+            ]:
+                _, measurement = measure(stage, func, data, rows=lambda written: written, **kwargs)
+                results.append(measurement)
+
+    run = {"run_id": datetime.datetime.now().isoformat(timespec="seconds"), "commit": _git_commit(),
+           "records": records, "sets": sets, "workers": workers}
+    return [dict(run, **measurement) for measurement in results]
+
+
+def check_stage_failures(db: bool = False) -> bool:
+    """Checks that a load that logs its error instead of raising still fails its stage and skips its dependents
+
+    Args:
+        db (bool, optional): True to also check that the failure is saved with status "failed" to the `pipeline_runs` table of the Postgres DB in `db/.env`. Defaults to False.
+
+    Returns:
+        bool: True if the check passed
+    """
+    # Imported here, so benchmarks without a DB don't need a DB driver
+    from datapipelines.load import (create_pipeline_tables,
+                                    load_apple_health_data, load_env)
+    from db.utils import init_db_connection
+
+    if db:
+        load_env()
+        if not create_pipeline_tables():
+            return False
+    # Incremental loads need a watermark column, which this table doesn't have (and without a DB the load can't connect),
+    # so the load logs an error and returns None
+    stages = [
+        Stage("check_failed_load", load_apple_health_data,
+              kwargs={"transformed_data": pd.DataFrame({"value": [1.0]}), "table_name": "_check_failed_load",
+                      "mode": "incremental"}),
+        Stage("check_skipped_dependent", len, depends_on=("check_failed_load",)),
+    ]
+    results = run_pipeline(stages, persist_metrics=db)
+    passed = not results
+
+    if db:
+        conn = init_db_connection()
+        try:
+            runs = pd.read_sql(text("""select distinct on (stage) stage, status
+from public.pipeline_runs
+where stage in ('check_failed_load', 'check_skipped_dependent')
+order by stage, run_id desc"""), conn)
+        finally:
+            conn.close()
+        statuses = dict(zip(runs["stage"], runs["status"]))
+        passed = passed and statuses == {"check_failed_load": "failed", "check_skipped_dependent": "skipped"}
+
+    if passed:
+        logger.success("A failing load fails its stage and skips its dependents")
+    else:
+        logger.error("A failing load was not recorded as a failed stage")
+    return passed
+
+
+def save_results(results: list, path: str = RESULTS_PATH):
+    """Appends measurements to the JSON lines results file"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "a") as f:
+        for result in results:
+            f.write(json.dumps(result) + "\n")
+    logger.success(f"Saved {len(results)} measurements to {path}")
+
+
+def compare_results(results: list, path: str = RESULTS_PATH, baseline: str = None) -> pd.DataFrame:
+    """Compares measurements with a previous run of the same scale
+
+    Args:
+        results (list): Measurements returned by `run_benchmarks`
+        path (str, optional): The JSON lines results file. Defaults to `RESULTS_PATH`.
+        baseline (str, optional): The `run_id` to compare with. Defaults to None, which uses the latest earlier run of the same scale.
+
+    Returns:
+        pd.DataFrame: One row per stage with both runs' seconds and peak RSS, their relative change and a regression flag
+    """
+    current = pd.DataFrame(results)
+    if not os.path.exists(path):
+        return pd.DataFrame()
+    history = pd.read_json(path, lines=True, dtype={"run_id": str})
+    run = current.iloc[0]
+    history = history[(history["records"] == run["records"]) & (history["sets"] == run["sets"])
+                      & (history["workers"] == run["workers"]) & (history["run_id"] != run["run_id"])]
+    if baseline is not None:
+        history = history[history["run_id"] == baseline]
+    if history.empty:
+        logger.warning("No earlier run of the same scale to compare with")
+        return pd.DataFrame()
+
+    previous = history[history["run_id"] == history["run_id"].max()]
+    comparison = current[["stage", "seconds", "peak_rss_mb"]].merge(
+        previous[["stage", "seconds", "peak_rss_mb"]], on="stage", suffixes=("", "_baseline"))
+    comparison["seconds_change"] = comparison["seconds"] / comparison["seconds_baseline"] - 1
+    comparison["peak_rss_change"] = comparison["peak_rss_mb"] / comparison["peak_rss_mb_baseline"] - 1
+    comparison["regression"] = comparison["seconds_change"] > REGRESSION_THRESHOLD
+
+    logger.info(
+        f"Compared with run {previous['run_id'].iloc[0]} ({previous['commit'].iloc[0]}):\n{comparison.to_string(index=False)}")
+    for stage in comparison.loc[comparison["regression"], "stage"]:
+        logger.warning(f"{stage} is more than {REGRESSION_THRESHOLD:.0%} slower than before")
+    return comparison
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmarks the pipeline stages on synthetic exports")
+    parser.add_argument("--records", type=int, default=100_000,
+                        help="Approximate number of Apple Health records, e.g. 100000, 1000000 or 10000000")
+    parser.add_argument("--sets", type=int, default=10_000,
+                        help="Approximate number of Strong App sets")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of processes that parse the Apple Health export")
+    parser.add_argument("--db", action="store_true",
+                        help="Also benchmark the loaders against Postgres")
+    parser.add_argument("--baseline", default=None,
+                        help="The run_id to compare with, defaults to the previous run of the same scale")
+    parser.add_argument("--check", action="store_true",
+                        help="Only check that failing stages are recorded as failed (in pipeline_runs with --db)")
+    args = parser.parse_args()
+
+    if args.check:
+        raise SystemExit(0 if check_stage_failures(db=args.db) else 1)
+
+    results = run_benchmarks(records=args.records, sets=args.sets, workers=args.workers, db=args.db)
+    compare_results(results, baseline=args.baseline)
+    save_results(results)
@@ -0,0 +1,123 @@
+import glob
+import hashlib
+import json
+import os
+
+import pandas as pd
+from loguru import logger
+
+# Where parsed exports are cached, and how much disk the cache may use before the least recently used entries are evicted
+CACHE_DIR = os.getenv("PIPELINE_CACHE_DIR", "./data/.cache")
+CACHE_MAX_BYTES = int(os.getenv("PIPELINE_CACHE_MAX_BYTES", 2 * 1024 ** 3))
+
+
+def _source_key(path: str) -> str:
+    """Identifies the source file, so every cache entry of one file can be invalidated together"""
+    return hashlib.sha256(os.path.abspath(path).encode()).hexdigest()[:16]
+
+
+def file_fingerprint(path: str, hash_contents: bool = False) -> str:
+    """Fingerprints a source file by its size and modification time, or by the SHA-256 of its contents
+
+    Args:
+        path (str): Path to the source file
+        hash_contents (bool, optional): True to hash the file contents instead of using size+mtime. Slower, but survives copies and touches. Defaults to False.
+
+    Returns:
+        str: A hex digest identifying this version of the file
+    """
+    if hash_contents:
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(block)
+        return digest.hexdigest()
+    stat = os.stat(path)
+    return hashlib.sha256(f"{stat.st_size}:{stat.st_mtime_ns}".encode()).hexdigest()
+
+
+def cache_path(path: str, params: dict = None, hash_contents: bool = False, cache_dir: str = None) -> str:
+    """Returns the Parquet file that caches the extraction of `path` with `params`"""
+    cache_dir = cache_dir or CACHE_DIR
+    params_key = hashlib.sha256(json.dumps(
+        params or {}, sort_keys=True, default=str).encode()).hexdigest()[:16]
+    return os.path.join(cache_dir, f"{_source_key(path)}-{file_fingerprint(path, hash_contents)[:16]}-{params_key}.parquet")
+
+
+def read_cache(path: str, params: dict = None, hash_contents: bool = False, cache_dir: str = None) -> pd.DataFrame:
+    """Loads a cached extraction of `path`, or returns None on a cache miss
+
+    Args:
+        path (str): Path to the source file that was extracted
+        params (dict, optional): The extraction parameters that are part of the cache key (e.g. `start_date`). Defaults to None.
+        hash_contents (bool, optional): Key the cache on the file contents instead of size+mtime. Defaults to False.
+        cache_dir (str, optional): The cache directory. Defaults to `CACHE_DIR`.
+
+    Returns:
+        pd.DataFrame: The cached records, or None if they are not cached
+    """
+    try:
+        entry = cache_path(path, params, hash_contents, cache_dir)
+        if not os.path.exists(entry):
+            return None
+        data = pd.read_parquet(entry)
+        # Bump the modification time, which is what LRU eviction orders on
+        os.utime(entry)
+        logger.success(f"Loaded {data.shape[0]} cached rows for {path}")
+        return data
+    except Exception as e:
+        logger.error(f"Could not read the parse cache for {path}: {e}")
+        return None
+
+
+def write_cache(data: pd.DataFrame, path: str, params: dict = None, hash_contents: bool = False, cache_dir: str = None, max_bytes: int = None):
+    """Stores an extraction of `path` as compressed Parquet, then evicts old entries to stay within the disk budget
+
+    Args:
+        data (pd.DataFrame): The extracted records
+        path (str): Path to the source file that was extracted
+        params (dict, optional): The extraction parameters that are part of the cache key. Defaults to None.
+        hash_contents (bool, optional): Key the cache on the file contents instead of size+mtime. Defaults to False.
+        cache_dir (str, optional): The cache directory. Defaults to `CACHE_DIR`.
+        max_bytes (int, optional): The disk budget of the cache. Defaults to `CACHE_MAX_BYTES`.
+    """
+    cache_dir = cache_dir or CACHE_DIR
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        entry = cache_path(path, params, hash_contents, cache_dir)
+        # Entries of older versions of the same file can never be hit again
+        current_version = entry.rsplit("-", 1)[0]
+        for stale in glob.glob(os.path.join(cache_dir, f"{_source_key(path)}-*.parquet")):
+            if not stale.startswith(current_version):
+                os.remove(stale)
+        # Write to a temporary file first, so a crash never leaves a truncated entry behind
+        data.to_parquet(f"{entry}.tmp", compression="zstd")
+        os.replace(f"{entry}.tmp", entry)
+        logger.success(f"Cached {data.shape[0]} rows for {path}")
+        evict_cache(cache_dir=cache_dir, max_bytes=max_bytes)
+    except Exception as e:
+        logger.error(f"Could not write the parse cache for {path}: {e}")
+
+
+def evict_cache(cache_dir: str = None, max_bytes: int = None):
+    """Removes the least recently used cache entries until the cache fits in `max_bytes`"""
+    cache_dir = cache_dir or CACHE_DIR
+    max_bytes = CACHE_MAX_BYTES if max_bytes is None else max_bytes
+    entries = sorted((os.stat(entry).st_mtime, os.stat(entry).st_size, entry)
+                     for entry in glob.glob(os.path.join(cache_dir, "*.parquet")))
+    total = sum(size for _, size, _ in entries)
+    for _, size, entry in entries:
+        if total <= max_bytes:
+            break
+        os.remove(entry)
+        total -= size
+        logger.info(f"Evicted {entry} from the parse cache")
+
+
+def invalidate_cache(path: str = None, cache_dir: str = None):
+    """Removes the cache entries of `path`, or the whole cache if `path` is None"""
+    cache_dir = cache_dir or CACHE_DIR
+    pattern = f"{_source_key(path)}-*.parquet" if path else "*.parquet"
+    for entry in glob.glob(os.path.join(cache_dir, pattern)):
+        os.remove(entry)
+        logger.info(f"Invalidated {entry} in the parse cache")
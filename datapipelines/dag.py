@@ -0,0 +1,111 @@
+import datetime
+from concurrent.futures import (FIRST_COMPLETED, ProcessPoolExecutor,
+                                ThreadPoolExecutor, wait)
+from dataclasses import dataclass, field
+from typing import Callable
+
+from loguru import logger
+
+from datapipelines.instrument import PIPELINE_PROFILE, run_stage, save_pipeline_run
+
+
+@dataclass
+class Stage:
+    """A step of the pipeline
+
+    Attributes:
+        name (str): Unique name of the stage, used by other stages to depend on it
+        func (Callable): Called with the results of `depends_on` (in order) as positional arguments, plus `kwargs`
+        depends_on (tuple, optional): Names of the stages that must succeed before this one runs. Defaults to ().
+        executor (str, optional): "thread" for I/O bound stages, "process" for CPU bound stages. Process stages need picklable functions, arguments and results. Defaults to "thread".
+        kwargs (dict, optional): Extra keyword arguments for `func`. Defaults to {}.
+    """
+    name: str
+    func: Callable
+    depends_on: tuple = ()
+    executor: str = "thread"
+    kwargs: dict = field(default_factory=dict)
+
+
+def run_pipeline(stages: list, max_workers: int = 4, persist_metrics: bool = False, profile: bool = PIPELINE_PROFILE) -> dict:
+    """Runs every stage as soon as its dependencies have succeeded, running independent stages concurrently
+
+    A failing stage only takes down the stages that depend on it, everything else still runs. A stage fails when it
+    raises or reports an error it handled itself with `record_stage_error`. Every stage is measured
+    by `run_stage` (duration, rows in and out, peak memory and bytes written).
+
+    Args:
+        stages (list): The `Stage`s of the pipeline
+        max_workers (int, optional): The size of each of the thread and process pools. Defaults to 4.
+        persist_metrics (bool, optional): True to save the metrics of every stage to the `pipeline_runs` table, see `create_pipeline_tables`. Defaults to False.
+        profile (bool, optional): True to run every stage under cProfile and tracemalloc. Defaults to `PIPELINE_PROFILE`.
+
+    Returns:
+        dict: The result of every stage that succeeded, by stage name
+    """
+    run_id = datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds")
+    names = [stage.name for stage in stages]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Stage names must be unique: {names}")
+
+    pending = {stage.name: stage for stage in stages}
+    results, failed = {}, set()
+    running = {}
+    metrics = []
+
+    threads = ThreadPoolExecutor(max_workers=max_workers)
+    processes = ProcessPoolExecutor(max_workers=max_workers) if any(
+        stage.executor == "process" for stage in stages) else None
+    try:
+        while pending or running:
+            for name, stage in list(pending.items()):
+                if any(dependency in failed or dependency not in names for dependency in stage.depends_on):
+                    logger.warning(
+                        f"Skipping stage {name} because one of its dependencies {stage.depends_on} did not succeed")
+                    failed.add(name)
+                    metrics.append({"run_id": run_id, "stage": name, "status": "skipped"})
+                    del pending[name]
+                elif all(dependency in results for dependency in stage.depends_on):
+                    pool = processes if stage.executor == "process" else threads
+                    args = [results[dependency]
+                            for dependency in stage.depends_on]
+                    logger.info(f"Starting stage {name}")
+                    running[pool.submit(run_stage, name, stage.func, tuple(args), stage.kwargs, run_id, profile)] = name
+                    del pending[name]
+
+            if not running:
+                # Whatever is still pending waits on a dependency cycle
+                for name in pending:
+                    logger.error(
+                        f"Skipping stage {name} because its dependencies form a cycle")
+                failed.update(pending)
+                metrics.extend({"run_id": run_id, "stage": name, "status": "skipped"} for name in pending)
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    result, stage_metrics = future.result()
+                except Exception as e:
+                    # e.g. a process stage whose result could not be pickled
+                    result, stage_metrics = None, {"run_id": run_id, "stage": name,
+                                                   "status": "failed", "error": str(e)}
+                metrics.append(stage_metrics)
+                if stage_metrics["status"] == "failed":
+                    failed.add(name)
+                    logger.error(f"Stage {name} failed: {stage_metrics['error']}")
+                else:
+                    results[name] = result
+                    logger.success(
+                        f"Finished stage {name} in {stage_metrics['duration_seconds']:.2f}s ({stage_metrics['rows_in']} rows in, {stage_metrics['rows_out']} rows out, peak RSS {stage_metrics['peak_rss_mb']} MB)")
+    finally:
+        threads.shutdown()
+        if processes:
+            processes.shutdown()
+
+    logger.info(
+        f"Pipeline finished: {len(results)} stages succeeded, {len(failed)} failed or skipped")
+    if persist_metrics:
+        save_pipeline_run(metrics)
+    return results
@@ -0,0 +1,122 @@
+import os
+
+import numpy as np
+import pandas as pd
+from loguru import logger
+
+from datapipelines.instrument import record_stage_error
+
+# Sources in order of priority, matched as substrings of `sourceName`. Sources that match none come last.
+SOURCE_PRIORITY = os.getenv("APPLE_SOURCE_PRIORITY", "Watch,iPhone").split(",")
+
+# Cumulative metrics (shortened HealthKit types) that every device records for the same minutes, so summing them
+# across sources double-counts. Discrete metrics like heart rate are averaged and left alone.
+DEDUPLICATED_METRICS = [
+    "StepCount",
+    "DistanceWalkingRunning",
+    "DistanceCycling",
+    "DistanceSwimming",
+    "ActiveEnergyBurned",
+    "BasalEnergyBurned",
+    "FlightsClimbed",
+    "AppleExerciseTime",
+    "AppleStandTime",
+]
+
+
+def _source_ranks(sources: pd.Series, priority: list) -> np.ndarray:
+    """The priority rank of every row's source, 0 being the highest. Ranks are looked up once per distinct source."""
+    sources = sources.astype("category")
+    ranks = [next((rank for rank, pattern in enumerate(priority) if pattern in str(source)), len(priority))
+             for source in sources.cat.categories]
+    # missing sources have code -1, which picks the trailing lowest rank
+    return np.array(ranks + [len(priority)], dtype=np.int64)[sources.cat.codes.to_numpy()]
+
+
+def _covered_seconds(cover_start: np.ndarray, cover_end: np.ndarray, start: np.ndarray, end: np.ndarray) -> tuple:
+    """How much of every [start, end) interval is covered by the union of the cover intervals
+
+    The cover intervals are sorted once and merged into disjoint intervals with a running maximum of their ends. A
+    prefix sum of the merged lengths then gives the covered time before any instant with one binary search, so the
+    whole sweep is O(n log n).
+
+    Returns:
+        tuple: The covered length of every interval and whether its start lies inside the cover (for zero-length samples)
+    """
+    if len(cover_start) == 0:
+        return np.zeros(len(start), dtype=np.int64), np.zeros(len(start), dtype=bool)
+    order = np.argsort(cover_start, kind="stable")
+    cover_start, cover_end = cover_start[order], cover_end[order]
+    reach = np.maximum.accumulate(cover_end)
+    # a merged interval starts wherever a cover interval begins after everything before it has ended
+    first = np.r_[True, cover_start[1:] > reach[:-1]]
+    merged_start = cover_start[first]
+    merged_end = reach[np.r_[np.flatnonzero(first)[1:] - 1, len(reach) - 1]]
+    covered_before = np.r_[0, np.cumsum(merged_end - merged_start)]
+
+    def covered_until(instant):
+        i = np.searchsorted(merged_start, instant, side="right") - 1
+        inside = np.clip(np.minimum(instant, merged_end[i]) - merged_start[i], 0, None)
+        return np.where(i >= 0, covered_before[np.maximum(i, 0)] + inside, 0)
+
+    i = np.searchsorted(merged_start, start, side="right") - 1
+    start_covered = (i >= 0) & (start < merged_end[np.maximum(i, 0)])
+    return covered_until(end) - covered_until(start), start_covered
+
+
+def deduplicate_sources(data: pd.DataFrame, priority: list = None, metrics: list = None) -> pd.DataFrame:
+    """Resolves samples of the same metric that several sources recorded for the same time, like Apple's own merge
+
+    Per metric, every source keeps only the part of its samples that no higher priority source covers. Partly covered
+    samples keep their interval and their value is prorated by the share of it left uncovered; fully covered samples
+    are dropped. All metrics are swept at once: their timelines are laid end to end, so one sort per priority rank
+    handles every metric.
+
+    Args:
+        data (pd.DataFrame): Typed Apple Health records, with `type`, `sourceName`, `startDate`, `endDate` and `value` columns
+        priority (list, optional): Source name substrings, highest priority first. Defaults to `SOURCE_PRIORITY`.
+        metrics (list, optional): The shortened types to deduplicate. Defaults to `DEDUPLICATED_METRICS`.
+
+    Returns:
+        pd.DataFrame: `data` without the double-counted samples
+    """
+    priority = priority or SOURCE_PRIORITY
+    metrics = metrics or DEDUPLICATED_METRICS
+    try:
+        eligible = data["type"].isin(metrics).to_numpy()
+        if not eligible.any():
+            return data
+        rows = data[eligible]
+        metric = pd.Categorical(rows["type"].astype(str), categories=metrics).codes.astype(np.int64)
+        rank = _source_ranks(rows["sourceName"], priority)
+        # the exports have second resolution, which leaves room to offset every metric onto its own stretch of time
+        start = rows["startDate"].to_numpy(dtype="datetime64[s]").astype(np.int64)
+        end = rows["endDate"].to_numpy(dtype="datetime64[s]").astype(np.int64)
+        end = np.maximum(end, start)
+        span = end.max() - start.min() + 1
+        offset = metric * span - start.min()
+        start, end = start + offset, end + offset
+
+        keep = np.ones(len(rows), dtype=np.float64)
+        for current in np.unique(rank)[1:]:
+            covers, targets = rank < current, rank == current
+            covered, start_covered = _covered_seconds(start[covers], end[covers], start[targets], end[targets])
+            length = end[targets] - start[targets]
+            keep[targets] = np.where(length > 0, 1 - covered / np.maximum(length, 1), ~start_covered)
+
+        dropped = keep <= 0
+        prorated = (keep > 0) & (keep < 1)
+        values = rows["value"].to_numpy(dtype=np.float64) * keep
+        data = data.copy()
+        data.loc[eligible, "value"] = values.astype(data["value"].dtype)
+        covered = np.zeros(len(data), dtype=bool)
+        covered[np.flatnonzero(eligible)[dropped]] = True
+        data = data[~covered]
+
+        logger.success(
+            f"Deduplicated Apple Health sources: dropped {dropped.sum()} and prorated {prorated.sum()} of {len(rows)} cumulative samples")
+        return data
+    except Exception as e:
+        logger.error(f"Could not deduplicate Apple Health sources: {e}")
+        record_stage_error(e)
+        return data
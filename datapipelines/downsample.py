@@ -0,0 +1,120 @@
+import os
+
+import numpy as np
+import pandas as pd
+from loguru import logger
+
+from datapipelines.instrument import record_stage_error
+from datapipelines.transform import camel_to_snake
+
+# Metrics the Apple Watch samples often enough to be worth downsampling, as snake_case names
+HIGH_FREQUENCY_METRICS = os.getenv(
+    "DOWNSAMPLE_METRICS",
+    "heart_rate,heart_rate_variability_s_d_n_n,respiratory_rate,oxygen_saturation,active_energy_burned,"
+    "basal_energy_burned,step_count,distance_walking_running").split(",")
+
+# Bucket width of every resolution, finest first. Each resolution is aggregated from the one before it.
+RESOLUTIONS = {
+    "minute": pd.Timedelta(minutes=1),
+    "hour": pd.Timedelta(hours=1),
+    "day": pd.Timedelta(days=1),
+}
+
+# The table every resolution is loaded into
+DOWNSAMPLE_TABLES = {resolution: f"apple_health_metrics_{resolution}" for resolution in RESOLUTIONS}
+
+
+def _samples(data: pd.DataFrame, metrics: list) -> tuple:
+    """Returns the metric codes, metric names, start times (int64 ns, UTC) and values of the high-frequency samples
+
+    Accepts the wide frame of `transform_apple_health_data` (one column per metric) and the long frame of
+    `transform_apple_health_data_long` (`metric` and `value` columns).
+    """
+    if "metric" in data.columns:
+        # long: map every distinct metric name to its code once, then look the codes up per row
+        names = data["metric"].astype("category")
+        snake_names = [camel_to_snake(str(metric)) for metric in names.cat.categories]
+        metrics = [metric for metric in metrics if metric in snake_names]
+        lookup = np.array([metrics.index(name) if name in metrics else -1 for name in snake_names] + [-1],
+                          dtype=np.int64)
+        # missing names have code -1, which picks the trailing -1 of the lookup
+        codes = lookup[names.cat.codes.to_numpy()]
+        keep = (codes >= 0) & data["value"].notnull().to_numpy()
+        codes = codes[keep]
+        starts = data["start_date"].to_numpy(dtype="datetime64[ns]")[keep].view(np.int64)
+        values = data["value"].to_numpy(dtype=np.float64)[keep]
+        return codes, metrics, starts, values
+
+    # wide: every metric is a sparse column, keep the filled cells of each one
+    metrics = [metric for metric in metrics if metric in data.columns]
+    all_starts = data["start_date"].to_numpy(dtype="datetime64[ns]").view(np.int64)
+    codes, starts, values = [], [], []
+    for code, metric in enumerate(metrics):
+        column = data[metric].to_numpy(dtype=np.float64)
+        filled = ~np.isnan(column)
+        codes.append(np.full(filled.sum(), code, dtype=np.int64))
+        starts.append(all_starts[filled])
+        values.append(column[filled])
+    if not metrics:
+        return np.empty(0, np.int64), metrics, np.empty(0, np.int64), np.empty(0, np.float64)
+    return np.concatenate(codes), metrics, np.concatenate(starts), np.concatenate(values)
+
+
+def _aggregate(codes: np.ndarray, buckets: np.ndarray, minimum: np.ndarray, maximum: np.ndarray, count: np.ndarray, total: np.ndarray) -> tuple:
+    """Reduces partial aggregates to one row per (metric code, bucket) with NumPy, without a pandas groupby
+
+    The rows are sorted by metric and bucket once, then every reduction runs over the contiguous groups.
+    """
+    if len(codes) == 0:
+        return codes, buckets, minimum, maximum, count, total
+    order = np.lexsort((buckets, codes))
+    codes, buckets = codes[order], buckets[order]
+    starts = np.flatnonzero(np.r_[True, (codes[1:] != codes[:-1]) | (buckets[1:] != buckets[:-1])])
+    return (codes[starts], buckets[starts],
+            np.minimum.reduceat(minimum[order], starts), np.maximum.reduceat(maximum[order], starts),
+            np.add.reduceat(count[order], starts), np.add.reduceat(total[order], starts))
+
+
+def downsample_apple_health_data(data: pd.DataFrame, metrics: list = None, resolutions: dict = None) -> dict:
+    """Aggregates high-frequency Apple Health metrics into per-minute, per-hour and per-day buckets
+
+    Samples are bucketed on their start time (UTC). The finest resolution is aggregated from the samples, every coarser
+    one from the resolution before it, so only the finest resolution has to go through the raw samples.
+
+    Args:
+        data (pd.DataFrame): A pandas DataFrame returned from `transform_apple_health_data` (wide) or `transform_apple_health_data_long` (long)
+        metrics (list, optional): The snake_case metrics to downsample. Defaults to `HIGH_FREQUENCY_METRICS`.
+        resolutions (dict, optional): {resolution name: bucket width}, finest first. Defaults to `RESOLUTIONS`.
+
+    Returns:
+        dict: {resolution name: DataFrame} with `metric`, `start_date`, `min_value`, `max_value`, `mean_value`, `sum_value` and `sample_count` columns
+    """
+    metrics = metrics or HIGH_FREQUENCY_METRICS
+    resolutions = resolutions or RESOLUTIONS
+    try:
+        codes, metrics, starts, values = _samples(data, metrics)
+        aggregates = (codes, starts, values, values, np.ones(len(values), dtype=np.int64), values)
+
+        downsampled = {}
+        for resolution, width in resolutions.items():
+            width = width.value
+            codes, starts, minimum, maximum, count, total = aggregates
+            aggregates = _aggregate(codes, starts // width * width, minimum, maximum, count, total)
+            codes, buckets, minimum, maximum, count, total = aggregates
+            downsampled[resolution] = pd.DataFrame({
+                "metric": pd.Categorical.from_codes(codes, categories=metrics),
+                "start_date": pd.to_datetime(buckets, utc=True),
+                "min_value": minimum.astype(np.float32),
+                "max_value": maximum.astype(np.float32),
+                "mean_value": (total / count).astype(np.float32),
+                "sum_value": total,
+                "sample_count": count,
+            })
+
+        logger.success(
+            f"Downsampled {len(values)} samples of {len(metrics)} metrics into " +
+            ", ".join(f"{len(frame)} {resolution}" for resolution, frame in downsampled.items()) + " buckets")
+        return downsampled
+    except Exception as e:
+        logger.error(f"Could not downsample Apple Health data: {e}")
+        record_stage_error(e)
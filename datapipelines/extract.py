@@ -1,39 +1,399 @@
+import io
+import mmap
+import os
 import xml.etree.ElementTree as ET
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from itertools import repeat
+from typing import Iterator
 
 import pandas as pd
 from loguru import logger
+from pandas.api.types import union_categoricals
 
+from datapipelines.cache import read_cache, write_cache
+from datapipelines.instrument import record_stage_error
+from datapipelines.schema import STRONG_SCHEMA, read_csv_dtypes
 
-def extract_apple_health_data(path: str = "./data/apple_health_export/export.xml", start_date: str = None) -> pd.DataFrame:
-    # create element tree object
-    tree = ET.parse(path)
 
-    # for every health record, extract the attributes into a dictionary (columns). Then create a list (rows).
-    root = tree.getroot()
-    record_list = [x.attrib for x in root.iter('Record')]
+# Rows per chunk when reading the Strong CSV export
+STRONG_CHUNK_SIZE = int(os.getenv("STRONG_CHUNK_SIZE", 100_000))
 
-    # create DataFrame from a list (rows) of dictionaries (columns)
+# Buffer in front of the decompressor, so the XML parser's small reads don't each pay the zip read overhead
+ZIP_READ_BUFFER = 1024 * 1024
+
+# Bytes after a candidate shard boundary that are searched for the end of an enclosing `Correlation`. Correlations
+# only hold a few Records and their metadata, so a Correlation that is still open ends well within this window.
+CORRELATION_SEARCH_WINDOW = 1024 * 1024
+
+
+def _export_member(archive: zipfile.ZipFile) -> str:
+    """Finds `export.xml` in the archive the iPhone exports (`apple_health_export/export.xml`)"""
+    names = [name for name in archive.namelist() if name.rsplit("/", 1)[-1] == "export.xml"]
+    if not names:
+        raise FileNotFoundError(f"No export.xml in {archive.filename}")
+    # The shallowest match is the export itself
+    return min(names, key=lambda name: name.count("/"))
+
+
+@contextmanager
+def open_apple_health_export(path: str):
+    """Opens the Apple Health export as a binary file object, from `export.xml` or straight out of `export.zip`
+
+    Zip members are decompressed while they are read, so nothing is extracted to disk.
+
+    Args:
+        path (str): Path to `export.xml` or to the `export.zip` archive that contains it
+
+    Yields:
+        A binary file object over the contents of `export.xml`
+    """
+    if zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as archive, archive.open(_export_member(archive)) as member:
+            yield io.BufferedReader(member, buffer_size=ZIP_READ_BUFFER)
+    else:
+        with open(path, "rb") as f:
+            yield f
+
+
+def iter_apple_health_export_members(path: str, suffix: str = None) -> Iterator[tuple]:
+    """Streams the members of `export.zip` (workout routes, electrocardiograms, clinical records...) without extracting them
+
+    Args:
+        path (str): Path to the `export.zip` archive
+        suffix (str, optional): Only yield members whose name ends with this, e.g. ".gpx". Defaults to None.
+
+    Yields:
+        tuple: The member name and a binary file object over its contents, valid until the next member is yielded
+    """
+    with zipfile.ZipFile(path) as archive:
+        for info in archive.infolist():
+            if info.is_dir() or (suffix and not info.filename.endswith(suffix)):
+                continue
+            with archive.open(info) as member:
+                yield info.filename, io.BufferedReader(member, buffer_size=ZIP_READ_BUFFER)
+
+
+# Output streams of `stream_apple_health_elements`, one per kind of element in the export
+APPLE_HEALTH_STREAMS = ["records", "correlations", "workouts", "workout_statistics", "workout_events",
+                        "activity_summaries"]
+
+
+def stream_apple_health_elements(path="./data/apple_health_export/export.xml", start_date: str = None, chunk_size: int = 100_000) -> Iterator[tuple]:
+    """Incrementally parses the Apple Health export and routes every kind of element into its own stream
+
+    One pass over the file produces all of the streams in `APPLE_HEALTH_STREAMS`:
+        records: `Record` attributes, including the records nested in a `Correlation`
+        correlations: `Correlation` attributes plus one column per nested record type with its value (e.g. blood pressure)
+        workouts: `Workout` attributes
+        workout_statistics / workout_events: `WorkoutStatistics` / `WorkoutEvent` attributes, with the `workoutStartDate` and `workoutSourceName` of their workout
+        activity_summaries: `ActivitySummary` (activity rings) attributes
+
+    Elements are cleared as soon as they have been processed, so memory stays flat regardless of the size of `export.xml`.
+
+    Args:
+        path (str or file object, optional): Path to the Apple Health `export.xml` file, or a binary file object to read it from. Defaults to "./data/apple_health_export/export.xml".
+        start_date (str, optional): Only keep elements whose `startDate` (`dateComponents` for activity summaries) is on or after this date. Defaults to None.
+        chunk_size (int, optional): Number of rows per yielded DataFrame. Defaults to 100_000.
+
+    Yields:
+        tuple: The name of a stream and a DataFrame chunk of at most `chunk_size` of its rows
+    """
+    context = ET.iterparse(path, events=("start", "end"))
+    # The first event is the start of the root element (`HealthData`), which we need to clear processed children from
+    _, root = next(context)
+
+    depth = 0
+    rows = {stream: [] for stream in APPLE_HEALTH_STREAMS}
+    # Values of the records nested in the `Correlation` being parsed, None outside of a Correlation
+    correlation_values = None
+    for event, elem in context:
+        if event == "start":
+            if depth == 0 and elem.tag == "Correlation":
+                correlation_values = {}
+            depth += 1
+            continue
+        depth -= 1
+
+        # Filter by start date while parsing, so filtered out elements never reach a DataFrame
+        keep = not start_date or elem.get("startDate", "") >= start_date
+        # `Record` elements can also be nested inside of `Correlation` elements, so match them at any depth
+        if elem.tag == "Record":
+            if keep:
+                rows["records"].append(dict(elem.attrib))
+            if correlation_values is not None:
+                correlation_values[elem.get("type")] = elem.get("value")
+            elem.clear()
+        elif depth == 0 and elem.tag == "Correlation":
+            if keep:
+                rows["correlations"].append(dict(elem.attrib, **correlation_values))
+            correlation_values = None
+        elif depth == 0 and elem.tag == "Workout":
+            if keep:
+                rows["workouts"].append(dict(elem.attrib))
+                parent = {"workoutStartDate": elem.get("startDate"), "workoutSourceName": elem.get("sourceName")}
+                for child in elem:
+                    if child.tag == "WorkoutStatistics":
+                        rows["workout_statistics"].append(dict(child.attrib, **parent))
+                    elif child.tag == "WorkoutEvent":
+                        rows["workout_events"].append(dict(child.attrib, **parent))
+        elif depth == 0 and elem.tag == "ActivitySummary":
+            if not start_date or elem.get("dateComponents", "") >= start_date[:10]:
+                rows["activity_summaries"].append(dict(elem.attrib))
+
+        for stream, stream_rows in rows.items():
+            if len(stream_rows) >= chunk_size:
+                yield stream, pd.DataFrame(stream_rows)
+                rows[stream] = []
+
+        # Drop every fully processed top level element from the tree
+        if depth == 0:
+            root.clear()
+
+    for stream, stream_rows in rows.items():
+        if stream_rows:
+            yield stream, pd.DataFrame(stream_rows)
+
+
+def _collect_streams(chunks: Iterator[tuple]) -> dict:
+    """Concatenates the chunks of `stream_apple_health_elements` into one DataFrame per stream"""
+    frames = {stream: [] for stream in APPLE_HEALTH_STREAMS}
+    for stream, chunk in chunks:
+        frames[stream].append(chunk)
+    return {stream: pd.concat(chunks, ignore_index=True) if chunks else pd.DataFrame()
+            for stream, chunks in frames.items()}
+
+
+def stream_apple_health_data(path="./data/apple_health_export/export.xml", start_date: str = None, chunk_size: int = 100_000) -> Iterator[pd.DataFrame]:
+    """Incrementally parses the Apple Health export and yields `Record` attributes as DataFrame chunks
+
+    Only the records stream of `stream_apple_health_elements`, see there for the arguments.
+
+    Yields:
+        pd.DataFrame: A chunk of at most `chunk_size` records
+    """
+    for stream, chunk in stream_apple_health_elements(path, start_date=start_date, chunk_size=chunk_size):
+        if stream == "records":
+            yield chunk
+
+
+class _ShardReader:
+    """Binary file object over a byte range of `export.xml`, wrapped in its own root element so it parses on its own"""
+
+    def __init__(self, f, start: int, end: int):
+        self._f = f
+        self._f.seek(start)
+        self._remaining = end - start
+        self._prefix = b"<HealthData>"
+        self._suffix = b"</HealthData>"
+
+    def read(self, size: int = -1) -> bytes:
+        if size is None or size < 0:
+            size = len(self._prefix) + self._remaining + len(self._suffix)
+        if self._prefix:
+            data, self._prefix = self._prefix[:size], self._prefix[size:]
+            return data
+        if self._remaining:
+            data = self._f.read(min(size, self._remaining))
+            self._remaining -= len(data)
+            return data
+        data, self._suffix = self._suffix[:size], self._suffix[size:]
+        return data
+
+
+def _next_record_boundary(mm: mmap.mmap, position: int, end: int) -> int:
+    """Returns the offset of the first top level `<Record` at or after `position`, or `end` if there is none"""
+    while True:
+        record = mm.find(b"<Record ", position, end)
+        if record == -1:
+            return end
+        # Records nested inside a `Correlation` can't start a shard, so skip past the end of that Correlation. Only a
+        # window after the Record is searched, otherwise every boundary of a file without Correlations scans to its end.
+        window_end = min(end, record + CORRELATION_SEARCH_WINDOW)
+        closing = mm.find(b"</Correlation>", record, window_end)
+        opening = mm.find(b"<Correlation", record, window_end)
+        if closing != -1 and (opening == -1 or closing < opening):
+            position = closing + len(b"</Correlation>")
+            continue
+        return record
+
+
+def shard_apple_health_export(path: str, shards: int) -> list:
+    """Splits `export.xml` into byte ranges that start on top level `<Record` elements
+
+    Every range holds only complete top level elements, so the shards can be parsed independently and in parallel.
+
+    Args:
+        path (str): Path to the Apple Health `export.xml` file
+        shards (int): The number of shards to aim for. Small files may produce fewer.
+
+    Returns:
+        list: (start, end) byte offsets of each shard, in file order
+    """
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        # Shards cover everything between the `<HealthData ...>` start tag and the `</HealthData>` end tag
+        start = mm.find(b">", mm.find(b"<HealthData")) + 1
+        end = mm.rfind(b"</HealthData>")
+
+        boundaries = [start]
+        for i in range(1, shards):
+            boundary = _next_record_boundary(
+                mm, start + (end - start) * i // shards, end)
+            if boundaries[-1] < boundary < end:
+                boundaries.append(boundary)
+        boundaries.append(end)
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def _extract_shard(path: str, start: int, end: int, start_date: str = None, chunk_size: int = 100_000) -> dict:
+    """Parses every stream of one shard of `export.xml` into a DataFrame per stream"""
+    with open(path, "rb") as f:
+        return _collect_streams(stream_apple_health_elements(
+            _ShardReader(f, start, end), start_date=start_date, chunk_size=chunk_size))
+
+
+def extract_apple_health_data_parallel(path: str = "./data/apple_health_export/export.xml", start_date: str = None, chunk_size: int = 100_000, workers: int = None) -> dict:
+    """Parses `export.xml` in shards on a process pool and merges them in file order
+
+    The result is identical to parsing the file serially with `stream_apple_health_elements`.
+
+    Args:
+        path (str, optional): Path to the Apple Health `export.xml` file. Defaults to "./data/apple_health_export/export.xml".
+        start_date (str, optional): Only keep elements whose `startDate` is on or after this date. Defaults to None.
+        chunk_size (int, optional): Number of rows per parsed chunk. Defaults to 100_000.
+        workers (int, optional): Number of worker processes. Defaults to None, which uses one per CPU.
+
+    Returns:
+        dict: A pandas DataFrame per stream of `APPLE_HEALTH_STREAMS`
+    """
+    workers = workers or os.cpu_count() or 1
+    shards = shard_apple_health_export(path, workers)
+    logger.info(
+        f"Parsing {path} in {len(shards)} shards with {workers} workers")
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # `map` returns the results in submission order, which keeps the elements in file order
+        starts, ends = zip(*shards)
+        shard_streams = list(executor.map(_extract_shard, repeat(path), starts, ends,
+                                          repeat(start_date), repeat(chunk_size)))
+    streams = {}
+    for stream in APPLE_HEALTH_STREAMS:
+        frames = [shard[stream] for shard in shard_streams if not shard[stream].empty]
+        streams[stream] = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+    return streams
+
+
+def extract_apple_health_export(path: str = "./data/apple_health_export/export.xml", start_date: str = None, chunk_size: int = 100_000, use_cache: bool = True, workers: int = 1) -> dict:
+    """Extracts every stream of the Apple Health export (records, correlations, workouts, activity summaries...) in one pass
+
+    Args:
+        path (str, optional): Path to `export.xml`, or to the `export.zip` that contains it. Defaults to "./data/apple_health_export/export.xml".
+        start_date (str, optional): Only keep elements whose `startDate` is on or after this date. Defaults to None.
+        chunk_size (int, optional): Number of rows per parsed chunk. Defaults to 100_000.
+        use_cache (bool, optional): True to reuse the parsed streams of an unchanged export. Defaults to True.
+        workers (int, optional): Number of processes that parse shards of `export.xml`. Defaults to 1.
+
+    Returns:
+        dict: A pandas DataFrame per stream of `APPLE_HEALTH_STREAMS`
+    """
+    # Skip parsing entirely if this version of the export was already parsed
+    params = {stream: {"kind": f"apple_health_{stream}", "start_date": start_date}
+              for stream in APPLE_HEALTH_STREAMS}
+    if use_cache:
+        streams = {stream: read_cache(path, params[stream]) for stream in APPLE_HEALTH_STREAMS}
+        if all(data is not None for data in streams.values()):
+            return streams
+
+    streams = {stream: pd.DataFrame() for stream in APPLE_HEALTH_STREAMS}
     try:
-        data = pd.DataFrame(record_list)
-        # Filter by start date if provided
-        if start_date:
-            data = data[data['startDate'] >= start_date]
-        logger.success("Created DataFrame from Apple Health XML file")
-        logger.debug(f"Shape of DataFrame: {data.shape}")
-        logger.debug(f"Data: {data}")
+        is_zip = zipfile.is_zipfile(path)
+        if workers > 1 and is_zip:
+            # Shards need random access to the uncompressed bytes, a compressed stream can only be read in order
+            logger.info(
+                f"Parsing {path} serially, zip archives can't be split into shards")
+        if workers > 1 and not is_zip:
+            streams = extract_apple_health_data_parallel(
+                path, start_date=start_date, chunk_size=chunk_size, workers=workers)
+        else:
+            # create one DataFrame per stream from the streamed chunks
+            with open_apple_health_export(path) as f:
+                streams = _collect_streams(stream_apple_health_elements(
+                    f, start_date=start_date, chunk_size=chunk_size))
+        if use_cache:
+            for stream, data in streams.items():
+                write_cache(data, path, params[stream])
+        logger.success(
+            f"Created DataFrames from Apple Health XML file: {', '.join(f'{len(data)} {stream}' for stream, data in streams.items())}")
+        logger.opt(lazy=True).debug("Data: {}", lambda: streams["records"])
     except Exception as e:
         logger.error(f"Could not create DataFrame from Apple Health data: {e}")
+        record_stage_error(e)
+    return streams
+
+
+def extract_apple_health_data(path: str = "./data/apple_health_export/export.xml", start_date: str = None, chunk_size: int = 100_000, use_cache: bool = True, workers: int = 1) -> pd.DataFrame:
+    """Extracts the `Record` elements of the Apple Health export, see `extract_apple_health_export` for the arguments"""
+    return extract_apple_health_export(path, start_date=start_date, chunk_size=chunk_size, use_cache=use_cache,
+                                       workers=workers)["records"]
+
+
+def _concat_chunks(chunks: list) -> pd.DataFrame:
+    """Concatenates DataFrame chunks, keeping their categorical columns categorical
+
+    `pd.concat` falls back to object columns when the chunks' categories differ, so those columns are unioned instead.
+    """
+    if not chunks:
+        return pd.DataFrame()
+    data = pd.concat(chunks, ignore_index=True)
+    for column in chunks[0].select_dtypes("category").columns:
+        data[column] = union_categoricals([chunk[column] for chunk in chunks])
     return data
 
 
-def extract_strong_app_data(path: str = "./data/strong_export/strong.csv", start_date: str = None) -> pd.DataFrame:
+def extract_strong_app_data(path: str = "./data/strong_export/strong.csv", start_date: str = None, since: pd.Timestamp = None, use_cache: bool = True, chunk_size: int = STRONG_CHUNK_SIZE) -> pd.DataFrame:
+    """Reads the Strong App CSV export in typed chunks, keeping only the sets in the requested date range
+
+    Columns are typed by the C parser while it reads (see `STRONG_SCHEMA`), and the date filters are applied to every
+    chunk as it is read, so sets outside the range never pile up in memory.
+
+    Args:
+        path (str, optional): Path to `strong.csv`. Defaults to "./data/strong_export/strong.csv".
+        start_date (str, optional): Only keep sets on or after this date. Defaults to None.
+        since (pd.Timestamp, optional): Only keep sets at or after the last loaded `created_at`, e.g. the earliest watermark of the tables loaded from the sets. Defaults to None.
+        use_cache (bool, optional): True to reuse the parsed sets of an unchanged export. Defaults to True.
+        chunk_size (int, optional): Number of rows per chunk. Defaults to `STRONG_CHUNK_SIZE`.
+
+    Returns:
+        pd.DataFrame: The sets, with the Strong CSV column names
+    """
+    # `Date` is read as a "%Y-%m-%d %H:%M:%S" string, which compares correctly with strings of the same format
+    if since is not None:
+        since = pd.Timestamp(since)
+        if since.tzinfo is not None:
+            since = since.tz_convert("UTC").tz_localize(None)
+        since = since.strftime("%Y-%m-%d %H:%M:%S")
+    bounds = [bound for bound in [start_date, since] if bound]
+
+    # Skip parsing entirely if this version of the export was already parsed
+    params = {"kind": "strong_sets", "start_date": start_date, "since": since}
+    data = read_cache(path, params) if use_cache else None
+    if data is not None:
+        return data
+
     try:
-        data = pd.read_csv(path)
-        if start_date:
-            data = data[data['Date'] >= start_date]
-        logger.success("Created DataFrame from Strong CSV file")
-        logger.debug(f"Shape of DataFrame: {data.shape}")
-        logger.debug(f"Data: {data}")
+        chunks = []
+        for chunk in pd.read_csv(path, engine="c", dtype=read_csv_dtypes(STRONG_SCHEMA), chunksize=chunk_size):
+            if bounds:
+                chunk = chunk[chunk['Date'] >= max(bounds)]
+            chunks.append(chunk)
+        data = _concat_chunks(chunks)
+        if use_cache:
+            write_cache(data, path, params)
+        logger.success(
+            f"Created DataFrame from Strong CSV file: {len(data)} sets{' since ' + max(bounds) if bounds else ''}")
+        logger.opt(lazy=True).debug("Shape of DataFrame: {}", lambda: data.shape)
+        logger.opt(lazy=True).debug("Data: {}", lambda: data)
     except Exception as e:
         logger.error(f"Could not read Strong CSV file: {e}")
+        record_stage_error(e)
     return data
@@ -0,0 +1,153 @@
+import pandas as pd
+from loguru import logger
+from sqlalchemy import inspect, text
+from sqlalchemy.engine.base import Connection
+
+# Table that keeps the high watermark of every incrementally loaded table
+WATERMARK_TABLE = "pipeline_watermarks"
+
+# Columns that identify a row of each table. They are hashed into the `record_key` column.
+RECORD_KEY_COLUMNS = {
+    "apple_health_records": ["metric", "source_name", "start_date", "end_date", "creation_date"],
+    "apple_health_activity_raw": ["start_date", "end_date", "creation_date", "source_name"],
+    # A night keeps its bed time when it is sessionized again with more samples, its latest `creation_date` doesn't
+    "apple_health_sleep_raw": ["bed_time"],
+    "strong_app_raw": ["created_at", "workout_name", "exercise_name", "set_order"],
+    "apple_health_workouts": ["workout_activity_type", "source_name", "start_date", "end_date"],
+    "apple_health_activity_summaries": ["date_components"],
+    "apple_health_metrics_minute": ["metric", "start_date"],
+    "apple_health_metrics_hour": ["metric", "start_date"],
+    "apple_health_metrics_day": ["metric", "start_date"],
+}
+
+# Time column that the watermark of each table is tracked on
+WATERMARK_COLUMNS = {
+    "apple_health_records": "start_date",
+    "apple_health_activity_raw": "start_date",
+    # The last loaded night is at the watermark, so it is re-read and recomputed by the next load
+    "apple_health_sleep_raw": "bed_time",
+    "strong_app_raw": "created_at",
+    "apple_health_workouts": "start_date",
+    "apple_health_activity_summaries": "date_components",
+    "apple_health_metrics_minute": "start_date",
+    "apple_health_metrics_hour": "start_date",
+    "apple_health_metrics_day": "start_date",
+}
+
+
+def add_record_key(data: pd.DataFrame, key_columns: list) -> pd.DataFrame:
+    """Adds a deterministic `record_key` column by hashing the key columns of every row
+
+    Args:
+        data (pd.DataFrame): A pandas DataFrame
+        key_columns (list): The columns that uniquely identify a row
+
+    Returns:
+        pd.DataFrame: A copy of `data` with a signed 64-bit `record_key` column
+    """
+    data = data.copy()
+    hashed = pd.util.hash_pandas_object(data[key_columns], index=False)
+    # Postgres has no unsigned 64-bit integer, so reinterpret the hash as a signed bigint
+    data["record_key"] = hashed.to_numpy().view("int64")
+    return data
+
+
+def _align_timezone(watermark: pd.Timestamp, series: pd.Series) -> pd.Timestamp:
+    """Makes `watermark` comparable with `series`, which may or may not be timezone aware"""
+    tz = getattr(series.dtype, "tz", None)
+    if watermark.tzinfo is None and tz is not None:
+        return watermark.tz_localize("UTC").tz_convert(tz)
+    if watermark.tzinfo is not None and tz is None and pd.api.types.is_datetime64_dtype(series):
+        return watermark.tz_convert("UTC").tz_localize(None)
+    return watermark
+
+
+def get_watermark(conn: Connection, table_name: str) -> pd.Timestamp:
+    """Returns the high watermark of `table_name`, or None if the table was never loaded incrementally"""
+    if not inspect(conn).has_table(WATERMARK_TABLE, schema="public"):
+        return None
+    watermark = conn.execute(text(f"select watermark from public.{WATERMARK_TABLE} where table_name = :table_name"),
+                             {"table_name": table_name}).scalar()
+    return pd.Timestamp(watermark) if watermark is not None else None
+
+
+def ensure_watermark_table(conn: Connection):
+    """Creates the table of watermarks, see `create_pipeline_tables`"""
+    conn.execute(text(f"""create table if not exists public.{WATERMARK_TABLE} (
+    table_name text primary key
+    , watermark timestamp with time zone
+    , updated_at timestamp with time zone not null default now()
+)"""))
+
+
+def set_watermark(conn: Connection, table_name: str, watermark: pd.Timestamp):
+    """Stores the high watermark of `table_name`, the watermark table must exist (see `ensure_watermark_table`)"""
+    conn.execute(text(f"""insert into public.{WATERMARK_TABLE} (table_name, watermark, updated_at)
+values (:table_name, :watermark, now())
+on conflict (table_name) do update set watermark = excluded.watermark, updated_at = excluded.updated_at"""),
+                 {"table_name": table_name, "watermark": None if pd.isnull(watermark) else pd.Timestamp(watermark).to_pydatetime()})
+
+
+def filter_since_watermark(data: pd.DataFrame, watermark: pd.Timestamp, watermark_column: str) -> pd.DataFrame:
+    """Keeps only the rows of `data` at or after `watermark`
+
+    Rows equal to the watermark are kept on purpose, they are deduplicated by `record_key` on insert.
+    """
+    if watermark is None or data.empty:
+        return data
+    watermark = _align_timezone(watermark, data[watermark_column])
+    return data[data[watermark_column] >= watermark]
+
+
+def _column_types(conn: Connection, table_name: str) -> dict:
+    """Returns a {column name: Postgres data type} dictionary for `table_name`"""
+    rows = conn.execute(text("""select column_name, data_type
+from information_schema.columns
+where table_schema = 'public' and table_name = :table_name
+order by ordinal_position"""), {"table_name": table_name})
+    return {column_name: data_type for column_name, data_type in rows}
+
+
+def upsert_from_staging(conn: Connection, staging_table: str, table_name: str, conflict_columns: tuple = ("record_key",), update: bool = True) -> int:
+    """Inserts the rows of `staging_table` into `table_name`, skipping or updating rows that already exist
+
+    Columns that only exist in the staging table (e.g. a newly seen Apple Health metric) are added to `table_name` first.
+
+    Args:
+        conn (Connection): SQLAlchemy connection object
+        staging_table (str): The table holding the new rows
+        table_name (str): The target table
+        conflict_columns (tuple, optional): The unique columns to detect existing rows on. Defaults to ("record_key",).
+        update (bool, optional): True to overwrite existing rows (upsert), False to keep them. Defaults to True.
+
+    Returns:
+        int: The number of inserted or updated rows
+    """
+    staging_types = _column_types(conn, staging_table)
+    target_types = _column_types(conn, table_name)
+
+    for column, data_type in staging_types.items():
+        if column not in target_types:
+            conn.execute(
+                text(f'alter table public."{table_name}" add column if not exists "{column}" {data_type}'))
+            logger.info(f"Added column {column} ({data_type}) to the {table_name} table")
+
+    columns = ", ".join(f'"{column}"' for column in staging_types)
+    conflict = ", ".join(f'"{column}"' for column in conflict_columns)
+    updates = [f'"{column}" = excluded."{column}"' for column in staging_types if column not in conflict_columns]
+    if update and updates:
+        on_conflict = f"do update set {', '.join(updates)}"
+    else:
+        on_conflict = "do nothing"
+
+    result = conn.execute(text(f"""insert into public."{table_name}" ({columns})
+select {columns} from public."{staging_table}"
+on conflict ({conflict}) {on_conflict}"""))
+    return result.rowcount
+
+
+def ensure_record_key_index(conn: Connection, table_name: str, conflict_columns: tuple = ("record_key",)):
+    """Creates the unique index that `upsert_from_staging` resolves conflicts on"""
+    conflict = ", ".join(f'"{column}"' for column in conflict_columns)
+    conn.execute(text(
+        f'create unique index if not exists "{table_name}_record_key_idx" on public."{table_name}" ({conflict})'))
@@ -0,0 +1,225 @@
+import cProfile
+import datetime
+import io
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+
+import pandas as pd
+from loguru import logger
+from sqlalchemy import text
+from sqlalchemy.engine.base import Connection
+
+# "1" to also run every stage under cProfile and tracemalloc, and write their reports to PIPELINE_PROFILE_DIR
+PIPELINE_PROFILE = os.getenv("PIPELINE_PROFILE", "0") == "1"
+PIPELINE_PROFILE_DIR = os.getenv("PIPELINE_PROFILE_DIR", "./logs/profiles")
+
+RUNS_TABLE = "pipeline_runs"
+
+# Bytes written to the DB and errors of the stage running on the current thread, see `record_bytes_written` and
+# `record_stage_error`
+_stage_state = threading.local()
+
+
+def rss_bytes() -> int:
+    """The resident set size of this process, from /proc/self/statm (Linux only, 0 elsewhere)"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return 0
+
+
+class PeakRSS:
+    """Samples the resident set size on a background thread and keeps the highest value seen
+
+    Stages that run at the same time share the process, so their peaks include each other's memory.
+    """
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def _sample(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, rss_bytes())
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self.peak = rss_bytes()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, rss_bytes())
+
+
+def count_rows(value) -> int:
+    """Counts the DataFrame rows in a stage argument or result (DataFrames, tuples/lists/dicts of them or a row count)"""
+    if isinstance(value, pd.DataFrame):
+        return len(value)
+    if isinstance(value, dict):
+        return count_rows(list(value.values()))
+    if isinstance(value, (tuple, list)):
+        counts = [count_rows(item) for item in value]
+        counts = [count for count in counts if count is not None]
+        return sum(counts) if counts else None
+    if isinstance(value, int) and not isinstance(value, bool):
+        return value
+    return None
+
+
+def record_bytes_written(written: int):
+    """Adds `written` bytes to the metrics of the stage running on the current thread, if any"""
+    if getattr(_stage_state, "bytes_written", None) is not None:
+        _stage_state.bytes_written += written
+
+
+def record_stage_error(error: Exception):
+    """Fails the stage running on the current thread, if any, with `error`
+
+    Extract, transform and load functions log their errors and return a fallback instead of raising, so they can also
+    be called on their own. Reporting the error here still lets `run_stage` mark the stage as failed.
+    """
+    if getattr(_stage_state, "errors", None) is not None:
+        _stage_state.errors.append(str(error))
+
+
+def _write_profile(profiler: cProfile.Profile, snapshot: tracemalloc.Snapshot, run_id: str, stage: str) -> str:
+    """Writes the cProfile stats (`.prof`) and a readable summary with the top allocations (`.txt`) of a stage"""
+    directory = os.path.join(PIPELINE_PROFILE_DIR, run_id.replace(":", "-"))
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, stage)
+    profiler.dump_stats(f"{path}.prof")
+
+    summary = io.StringIO()
+    pstats.Stats(profiler, stream=summary).sort_stats("cumulative").print_stats(30)
+    summary.write("\nTop allocations (tracemalloc):\n")
+    for statistic in snapshot.statistics("lineno")[:20]:
+        summary.write(f"{statistic}\n")
+    with open(f"{path}.txt", "w") as f:
+        f.write(summary.getvalue())
+    return f"{path}.prof"
+
+
+def run_stage(stage: str, func, args: tuple = (), kwargs: dict = None, run_id: str = None, profile: bool = PIPELINE_PROFILE) -> tuple:
+    """Runs a pipeline stage and measures it
+
+    Never raises: a failing stage returns a None result with status "failed" and the error, so the metrics of failed
+    stages are kept too. A stage fails when `func` raises or reports an error it handled with `record_stage_error`.
+    Module level, so it can run in a process pool.
+
+    Args:
+        stage (str): The name of the stage
+        func (callable): The stage function
+        args (tuple, optional): Positional arguments for `func`, counted as the stage's input rows. Defaults to ().
+        kwargs (dict, optional): Keyword arguments for `func`. Defaults to None.
+        run_id (str, optional): The pipeline run the stage belongs to, used to name profiles. Defaults to None.
+        profile (bool, optional): True to run under cProfile and tracemalloc. Defaults to `PIPELINE_PROFILE`.
+
+    Returns:
+        tuple: The result of `func` and a dictionary of metrics
+    """
+    metrics = {
+        "run_id": run_id,
+        "stage": stage,
+        "status": "succeeded",
+        "started_at": datetime.datetime.now(datetime.timezone.utc),
+        "rows_in": count_rows(list(args)),
+        "error": None,
+        "profile_path": None,
+    }
+    _stage_state.bytes_written = 0
+    _stage_state.errors = []
+    profiler = cProfile.Profile() if profile else None
+    if profile and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+    result = None
+    started_at = time.perf_counter()
+    with PeakRSS() as rss:
+        try:
+            if profiler:
+                profiler.enable()
+            result = func(*args, **(kwargs or {}))
+        except Exception as e:
+            metrics["status"] = "failed"
+            metrics["error"] = str(e)
+        finally:
+            if profiler:
+                profiler.disable()
+
+    if _stage_state.errors and metrics["status"] == "succeeded":
+        # `func` returned a fallback (e.g. its unchanged input or None), which dependent stages must not use
+        metrics["status"] = "failed"
+        metrics["error"] = "; ".join(_stage_state.errors)
+        result = None
+    _stage_state.errors = None
+
+    metrics["duration_seconds"] = time.perf_counter() - started_at
+    metrics["finished_at"] = datetime.datetime.now(datetime.timezone.utc)
+    metrics["rows_out"] = count_rows(result)
+    metrics["peak_rss_mb"] = round(rss.peak / 2**20, 1)
+    metrics["bytes_written"] = _stage_state.bytes_written
+    _stage_state.bytes_written = None
+
+    if profiler:
+        try:
+            metrics["profile_path"] = _write_profile(
+                profiler, tracemalloc.take_snapshot(), run_id or "adhoc", stage)
+        except Exception as e:
+            logger.error(f"Could not write the profile of stage {stage}: {e}")
+
+    return result, metrics
+
+
+def ensure_runs_table(conn: Connection, table_name: str = RUNS_TABLE):
+    """Creates the table that `save_pipeline_run` appends to, see `create_pipeline_tables`"""
+    conn.execute(text(f"""create table if not exists public.{table_name} (
+    run_id text not null
+    , stage text not null
+    , status text not null
+    , started_at timestamp with time zone
+    , finished_at timestamp with time zone
+    , duration_seconds double precision
+    , rows_in bigint
+    , rows_out bigint
+    , peak_rss_mb real
+    , bytes_written bigint
+    , error text
+    , profile_path text
+    , primary key (run_id, stage)
+)"""))
+
+
+def save_pipeline_run(metrics: list, table_name: str = RUNS_TABLE):
+    """Appends the metrics of every stage of a pipeline run to the `pipeline_runs` table, which must exist (see `ensure_runs_table`)
+
+    Args:
+        metrics (list): The metrics dictionaries returned by `run_stage`
+        table_name (str, optional): The table to write to. Defaults to "pipeline_runs".
+    """
+    # Imported here, so stages running in worker processes don't need the DB settings
+    from datapipelines.incremental import set_watermark
+    from db.utils import init_db_connection
+
+    columns = ["run_id", "stage", "status", "started_at", "finished_at", "duration_seconds", "rows_in", "rows_out",
+               "peak_rss_mb", "bytes_written", "error", "profile_path"]
+    try:
+        conn = init_db_connection()
+        with conn.begin():
+            conn.execute(text(f"""insert into public.{table_name} ({", ".join(columns)})
+values ({", ".join(":" + column for column in columns)})
+on conflict (run_id, stage) do nothing"""), [{column: row.get(column) for column in columns} for row in metrics])
+            set_watermark(conn, table_name, max((row["finished_at"] for row in metrics if row.get("finished_at")),
+                                                default=None))
+        conn.close()
+        logger.success(f"Saved the metrics of {len(metrics)} stages to the {table_name} table")
+    except Exception as e:
+        logger.error(f"Could not save the pipeline run metrics: {e}")
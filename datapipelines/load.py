@@ -1,58 +1,335 @@
+import functools
 import os
 import time
 
+import pandas as pd
 from dotenv import load_dotenv
 from loguru import logger
+from sqlalchemy import inspect, text
 
+from datapipelines.bulk import write_frame
+from datapipelines.incremental import (RECORD_KEY_COLUMNS, WATERMARK_COLUMNS,
+                                       add_record_key, ensure_record_key_index,
+                                       ensure_watermark_table,
+                                       filter_since_watermark, get_watermark,
+                                       set_watermark, upsert_from_staging)
+from datapipelines.instrument import ensure_runs_table, record_stage_error
+from datapipelines.rollups import refresh_rollups
+from datapipelines.star import write_strong_star
+from datapipelines.strength import write_strength
+from datapipelines.transform import camel_to_snake
+from db.tables import TABLES, ensure_table, is_managed, prepare_table
 from db.utils import init_db_connection
 
-# Load environment variables from the .env file
-# os.path.dirname(__file__): Gives you the directory of your Python script.
-# ..: Moves up one level to the parent directory.
-# 'db': Enters the db directory.
-# '.env': Specifies the .env file you want to access.
-dotenv_path = os.path.join(os.path.dirname(__file__), '..', 'db', '.env')
-try:
-    load_dotenv(dotenv_path)
-    logger.success("Loaded .env file")
-except:
-    logger.error("Could not load .env file")
+def load_env():
+    """Loads the DB credentials from the db/.env file into the environment"""
+    # os.path.dirname(__file__): Gives you the directory of your Python script.
+    # ..: Moves up one level to the parent directory.
+    # 'db': Enters the db directory.
+    # '.env': Specifies the .env file you want to access.
+    dotenv_path = os.path.join(os.path.dirname(__file__), '..', 'db', '.env')
+    try:
+        load_dotenv(dotenv_path)
+        logger.success("Loaded .env file")
+    except:
+        logger.error("Could not load .env file")
 
 
-def load_apple_health_data(transformed_data, table_name="apple_health_activity_raw"):
+def create_pipeline_tables() -> bool:
+    """Creates the `pipeline_watermarks` and `pipeline_runs` tables, returning True if they exist
+
+    Must run before the stages: concurrent `create table if not exists` statements on a fresh DB race in Postgres, and
+    the loser fails with a duplicate key error instead of skipping the table.
+    """
     try:
         conn = init_db_connection()
-        # Write to Database
-        transformed_data.to_sql(name=table_name, con=conn,
-                                schema="public", if_exists="replace", index_label="id")
+        try:
+            with conn.begin():
+                ensure_watermark_table(conn)
+                ensure_runs_table(conn)
+        finally:
+            conn.close()
+        logger.success("Created the pipeline tables")
+        return True
+    except Exception as e:
+        logger.error(f"Could not create the pipeline tables: {e}")
+        return False
+
+
+def get_table_watermark(table_name: str):
+    """Returns the high watermark of an incrementally loaded table, or None if it was never loaded or the DB is unreachable
+
+    Extract stages use it to only read the rows that are new since the last load.
+    """
+    try:
+        conn = init_db_connection()
+        try:
+            return get_watermark(conn, table_name)
+        finally:
+            conn.close()
+    except Exception as e:
+        logger.error(f"Could not read the watermark of the {table_name} table: {e}")
+        record_stage_error(e)
+
+
+def _add_record_key(data, table_name: str):
+    """Adds the `record_key` of `table_name` to `data`, keeping only the last row of every key"""
+    data = add_record_key(data, RECORD_KEY_COLUMNS[table_name])
+    # A row can only be upserted once per statement
+    return data.drop_duplicates(subset="record_key", keep="last")
+
+
+# Rows per chunk when the rows of an existing table are moved into its managed definition
+MIGRATION_CHUNK_SIZE = 100_000
+
+
+def _migrate_rows(conn, old_table: str, table_name: str, chunk_size: int = MIGRATION_CHUNK_SIZE) -> int:
+    """Upserts the rows of `old_table` into the managed `table_name` in chunks, returning the rows written
+
+    Used by `ensure_table` to migrate a table that was created with another definition. `record_key` is computed again
+    from the key columns, cast to the dtypes of the transformed frames so the keys match the ones later loads compute.
+    """
+    columns = TABLES[table_name]["columns"]
+    staging_table = f"_staging_{table_name}"
+    migrated = 0
+    result = conn.execute(text(f'select * from "{old_table}"').execution_options(
+        stream_results=True, max_row_buffer=chunk_size))
+    for rows in result.partitions(chunk_size):
+        # `DataFrame.to_sql` wrote the index as an "id" column
+        data = pd.DataFrame(rows, columns=list(result.keys())).drop(
+            columns=["id", "record_key"], errors="ignore")
+        for column in RECORD_KEY_COLUMNS[table_name]:
+            data_type = columns.get(column, "")
+            if data_type == "timestamp with time zone":
+                data[column] = pd.to_datetime(data[column], utc=True).astype("datetime64[ns, UTC]")
+            elif data_type == "timestamp":
+                data[column] = pd.to_datetime(data[column]).astype("datetime64[ns]")
+            elif data_type in ("smallint", "integer", "bigint"):
+                data[column] = data[column].astype("Int64")
+        data = _add_record_key(data, table_name)
+
+        prepare_table(conn, table_name, data)
+        write_frame(conn, data, staging_table, if_exists="replace")
+        migrated += upsert_from_staging(conn, staging_table, table_name,
+                                        conflict_columns=TABLES[table_name]["unique"])
+        conn.execute(text(f'drop table public."{staging_table}"'))
+    logger.success(f"Migrated {migrated} rows into the managed {table_name} table")
+    return migrated
+
+
+def write_incremental(conn, data, table_name: str, upsert: bool = True, method: str = "copy") -> int:
+    """Writes only the rows of `data` that are new since the last load of `table_name`
+
+    Rows get a deterministic `record_key` and are inserted through a staging table, so re-loading a row that already
+    exists updates it (or skips it when `upsert` is False) instead of duplicating it. The table's watermark is moved
+    to the newest loaded row afterwards.
+
+    Args:
+        conn (Connection): SQLAlchemy connection object
+        data (pd.DataFrame): The transformed data to load
+        table_name (str): The name of the table to load into
+        upsert (bool, optional): True to overwrite rows that already exist, False to skip them. Defaults to True.
+        method (str, optional): The `write_frame` backend, "copy" or "to_sql". Defaults to "copy".
+
+    Returns:
+        int: The number of rows written
+    """
+    watermark_column = WATERMARK_COLUMNS[table_name]
+    data = _add_record_key(data, table_name)
+
+    with conn.begin():
+        if is_managed(table_name):
+            ensure_table(conn, table_name, migrate=functools.partial(_migrate_rows, table_name=table_name))
+        columns = [column["name"] for column in inspect(conn).get_columns(table_name, schema="public")] \
+            if inspect(conn).has_table(table_name, schema="public") else []
+
+        if "record_key" not in columns:
+            # First incremental load (or the table was last written by a full replace): write everything once
+            logger.info(
+                f"No incremental state found for the {table_name} table, loading all rows")
+            written = write_frame(conn, data, table_name,
+                                  if_exists="replace", method=method)
+            ensure_record_key_index(conn, table_name)
+        else:
+            watermark = get_watermark(conn, table_name)
+            data = filter_since_watermark(data, watermark, watermark_column)
+            conflict_columns = ("record_key",)
+            if is_managed(table_name):
+                prepare_table(conn, table_name, data)
+                conflict_columns = TABLES[table_name]["unique"]
+            staging_table = f"_staging_{table_name}"
+            write_frame(conn, data, staging_table,
+                        if_exists="replace", method=method)
+            written = upsert_from_staging(
+                conn, staging_table, table_name, conflict_columns=conflict_columns, update=upsert)
+            conn.execute(text(f'drop table public."{staging_table}"'))
+
+        if not data.empty:
+            set_watermark(conn, table_name, data[watermark_column].max())
+
+        # Re-aggregate the time buckets that the new rows fall into
+        refresh_rollups(conn, table_name, data)
+
+    return written
+
+
+def _load(transformed_data, table_name: str, mode: str, method: str) -> int:
+    """Writes `transformed_data` to `table_name` with the given load mode and backend, returning the rows written"""
+    conn = init_db_connection()
+    try:
+        if mode == "incremental":
+            return write_incremental(conn, transformed_data, table_name, method=method)
+        with conn.begin():
+            if is_managed(table_name):
+                # Managed tables keep their definition, indexes and partitions, only their rows are replaced
+                transformed_data = _add_record_key(transformed_data, table_name)
+                prepare_table(conn, table_name, transformed_data,
+                              migrate=functools.partial(_migrate_rows, table_name=table_name))
+                conn.execute(text(f'truncate table public."{table_name}"'))
+                written = write_frame(conn, transformed_data, table_name,
+                                      if_exists="append", method=method)
+            else:
+                written = write_frame(conn, transformed_data, table_name,
+                                      if_exists="replace", method=method, index_label="id")
+            refresh_rollups(conn, table_name)
+            # A full replace also moves the watermark, which tells readers (e.g. the query cache) that the data changed
+            watermark_column = WATERMARK_COLUMNS.get(table_name)
+            set_watermark(conn, table_name, transformed_data[watermark_column].max()
+                          if watermark_column in transformed_data else None)
+            return written
+    finally:
         # Close out DB connection
         conn.close()
+
+
+def load_apple_health_data(transformed_data, table_name="apple_health_activity_raw", mode="replace", method="copy"):
+    """Loads transformed Apple Health data into Postgres
+
+    Args:
+        transformed_data (pd.DataFrame): A pandas DataFrame returned from `split_apple_health_data`
+        table_name (str, optional): The name of the table to load into. Defaults to "apple_health_activity_raw".
+        mode (str, optional): "replace" to rewrite the whole table, "incremental" to only write rows that are new since the last load. Defaults to "replace".
+        method (str, optional): "copy" to bulk load with `COPY FROM STDIN`, "to_sql" to use `DataFrame.to_sql`. Defaults to "copy".
+
+    Returns:
+        int: The number of rows written, None if the load failed
+    """
+    try:
+        started_at = time.perf_counter()
+        # Write to Database
+        written = _load(transformed_data, table_name, mode, method)
+        elapsed = time.perf_counter() - started_at
         logger.success(
-            f"Loaded {transformed_data.shape[0]} rows of Apple Health data to DB into the {table_name} table")
-    except:
+            f"Loaded {written} rows of Apple Health data to DB into the {table_name} table ({written / max(elapsed, 1e-9):.0f} rows/sec with {method})")
+        return written
+    except Exception as e:
         logger.error(
-            f"Could not load Apple Health data to DB into the {table_name} table")
+            f"Could not load Apple Health data to DB into the {table_name} table: {e}")
+        record_stage_error(e)
+
 
+def create_apple_health_wide_view(view_name: str = "apple_health_activity_wide", source_table: str = "apple_health_records", metrics: list = None):
+    """Creates a wide view with one column per metric on top of the long `apple_health_records` table
 
-def load_strong_app_data(transformed_data):
+    This gives Metabase the same shape as `apple_health_activity_raw` without ever materializing the sparse pivot.
+
+    Args:
+        view_name (str, optional): The name of the view. Defaults to "apple_health_activity_wide".
+        source_table (str, optional): The long table to pivot. Defaults to "apple_health_records".
+        metrics (list, optional): The metrics to turn into columns. Defaults to None, which uses every metric in `source_table`.
+    """
     try:
         conn = init_db_connection()
-        # Write to Database
-        transformed_data.to_sql(name="strong_app_raw", con=conn,
-                                schema="public", if_exists="replace", index_label="id")
-        # Close out DB connection
+        with conn.begin():
+            if metrics is None:
+                metrics = conn.execute(text(
+                    f'select distinct metric from public."{source_table}" where metric <> \'SleepAnalysis\' order by metric')).scalars().all()
+            metric_columns = "".join(
+                f"\n    , avg(value) filter (where metric = '{metric}') as \"{camel_to_snake(metric)}\"" for metric in metrics)
+            # Columns can't be dropped with `create or replace view`, so recreate the view from scratch
+            conn.execute(text(f'drop view if exists public."{view_name}"'))
+            conn.execute(text(f"""create view public."{view_name}" as
+select
+    end_date
+    , creation_date
+    , start_date
+    , source_name{metric_columns}
+from public."{source_table}"
+where metric <> 'SleepAnalysis'
+group by end_date, creation_date, start_date, source_name"""))
         conn.close()
         logger.success(
-            f"Loaded {transformed_data.shape[0]} rows of Strong App data to DB")
-    except:
-        logger.error("Could not load Strong App data to DB")
+            f"Created the {view_name} view with {len(metrics)} metric columns")
+    except Exception as e:
+        logger.error(f"Could not create the {view_name} view: {e}")
+        record_stage_error(e)
 
 
-# Add a 10 second delay to allow the Metabase backend to start before trying to connect to it
-logger.info("Waiting for Metabase backend to start...")
-for i in range(10):
-    time.sleep(1)
-    i = 11 - i
-    if i % 5 == 0:
-        logger.info(
-            f"Waiting for Metabase backend to start... {i} seconds remaining")
+def load_strong_app_data(transformed_data, mode="replace", method="copy"):
+    """Loads transformed Strong App data into Postgres
+
+    Args:
+        transformed_data (pd.DataFrame): A pandas DataFrame returned from `transform_strong_data`
+        mode (str, optional): "replace" to rewrite the whole table, "incremental" to only write rows that are new since the last load. Defaults to "replace".
+        method (str, optional): "copy" to bulk load with `COPY FROM STDIN`, "to_sql" to use `DataFrame.to_sql`. Defaults to "copy".
+
+    Returns:
+        int: The number of rows written, None if the load failed
+    """
+    try:
+        started_at = time.perf_counter()
+        # Write to Database
+        written = _load(transformed_data, "strong_app_raw", mode, method)
+        elapsed = time.perf_counter() - started_at
+        logger.success(
+            f"Loaded {written} rows of Strong App data to DB ({written / max(elapsed, 1e-9):.0f} rows/sec with {method})")
+        return written
+    except Exception as e:
+        logger.error(f"Could not load Strong App data to DB: {e}")
+        record_stage_error(e)
+
+
+def load_strong_star(transformed_data):
+    """Loads transformed Strong App data into the `dim_exercise`, `dim_workout` and `fact_set` star schema
+
+    Args:
+        transformed_data (pd.DataFrame): A pandas DataFrame returned from `transform_strong_data`
+
+    Returns:
+        int: The number of set rows written, None if the load failed
+    """
+    try:
+        conn = init_db_connection()
+        try:
+            with conn.begin():
+                written = write_strong_star(conn, transformed_data)
+        finally:
+            conn.close()
+        logger.success(f"Loaded {written} Strong App sets to DB into the fact_set table")
+        return written
+    except Exception as e:
+        logger.error(f"Could not load Strong App data into the star schema: {e}")
+        record_stage_error(e)
+
+
+def load_strength(transformed_data):
+    """Updates the per-exercise strength state, rep PRs and estimated one rep maxes with new Strong App sets
+
+    Args:
+        transformed_data (pd.DataFrame): A pandas DataFrame returned from `transform_strong_data`
+
+    Returns:
+        int: The number of rows written, None if the update failed
+    """
+    try:
+        conn = init_db_connection()
+        try:
+            with conn.begin():
+                written = write_strength(conn, transformed_data)
+        finally:
+            conn.close()
+        logger.success(f"Updated the strength tables with {len(transformed_data)} Strong App sets")
+        return written
+    except Exception as e:
+        logger.error(f"Could not update the strength tables: {e}")
+        record_stage_error(e)
@@ -0,0 +1,195 @@
+import re
+
+import pandas as pd
+from loguru import logger
+from sqlalchemy import text
+from sqlalchemy.engine.base import Connection
+
+from datapipelines.instrument import record_stage_error
+
+# Granularities that Metabase's `{{date_granularity}}` variable can select
+GRANULARITIES = ["day", "week", "month", "quarter", "year"]
+
+# The start of a rollup's time bucket, `date_trunc(granularity, time_column)`
+# Date filters on it select whole buckets: a bucket is in a range when its start is. With the Week granularity, a
+# range that ends on a Wednesday includes that whole week, and a range that starts on a Wednesday leaves out the week
+# it starts in. Use the Day granularity for exact dates.
+BUCKET_COLUMN = "bucket_start"
+
+# Pre-aggregated tables behind the Metabase time-series questions
+# Every rollup stores one row per (granularity, `BUCKET_COLUMN`, dimensions).
+# Measures must be re-aggregatable: sums and counts, from which the questions derive averages.
+# "joins" add dimension tables to the source table, so rollups can group on integer keys and still store names.
+# "sources" aggregate the same rollup from other tables, with their own "time_column", "joins" and "measures".
+ROLLUPS = {
+    "apple_activity_rollup": {
+        "source_table": "apple_health_activity_raw",
+        "time_column": "end_date",
+        "dimensions": [],
+        "measures": {
+            "active_energy_burned": "sum(active_energy_burned)",
+            "basal_energy_burned": "sum(basal_energy_burned)",
+        },
+        # `APPLE_STORAGE_MODE=long` loads one row per sample into `apple_health_records` instead
+        "sources": {
+            "apple_health_records": {
+                "measures": {
+                    "active_energy_burned": "sum(value) filter (where metric = 'ActiveEnergyBurned')",
+                    "basal_energy_burned": "sum(value) filter (where metric = 'BasalEnergyBurned')",
+                },
+            },
+        },
+    },
+    "apple_sleep_rollup": {
+        "source_table": "apple_health_sleep_raw",
+        "time_column": "bed_time",
+        "dimensions": [],
+        "measures": {
+            "nights": "count(*)",
+            "total_time_asleep_seconds": "sum(total_time_asleep_seconds)",
+            "time_in_bed_seconds": "sum(time_in_bed_seconds)",
+            "rem_cycles": "sum(rem_cycles)",
+            "core_seconds": "sum(core_seconds)",
+            "deep_seconds": "sum(deep_seconds)",
+            "rem_seconds": "sum(rem_seconds)",
+            "awake_seconds": "sum(awake_seconds)",
+        },
+    },
+    "strong_workout_rollup": {
+        "source_table": "fact_set",
+        "joins": ["join public.dim_workout using (workout_id, created_at)"],
+        "time_column": "created_at",
+        "dimensions": ["workout_name"],
+        "measures": {
+            "number_of_sets": "count(*)",
+            "number_of_workout_days": "count(distinct workout_id)",
+        },
+    },
+    "strong_exercise_rollup": {
+        "source_table": "fact_set",
+        "joins": ["join public.dim_exercise using (exercise_key)"],
+        "time_column": "created_at",
+        "dimensions": ["exercise_name"],
+        "measures": {
+            "number_of_sets": "count(*)",
+        },
+    },
+}
+
+
+# Words of the measure expressions that are not column names
+SQL_WORDS = {"sum", "count", "avg", "min", "max", "distinct", "filter", "where", "and", "or", "not", "is", "null"}
+
+
+def _measure_columns(rollup: dict) -> set:
+    """The columns of the source table that the measures of a rollup read"""
+    # Leave out string literals, e.g. the metric names of `filter (where metric = '...')`
+    expressions = re.sub(r"'[^']*'", "", " ".join(rollup["measures"].values()))
+    return set(re.findall(r"[a-z_][a-z0-9_]*", expressions)) - SQL_WORDS
+
+
+def _rollup_source(rollup: dict, source_table: str) -> dict:
+    """The definition of a rollup that aggregates `source_table`, None if the rollup doesn't read that table"""
+    if source_table == rollup["source_table"]:
+        return rollup
+    if source_table in rollup.get("sources", {}):
+        return dict(rollup, source_table=source_table, **rollup["sources"][source_table])
+    return None
+
+
+def _rollup_select(rollup: dict, since_filter: bool) -> str:
+    """Builds the aggregation query of a rollup for the `:granularity` parameter"""
+    time_column = rollup["time_column"]
+    columns = [f"date_trunc(:granularity, {time_column}) as {BUCKET_COLUMN}"] + rollup["dimensions"] + \
+        [f"{expression} as {name}" for name, expression in rollup["measures"].items()]
+    group_by = ", ".join([str(i) for i in range(2, len(rollup["dimensions"]) + 3)])
+    columns = "\n    , ".join(columns)
+    joins = "".join(f"\n{join}" for join in rollup.get("joins", []))
+    where = f"where {time_column} >= date_trunc(:granularity, cast(:since as timestamp with time zone))" if since_filter else ""
+    return f"""select
+    cast(:granularity as text) as granularity
+    , {columns}
+from public.{rollup["source_table"]}{joins}
+{where}
+group by {group_by}"""
+
+
+def _rollup_columns(rollup: dict) -> list:
+    """The columns of a rollup table, in order"""
+    return ["granularity", BUCKET_COLUMN] + rollup["dimensions"] + list(rollup["measures"])
+
+
+def _drop_outdated_rollup(conn: Connection, name: str, rollup: dict) -> bool:
+    """Drops the rollup table `name` if its columns differ from its definition, returning True if it was dropped"""
+    columns = conn.execute(text("""select column_name from information_schema.columns
+where table_schema = 'public' and table_name = :table_name
+order by ordinal_position"""), {"table_name": name}).scalars().all()
+    if not columns or columns == _rollup_columns(rollup):
+        return False
+    logger.warning(f"Rebuilding the {name} rollup, its definition changed")
+    conn.execute(text(f"drop table public.{name}"))
+    return True
+
+
+def refresh_rollups(conn: Connection, source_table: str, data: pd.DataFrame = None):
+    """Recomputes the rollups of `source_table` for the time buckets touched by `data`
+
+    Only buckets at or after the earliest loaded row are deleted and re-aggregated from the source table, so the cost
+    of a refresh follows the size of the load, not the length of the history. A rollup whose definition changed since
+    its table was created is rebuilt from scratch. Rollups whose measures read columns that the source table doesn't
+    have (e.g. a metric missing from the export) are skipped with a warning.
+
+    Args:
+        conn (Connection): SQLAlchemy connection object, inside the transaction that loaded `source_table`
+        source_table (str): The table that was just loaded
+        data (pd.DataFrame, optional): The rows that were loaded. Defaults to None, which rebuilds the rollups from scratch.
+    """
+    for name, rollup in ROLLUPS.items():
+        rollup = _rollup_source(rollup, source_table)
+        if rollup is None:
+            continue
+
+        time_column = rollup["time_column"]
+        since = None
+        if data is not None:
+            if data.empty:
+                continue
+            since = pd.Timestamp(data[time_column].min())
+            if since.tzinfo is None:
+                since = since.tz_localize("UTC")
+            since = since.to_pydatetime()
+
+        try:
+            # A wide table only has the metrics of the exports it was loaded from
+            missing = _measure_columns(rollup) - set(conn.execute(text("""select column_name from information_schema.columns
+where table_schema = 'public' and table_name = :table_name"""), {"table_name": source_table}).scalars())
+            if missing:
+                logger.warning(
+                    f"Skipping the {name} rollup, the {source_table} table has no {', '.join(sorted(missing))} column")
+                continue
+
+            with conn.begin_nested():
+                if _drop_outdated_rollup(conn, name, rollup):
+                    since = None
+                conn.execute(text(f"""create table if not exists public.{name} as
+{_rollup_select(rollup, since_filter=False)}
+with no data"""), {"granularity": GRANULARITIES[0]})
+                key = ", ".join(["granularity", BUCKET_COLUMN] + rollup["dimensions"])
+                conn.execute(text(
+                    f"create unique index if not exists {name}_key_idx on public.{name} ({key})"))
+
+                for granularity in GRANULARITIES:
+                    params = {"granularity": granularity, "since": since}
+                    if since is None:
+                        conn.execute(
+                            text(f"delete from public.{name} where granularity = :granularity"), params)
+                    else:
+                        conn.execute(text(
+                            f"delete from public.{name} where granularity = :granularity and {BUCKET_COLUMN} >= date_trunc(:granularity, cast(:since as timestamp with time zone))"), params)
+                    conn.execute(text(f"insert into public.{name}\n{_rollup_select(rollup, since_filter=since is not None)}"),
+                                 params)
+            logger.success(
+                f"Refreshed the {name} rollup {'since ' + str(since) if since else 'from scratch'}")
+        except Exception as e:
+            logger.error(f"Could not refresh the {name} rollup: {e}")
+            record_stage_error(e)
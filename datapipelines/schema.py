@@ -0,0 +1,160 @@
+import numpy as np
+import pandas as pd
+
+# Timestamp formats of the exports. Passing them explicitly skips pandas' (very slow) per-row format inference.
+# A trailing `%z` still sends pandas down its per-element path, so `parse_timestamps` parses the offset itself.
+APPLE_HEALTH_DATE_FORMAT = "%Y-%m-%d %H:%M:%S %z"
+STRONG_DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+APPLE_ACTIVITY_SUMMARY_DATE_FORMAT = "%Y-%m-%d"
+
+# Compact dtypes of the Apple Health `Record` attributes
+# "timestamp" columns are parsed with `parse_timestamps`, every other value is a pandas dtype
+APPLE_HEALTH_SCHEMA = {
+    "type": "category",
+    "sourceName": "category",
+    "sourceVersion": "category",
+    "unit": "category",
+    "device": "category",
+    "creationDate": "timestamp",
+    "startDate": "timestamp",
+    "endDate": "timestamp",
+    "value": "float32",
+}
+
+# Compact dtypes of the Apple Health `Workout` attributes
+APPLE_WORKOUT_SCHEMA = {
+    "workoutActivityType": "category",
+    "duration": "float32",
+    "durationUnit": "category",
+    "totalDistance": "float32",
+    "totalDistanceUnit": "category",
+    "totalEnergyBurned": "float32",
+    "totalEnergyBurnedUnit": "category",
+    "sourceName": "category",
+    "sourceVersion": "category",
+    "device": "category",
+    "creationDate": "timestamp",
+    "startDate": "timestamp",
+    "endDate": "timestamp",
+}
+
+# Compact dtypes of the Apple Health `WorkoutStatistics` attributes (plus the start and source of their workout)
+APPLE_WORKOUT_STATISTICS_SCHEMA = {
+    "type": "category",
+    "startDate": "timestamp",
+    "endDate": "timestamp",
+    "sum": "float32",
+    "average": "float32",
+    "minimum": "float32",
+    "maximum": "float32",
+    "unit": "category",
+    "workoutStartDate": "timestamp",
+    "workoutSourceName": "category",
+}
+
+# Compact dtypes of the Apple Health `ActivitySummary` attributes. `dateComponents` uses `APPLE_ACTIVITY_SUMMARY_DATE_FORMAT`.
+APPLE_ACTIVITY_SUMMARY_SCHEMA = {
+    "dateComponents": "timestamp",
+    "activeEnergyBurned": "float32",
+    "activeEnergyBurnedGoal": "float32",
+    "activeEnergyBurnedUnit": "category",
+    "appleMoveTime": "float32",
+    "appleMoveTimeGoal": "float32",
+    "appleExerciseTime": "float32",
+    "appleExerciseTimeGoal": "float32",
+    "appleStandHours": "float32",
+    "appleStandHoursGoal": "float32",
+}
+
+# Compact dtypes of the Strong App CSV columns
+STRONG_SCHEMA = {
+    "Date": "timestamp",
+    "Workout Name": "category",
+    "Duration": "category",
+    "Exercise Name": "category",
+    "Set Order": "Int16",
+    "Weight": "float32",
+    "Reps": "float32",
+    "Distance": "float32",
+    "Seconds": "float32",
+    "Notes": "object",
+    "Workout Notes": "object",
+    "RPE": "float32",
+}
+
+
+def read_csv_dtypes(schema: dict) -> dict:
+    """Returns the `pd.read_csv` dtypes of a schema, so CSV columns are typed while they are parsed
+
+    "timestamp" columns are read as strings: the exports' fixed-width formats compare correctly as strings, and
+    `apply_schema` parses every distinct timestamp once afterwards.
+    """
+    return {column: "object" if dtype == "timestamp" else dtype for column, dtype in schema.items()}
+
+
+def _parse_utc_offset_timestamps(strings: pd.Series, date_format: str) -> pd.DatetimeIndex:
+    """Parses "<local time> ±HHMM" strings into UTC
+
+    The local time is parsed with the vectorized fixed format path, the offset is read from the last 5 characters and
+    subtracted, and the result is localized to UTC.
+    """
+    strings = strings.astype(str)
+    local = pd.to_datetime(strings.str.slice(0, -6), format=date_format, errors="coerce")
+    # the code points of "±HHMM", one row per string
+    chars = strings.str.slice(-5).to_numpy(dtype="U5").view(np.int32).reshape(-1, 5)
+    digits = chars[:, 1:] - ord("0")
+    valid = np.isin(chars[:, 0], [ord("+"), ord("-")]) & ((digits >= 0) & (digits <= 9)).all(axis=1)
+    minutes = (digits[:, 0] * 10 + digits[:, 1]) * 60 + digits[:, 2] * 10 + digits[:, 3]
+    minutes = np.where(chars[:, 0] == ord("-"), -minutes, minutes)
+    utc = local.to_numpy() - minutes.astype("timedelta64[m]")
+    return pd.DatetimeIndex(np.where(valid, utc, np.datetime64("NaT"))).tz_localize("UTC")
+
+
+def parse_timestamps(series: pd.Series, date_format: str, utc: bool = True) -> pd.Series:
+    """Parses timestamps with a fixed format, parsing every distinct string only once
+
+    Exports repeat the same timestamps many times (every sample of a batch shares its `creationDate`), so the column is
+    factorized first and only the unique strings are parsed.
+
+    Args:
+        series (pd.Series): A column of timestamp strings
+        date_format (str): The `strftime` format of the strings
+        utc (bool, optional): True to convert the timestamps to timezone aware UTC. Defaults to True.
+
+    Returns:
+        pd.Series: The parsed timestamps, NaT where a string could not be parsed
+    """
+    if pd.api.types.is_datetime64_any_dtype(series):
+        return series
+    codes, uniques = pd.factorize(series)
+    if utc and date_format.endswith(" %z"):
+        parsed = _parse_utc_offset_timestamps(pd.Series(uniques, dtype=object), date_format[:-3])
+    else:
+        parsed = pd.to_datetime(pd.Index(uniques), format=date_format,
+                                utc=utc, errors="coerce")
+    return pd.Series(parsed.take(codes, allow_fill=True, fill_value=pd.NaT), index=series.index, name=series.name)
+
+
+def apply_schema(data: pd.DataFrame, schema: dict, date_format: str, utc: bool = True) -> pd.DataFrame:
+    """Casts the columns of `data` to the dtypes of a schema from this module
+
+    Args:
+        data (pd.DataFrame): A pandas DataFrame
+        schema (dict): A {column name: dtype} dictionary, e.g. `APPLE_HEALTH_SCHEMA`
+        date_format (str): The format of the "timestamp" columns
+        utc (bool, optional): True to convert "timestamp" columns to timezone aware UTC. Defaults to True.
+
+    Returns:
+        pd.DataFrame: A copy of `data` with typed columns. Columns that are not in the schema are left as they are.
+    """
+    data = data.copy()
+    for column, dtype in schema.items():
+        if column not in data.columns:
+            continue
+        if dtype == "timestamp":
+            data[column] = parse_timestamps(data[column], date_format, utc=utc)
+        elif dtype.startswith(("float", "Int")):
+            data[column] = pd.to_numeric(data[column], errors="coerce").astype(dtype)
+        else:
+            data[column] = data[column].astype(dtype)
+    return data
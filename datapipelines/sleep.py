@@ -0,0 +1,120 @@
+import numpy as np
+import pandas as pd
+from loguru import logger
+
+from datapipelines.instrument import record_stage_error
+from datapipelines.schema import APPLE_HEALTH_DATE_FORMAT, parse_timestamps
+
+SLEEP_TYPE = "HKCategoryTypeIdentifierSleepAnalysis"
+
+# Sleep stage of every `HKCategoryValueSleepAnalysis*` value. Watches before watchOS 9 only record InBed/Asleep.
+SLEEP_STAGES = {
+    "HKCategoryValueSleepAnalysisInBed": "in_bed",
+    "HKCategoryValueSleepAnalysisAwake": "awake",
+    "HKCategoryValueSleepAnalysisAsleep": "asleep_unspecified",
+    "HKCategoryValueSleepAnalysisAsleepUnspecified": "asleep_unspecified",
+    "HKCategoryValueSleepAnalysisAsleepCore": "core",
+    "HKCategoryValueSleepAnalysisAsleepDeep": "deep",
+    "HKCategoryValueSleepAnalysisAsleepREM": "rem",
+}
+ASLEEP_STAGES = ["asleep_unspecified", "core", "deep", "rem"]
+
+# Samples further apart than this belong to different nights
+NIGHT_GAP = pd.Timedelta(hours=4)
+
+
+def _no_nights(stages: list) -> pd.DataFrame:
+    """An empty DataFrame with the columns and dtypes of `sessionize_sleep`, so loading it writes nothing"""
+    timestamp = pd.Series(dtype="datetime64[ns, UTC]")
+    seconds = pd.Series(dtype="float64")
+    return pd.DataFrame({
+        "creation_date": timestamp,
+        "bed_time": timestamp,
+        "awake_time": timestamp,
+        "sleep_counts": pd.Series(dtype="int64"),
+        "rem_cycles": pd.Series(dtype="int64"),
+        **{f"{stage}_seconds": seconds for stage in stages},
+        "total_time_asleep_seconds": seconds,
+        "time_in_bed_seconds": seconds,
+        "restless_time_seconds": seconds,
+    })
+
+
+def sessionize_sleep(data: pd.DataFrame, gap: pd.Timedelta = NIGHT_GAP, source: str = "Watch") -> pd.DataFrame:
+    """Groups sleep samples into nights and computes the time spent in each sleep stage
+
+    Samples are sorted by start time once; a new night starts wherever a sample begins more than `gap` after every
+    earlier sample has ended. All per-night figures are computed with NumPy reductions over the sorted arrays, so there
+    are no per-night Python callbacks and nights no longer depend on the samples sharing a `creationDate`.
+
+    Args:
+        data (pd.DataFrame): A pandas DataFrame returned from `extract_apple_health_data`
+        gap (pd.Timedelta, optional): The minimum time between two nights. Defaults to `NIGHT_GAP`.
+        source (str, optional): Only use samples whose `sourceName` contains this string. Defaults to "Watch".
+
+    Returns:
+        pd.DataFrame: One row per night with bed/awake times, totals in seconds and `<stage>_seconds` columns, None if sessionizing failed
+    """
+    stages = list(dict.fromkeys(SLEEP_STAGES.values()))
+    stage_codes = {value: stages.index(stage)
+                   for value, stage in SLEEP_STAGES.items()}
+
+    try:
+        if data.empty:
+            logger.warning("No sleep samples found")
+            return _no_nights(stages)
+        is_sleep = (data["type"] == SLEEP_TYPE) & data["sourceName"].astype(
+            str).str.contains(source, regex=False)
+        sleep = data.loc[is_sleep, ["startDate", "endDate", "creationDate", "value"]]
+        codes = sleep["value"].astype(str).map(stage_codes)
+        sleep = sleep[codes.notnull()]
+        codes = codes[codes.notnull()].to_numpy(dtype=np.int64)
+
+        if sleep.empty:
+            logger.warning("No sleep samples found")
+            return _no_nights(stages)
+
+        start, end, creation = [parse_timestamps(sleep[column], APPLE_HEALTH_DATE_FORMAT).to_numpy(dtype="datetime64[ns]").view(np.int64)
+                                for column in ["startDate", "endDate", "creationDate"]]
+
+        # Sort every sample by its start time
+        order = np.argsort(start, kind="stable")
+        start, end, creation, codes = start[order], end[order], creation[order], codes[order]
+
+        # A night starts where a sample begins more than `gap` after the latest end seen so far
+        latest_end = np.maximum.accumulate(end)
+        new_night = np.empty(start.shape[0], dtype=bool)
+        new_night[0] = True
+        new_night[1:] = start[1:] - latest_end[:-1] > gap.value
+        night = np.cumsum(new_night) - 1
+        night_starts = np.flatnonzero(new_night)
+        nights = night_starts.shape[0]
+
+        # Seconds per (night, stage) in one weighted bincount
+        durations = (end - start) / 1e9
+        stage_seconds = np.bincount(night * len(stages) + codes, weights=durations,
+                                    minlength=nights * len(stages)).reshape(nights, len(stages))
+
+        sleep_df = pd.DataFrame({
+            "creation_date": pd.to_datetime(np.maximum.reduceat(creation, night_starts), utc=True),
+            "bed_time": pd.to_datetime(start[night_starts], utc=True),
+            "awake_time": pd.to_datetime(np.maximum.reduceat(end, night_starts), utc=True),
+            "sleep_counts": np.diff(np.append(night_starts, start.shape[0])),
+            # every REM sample is one REM period of the night
+            "rem_cycles": np.bincount(night[codes == stages.index("rem")], minlength=nights),
+        })
+        for i, stage in enumerate(stages):
+            sleep_df[f"{stage}_seconds"] = stage_seconds[:, i]
+
+        sleep_df["total_time_asleep_seconds"] = sleep_df[[
+            f"{stage}_seconds" for stage in ASLEEP_STAGES]].sum(axis=1)
+        sleep_df["time_in_bed_seconds"] = (
+            sleep_df["awake_time"] - sleep_df["bed_time"]).dt.total_seconds()
+        sleep_df["restless_time_seconds"] = sleep_df["time_in_bed_seconds"] - \
+            sleep_df["total_time_asleep_seconds"]
+
+        logger.success(f"Sessionized {start.shape[0]} sleep samples into {nights} nights")
+        return sleep_df
+    except Exception as e:
+        logger.error(f"Could not sessionize sleep samples: {e}")
+        record_stage_error(e)
@@ -0,0 +1,122 @@
+import pandas as pd
+from loguru import logger
+from sqlalchemy import text
+from sqlalchemy.engine.base import Connection
+
+from datapipelines.bulk import write_frame
+from datapipelines.incremental import set_watermark, upsert_from_staging
+from datapipelines.rollups import refresh_rollups
+
+# Star schema of the Strong sets: one row per exercise and per workout, and one narrow row per set that only
+# references them by integer key. Every statement is idempotent, so the definitions are applied on every load.
+STAR_DDL = [
+    """create table if not exists public.dim_exercise (
+    exercise_key integer primary key
+    , exercise_name text not null unique
+)""",
+    """create table if not exists public.dim_workout (
+    workout_id integer primary key
+    , created_at timestamp not null
+    , workout_name text not null
+    , duration integer
+    , workout_notes text
+    , unique (created_at, workout_name)
+)""",
+    """create table if not exists public.fact_set (
+    workout_id integer not null references public.dim_workout (workout_id)
+    , exercise_key integer not null references public.dim_exercise (exercise_key)
+    , created_at timestamp not null
+    , set_order smallint not null
+    , weight real
+    , reps real
+    , distance real
+    , seconds real
+    , notes text
+    , r_p_e real
+    , primary key (workout_id, exercise_key, set_order)
+)""",
+    "create index if not exists dim_workout_created_at_idx on public.dim_workout (created_at)",
+    "create index if not exists fact_set_created_at_idx on public.fact_set using brin (created_at)",
+    "create index if not exists fact_set_exercise_key_idx on public.fact_set (exercise_key)",
+]
+
+DIM_WORKOUT_COLUMNS = ["workout_id", "created_at", "workout_name", "duration", "workout_notes"]
+FACT_COLUMNS = ["workout_id", "exercise_key", "created_at", "set_order", "weight", "reps", "distance", "seconds",
+                "notes", "r_p_e"]
+
+
+def assign_surrogate_keys(data: pd.DataFrame, existing: pd.DataFrame, natural_columns: list, key_column: str) -> tuple:
+    """Gives every distinct natural key of `data` a stable integer key
+
+    The natural keys are factorized once. Keys that are already in the dimension keep their integer; new ones are
+    numbered after the dimension's highest key, so keys never change between loads.
+
+    Args:
+        data (pd.DataFrame): The rows to key, e.g. transformed Strong sets
+        existing (pd.DataFrame): The dimension's current `key_column` and `natural_columns`
+        natural_columns (list): The columns that identify a dimension row, e.g. ["exercise_name"]
+        key_column (str): The integer key column of the dimension, e.g. "exercise_key"
+
+    Returns:
+        tuple: The key of every row of `data` (np.ndarray) and the distinct natural keys that are new to the dimension, with their keys (pd.DataFrame)
+    """
+    groups = data.groupby(natural_columns, sort=False, observed=True, dropna=False)
+    codes = groups.ngroup().to_numpy()
+    uniques = groups.size().index.to_frame(index=False)
+
+    # compare plain values, the categoricals of `data` and the dimension's columns have different categories
+    plain = {column: object for column in natural_columns if not pd.api.types.is_datetime64_any_dtype(uniques[column])}
+    uniques = uniques.astype(plain)
+    existing = existing.astype(uniques.dtypes[natural_columns].to_dict())
+    keyed = uniques.merge(existing, on=natural_columns, how="left")
+
+    new = keyed[key_column].isnull().to_numpy()
+    next_key = 1 if existing.empty else int(existing[key_column].max()) + 1
+    keyed.loc[new, key_column] = range(next_key, next_key + new.sum())
+    keys = keyed[key_column].astype("int64").to_numpy()
+    return keys[codes], keyed.loc[new, natural_columns + [key_column]].astype({key_column: "int64"})
+
+
+def write_strong_star(conn: Connection, data: pd.DataFrame) -> int:
+    """Writes transformed Strong sets into the `dim_exercise`, `dim_workout` and `fact_set` tables
+
+    Args:
+        conn (Connection): SQLAlchemy connection object, inside a transaction
+        data (pd.DataFrame): A pandas DataFrame returned from `transform_strong_data`
+
+    Returns:
+        int: The number of set rows inserted or updated
+    """
+    for statement in STAR_DDL:
+        conn.execute(text(statement))
+
+    # The dimensions only have one row per exercise and per workout, so they are read whole
+    exercises = pd.read_sql(text("select exercise_key, exercise_name from public.dim_exercise"), conn)
+    workouts = pd.read_sql(text("select workout_id, created_at, workout_name from public.dim_workout"), conn)
+
+    exercise_keys, new_exercises = assign_surrogate_keys(
+        data, exercises, ["exercise_name"], "exercise_key")
+    workout_ids, new_workouts = assign_surrogate_keys(
+        data, workouts, ["created_at", "workout_name"], "workout_id")
+
+    facts = data.assign(workout_id=workout_ids, exercise_key=exercise_keys)
+    # The workout level columns are the same on every set of a workout
+    new_workouts = new_workouts.merge(
+        facts.drop_duplicates("workout_id")[["workout_id", "duration", "workout_notes"]], on="workout_id")
+    write_frame(conn, new_exercises, "dim_exercise", if_exists="append")
+    write_frame(conn, new_workouts[DIM_WORKOUT_COLUMNS], "dim_workout", if_exists="append")
+
+    facts = facts[FACT_COLUMNS].drop_duplicates(["workout_id", "exercise_key", "set_order"], keep="last")
+    write_frame(conn, facts, "_staging_fact_set", if_exists="replace")
+    written = upsert_from_staging(conn, "_staging_fact_set", "fact_set",
+                                  conflict_columns=("workout_id", "exercise_key", "set_order"))
+    conn.execute(text('drop table public."_staging_fact_set"'))
+
+    # Re-aggregate the time buckets that the new sets fall into
+    refresh_rollups(conn, "fact_set", facts)
+    if not facts.empty:
+        set_watermark(conn, "fact_set", facts["created_at"].max())
+
+    logger.info(
+        f"Added {len(new_exercises)} exercises and {len(new_workouts)} workouts to the Strong star schema")
+    return written
@@ -0,0 +1,186 @@
+import numpy as np
+import pandas as pd
+from loguru import logger
+from sqlalchemy import inspect, text
+from sqlalchemy.engine.base import Connection
+
+from datapipelines.bulk import write_frame
+from datapipelines.incremental import set_watermark, upsert_from_staging
+
+# 5x5: the weight goes up once every set of a session was completed, by more for the lifts that progress faster
+COMPLETED_SETS = 5
+COMPLETED_REPS = 25
+WEIGHT_INCREMENTS = {"Trap Bar Deadlift": 10}
+DEFAULT_WEIGHT_INCREMENT = 5
+
+# Brzycki's formula diverges as reps approach 37, so sets with more reps get no Brzycki estimate
+BRZYCKI_MAX_REPS = 36
+
+# The strength tables and the key they are upserted on
+STRENGTH_TABLES = {
+    # One row per exercise: its last session and the next working set weight
+    "strength_state": ["exercise_name"],
+    # One row per exercise and rep count: the heaviest weight ever lifted for that many reps
+    "strength_rep_prs": ["exercise_name", "reps"],
+    # One row per exercise and session: the best estimated one rep max of the session
+    "strength_e1rm": ["exercise_name", "session_at"],
+}
+
+
+def estimate_one_rep_max(weight: np.ndarray, reps: np.ndarray) -> tuple:
+    """Estimates one rep maxes from sets with the Epley and Brzycki formulas
+
+    Args:
+        weight (np.ndarray): The weight of every set
+        reps (np.ndarray): The reps of every set
+
+    Returns:
+        tuple: The Epley and Brzycki estimates, NaN for sets without reps (and Brzycki for sets above `BRZYCKI_MAX_REPS`)
+    """
+    weight, reps = np.asarray(weight, dtype=np.float64), np.asarray(reps, dtype=np.float64)
+    lifted = reps > 0
+    epley = np.where(lifted, weight * (1 + reps / 30), np.nan)
+    # a single is its own one rep max
+    epley = np.where(reps == 1, weight, epley)
+    brzycki = np.where(lifted & (reps <= BRZYCKI_MAX_REPS), weight * 36 / (37 - np.minimum(reps, BRZYCKI_MAX_REPS)), np.nan)
+    return epley, brzycki
+
+
+def summarize_sessions(data: pd.DataFrame) -> pd.DataFrame:
+    """Aggregates Strong sets into one row per exercise and session (the workout's `created_at`)
+
+    Args:
+        data (pd.DataFrame): A pandas DataFrame returned from `transform_strong_data`
+
+    Returns:
+        pd.DataFrame: `exercise_name`, `session_at`, `number_of_sets`, `number_of_reps`, `working_set_weight` (the lightest set) and the session's best `e1rm_epley` and `e1rm_brzycki`
+    """
+    epley, brzycki = estimate_one_rep_max(data["weight"], data["reps"])
+    sets = pd.DataFrame({
+        "exercise_name": data["exercise_name"].astype(str).to_numpy(),
+        "session_at": data["created_at"].to_numpy(),
+        "weight": data["weight"].to_numpy(dtype=np.float64),
+        "reps": data["reps"].to_numpy(dtype=np.float64),
+        "e1rm_epley": epley,
+        "e1rm_brzycki": brzycki,
+    })
+    return sets.groupby(["exercise_name", "session_at"], as_index=False, sort=False).agg(
+        number_of_sets=("weight", "size"),
+        number_of_reps=("reps", "sum"),
+        working_set_weight=("weight", "min"),
+        e1rm_epley=("e1rm_epley", "max"),
+        e1rm_brzycki=("e1rm_brzycki", "max"),
+    )
+
+
+def update_strength_state(state: pd.DataFrame, sessions: pd.DataFrame) -> pd.DataFrame:
+    """Moves every exercise's state to its latest session
+
+    Args:
+        state (pd.DataFrame): The current `strength_state` rows
+        sessions (pd.DataFrame): New sessions returned from `summarize_sessions`
+
+    Returns:
+        pd.DataFrame: The `strength_state` rows of the exercises in `sessions`
+    """
+    latest = sessions.sort_values("session_at").drop_duplicates("exercise_name", keep="last")
+    latest = latest.rename(columns={"session_at": "last_session_at"})
+    latest["increase_weight"] = (latest["number_of_reps"] >= COMPLETED_REPS) & (latest["number_of_sets"] >= COMPLETED_SETS)
+    increments = latest["exercise_name"].map(WEIGHT_INCREMENTS).fillna(DEFAULT_WEIGHT_INCREMENT)
+    latest["new_working_set_weight"] = latest["working_set_weight"] + increments.where(latest["increase_weight"], 0)
+
+    # a batch of older sessions (e.g. a re-imported export) never moves the state backwards, but can raise the best e1rm
+    best = sessions.groupby("exercise_name")[["e1rm_epley", "e1rm_brzycki"]].max()
+    latest = latest.drop(columns=["e1rm_epley", "e1rm_brzycki"]).join(
+        best.add_prefix("best_"), on="exercise_name")
+    if not state.empty:
+        current = state.set_index("exercise_name")
+        previous = current.reindex(latest["exercise_name"])
+        older = (previous["last_session_at"] > latest["last_session_at"].to_numpy()).to_numpy()
+        for column in ["last_session_at", "number_of_sets", "number_of_reps", "working_set_weight", "increase_weight",
+                       "new_working_set_weight"]:
+            latest[column] = latest[column].where(~older, previous[column].to_numpy())
+        for column in ["best_e1rm_epley", "best_e1rm_brzycki"]:
+            latest[column] = np.fmax(latest[column].to_numpy(dtype=np.float64),
+                                     previous[column].to_numpy(dtype=np.float64))
+    return latest.reset_index(drop=True)
+
+
+def update_rep_prs(prs: pd.DataFrame, data: pd.DataFrame) -> pd.DataFrame:
+    """Finds the rep PRs that new sets set or beat
+
+    Args:
+        prs (pd.DataFrame): The current `strength_rep_prs` rows
+        data (pd.DataFrame): New sets returned from `transform_strong_data`
+
+    Returns:
+        pd.DataFrame: The `strength_rep_prs` rows that are new or heavier than before
+    """
+    sets = pd.DataFrame({
+        "exercise_name": data["exercise_name"].astype(str).to_numpy(),
+        "reps": data["reps"].to_numpy(dtype=np.float64),
+        "weight": data["weight"].to_numpy(dtype=np.float64),
+        "achieved_at": data["created_at"].to_numpy(),
+    })
+    sets = sets[(sets["reps"] > 0) & sets["weight"].notnull()]
+    sets["reps"] = sets["reps"].astype(np.int64)
+    # heaviest first, earliest first among equal weights: the first row of every group is its PR
+    best = sets.sort_values(["weight", "achieved_at"], ascending=[False, True]).drop_duplicates(
+        ["exercise_name", "reps"])
+    if prs.empty:
+        return best.reset_index(drop=True)
+    best = best.merge(prs[["exercise_name", "reps", "weight"]].astype({"reps": np.int64}),
+                      on=["exercise_name", "reps"], how="left", suffixes=("", "_previous"))
+    beaten = best["weight_previous"].isnull() | (best["weight"] > best["weight_previous"])
+    return best.loc[beaten, ["exercise_name", "reps", "weight", "achieved_at"]].reset_index(drop=True)
+
+
+def _read_table(conn: Connection, table_name: str, exercises: list) -> pd.DataFrame:
+    """Reads the rows of a strength table for `exercises`, an empty DataFrame if the table doesn't exist yet"""
+    if not inspect(conn).has_table(table_name, schema="public"):
+        return pd.DataFrame()
+    return pd.read_sql(text(f"select * from public.{table_name} where exercise_name = any(:exercises)"), conn,
+                       params={"exercises": exercises})
+
+
+def _upsert(conn: Connection, data: pd.DataFrame, table_name: str) -> int:
+    """Upserts `data` into a strength table on its key, creating the table on the first load"""
+    key = STRENGTH_TABLES[table_name]
+    if not inspect(conn).has_table(table_name, schema="public"):
+        write_frame(conn, data.head(0), table_name, if_exists="replace")
+        columns = ", ".join(f'"{column}"' for column in key)
+        conn.execute(text(f'alter table public."{table_name}" add primary key ({columns})'))
+    staging_table = f"_staging_{table_name}"
+    write_frame(conn, data, staging_table, if_exists="replace")
+    written = upsert_from_staging(conn, staging_table, table_name, conflict_columns=key)
+    conn.execute(text(f'drop table public."{staging_table}"'))
+    return written
+
+
+def write_strength(conn: Connection, data: pd.DataFrame) -> int:
+    """Updates the `strength_state`, `strength_rep_prs` and `strength_e1rm` tables with new Strong sets
+
+    Only the exercises in `data` are read and written, so the cost of an update follows the size of the load.
+
+    Args:
+        conn (Connection): SQLAlchemy connection object, inside a transaction
+        data (pd.DataFrame): A pandas DataFrame returned from `transform_strong_data`, e.g. only the sets since the last load
+
+    Returns:
+        int: The number of rows inserted or updated across the three tables
+    """
+    if data.empty:
+        return 0
+    sessions = summarize_sessions(data)
+    exercises = sessions["exercise_name"].unique().tolist()
+
+    state = update_strength_state(_read_table(conn, "strength_state", exercises), sessions)
+    prs = update_rep_prs(_read_table(conn, "strength_rep_prs", exercises), data)
+    e1rm = sessions[["exercise_name", "session_at", "e1rm_epley", "e1rm_brzycki"]]
+
+    written = _upsert(conn, state, "strength_state") + _upsert(conn, prs, "strength_rep_prs") + \
+        _upsert(conn, e1rm, "strength_e1rm")
+    set_watermark(conn, "strength_state", sessions["session_at"].max())
+    logger.info(
+        f"Updated the strength state of {len(state)} exercises, {len(prs)} rep PRs and {len(e1rm)} sessions")
+    return written
@@ -1,9 +1,22 @@
 import datetime
 import re
+import time
+import tracemalloc
 
 import pandas as pd
 from loguru import logger
 
+from datapipelines.dedupe import deduplicate_sources
+from datapipelines.instrument import record_stage_error
+from datapipelines.schema import (APPLE_ACTIVITY_SUMMARY_DATE_FORMAT,
+                                  APPLE_ACTIVITY_SUMMARY_SCHEMA,
+                                  APPLE_HEALTH_DATE_FORMAT,
+                                  APPLE_HEALTH_SCHEMA,
+                                  APPLE_WORKOUT_SCHEMA,
+                                  APPLE_WORKOUT_STATISTICS_SCHEMA,
+                                  STRONG_DATE_FORMAT, STRONG_SCHEMA,
+                                  apply_schema)
+
 
 def camel_to_snake(camel_case):
   # Check for an uppercase letter in the string
@@ -22,53 +35,191 @@ def camel_to_snake(camel_case):
     return snake_case
 
 
-def transform_apple_health_data(data: pd.DataFrame) -> pd.DataFrame:
+def _shorten_type(observation_type: str) -> str:
+    """Strips the HealthKit prefix from an observation type"""
+    return observation_type.replace('HKQuantityTypeIdentifier', '').replace('HKCategoryTypeIdentifier', '').replace(
+        'HKDataTypeSleepDurationGoal', 'SleepDurationGoal')
+
+
+def _type_apple_health_records(data: pd.DataFrame) -> pd.DataFrame:
+    """Casts extracted Apple Health records to `APPLE_HEALTH_SCHEMA` and shortens the observation types"""
+    # compact dtypes: categoricals for repeated strings, float32 values and UTC timestamps parsed with a fixed format
+    data = apply_schema(data, APPLE_HEALTH_SCHEMA, APPLE_HEALTH_DATE_FORMAT)
+
+    # some records do not measure anything, just count occurences
+    # filling with 1.0 (= one time) makes it easier to aggregate
+    data['value'] = data['value'].fillna(1.0)
+
+    # shorter observation names: only the categories need to be renamed, not every row
+    data['type'] = data['type'].cat.rename_categories(_shorten_type)
+    return data
+
+
+def transform_apple_health_data(data: pd.DataFrame, typed: bool = True, deduplicate: bool = True) -> pd.DataFrame:
     """Tidies up data to prepare for loading into Postgres
 
     Args:
         df (pd.DataFrame): A pandas DataFrame
+        typed (bool, optional): True to cast columns with `APPLE_HEALTH_SCHEMA`, False to use pandas' type inference. Defaults to True.
+        deduplicate (bool, optional): True to drop the samples that a higher priority source already recorded (see `deduplicate_sources`). Defaults to True.
 
     Returns:
         pd.DataFrame: A modified pandas DataFrame with all column names converted to snake_case
     """
 
     try:
-        # proper type to dates
-        date_cols = ['creationDate', 'startDate', 'endDate']
-        data[date_cols] = data[date_cols].apply(pd.to_datetime)
+        started_at = time.perf_counter()
+        if typed:
+            data = _type_apple_health_records(data)
+        else:
+            data = data.copy()
+
+            # proper type to dates
+            date_cols = ['creationDate', 'startDate', 'endDate']
+            data[date_cols] = data[date_cols].apply(pd.to_datetime)
+
+            # value is numeric, NaN if fails
+            data['value'] = pd.to_numeric(data['value'], errors='coerce')
 
-        # value is numeric, NaN if fails
-        data['value'] = pd.to_numeric(data['value'], errors='coerce')
+            # some records do not measure anything, just count occurences
+            # filling with 1.0 (= one time) makes it easier to aggregate
+            data['value'] = data['value'].fillna(1.0)
 
-        # some records do not measure anything, just count occurences
-        # filling with 1.0 (= one time) makes it easier to aggregate
-        data['value'] = data['value'].fillna(1.0)
+            # shorter observation names: use vectorized replace function
+            data['type'] = data['type'].str.replace('HKQuantityTypeIdentifier', '')
+            data['type'] = data['type'].str.replace('HKCategoryTypeIdentifier', '')
+            data['type'] = data['type'].str.replace(
+                'HKDataTypeSleepDurationGoal', 'SleepDurationGoal')
 
-        # shorter observation names: use vectorized replace function
-        data['type'] = data['type'].str.replace('HKQuantityTypeIdentifier', '')
-        data['type'] = data['type'].str.replace('HKCategoryTypeIdentifier', '')
-        data['type'] = data['type'].str.replace(
-            'HKDataTypeSleepDurationGoal', 'SleepDurationGoal')
+        # steps, distance and energy are recorded by the iPhone and the Watch for the same minutes
+        if deduplicate:
+            data = deduplicate_sources(data)
 
         # pivot and resample. Might want to use index=['endDate', 'creationDate', 'startDate'] instead
         pivot_df = data.pivot_table(
-            index=['endDate', 'creationDate', 'startDate', 'sourceName'], columns='type', values='value')
+            index=['endDate', 'creationDate', 'startDate', 'sourceName'], columns='type', values='value', observed=True)
 
         # Make endDate a column instead of the index
+        pivot_df.columns = pivot_df.columns.astype(str)
         pivot_df.reset_index(inplace=True)
 
         # rename columns
         pivot_df.columns = [camel_to_snake(col) for col in pivot_df.columns]
 
-        logger.success("Transformed Apple Health data")
-        logger.debug(f"Transformed Apple Health dataframe: {pivot_df}")
+        logger.success(
+            f"Transformed Apple Health data in {time.perf_counter() - started_at:.2f}s ({data.memory_usage(deep=True).sum() / 1e6:.1f} MB of {'typed' if typed else 'inferred'} records)")
+        logger.opt(lazy=True).debug("Transformed Apple Health dataframe: {}", lambda: pivot_df)
 
         return pivot_df
     except Exception as e:
         logger.error(f"Could not transform Apple Health data: {e}")
+        record_stage_error(e)
+        return data
+
+
+def compare_apple_health_transforms(data: pd.DataFrame) -> pd.DataFrame:
+    """Runs `transform_apple_health_data` with and without `APPLE_HEALTH_SCHEMA` and reports time and peak memory
+
+    Args:
+        data (pd.DataFrame): A pandas DataFrame returned from `extract_apple_health_data`
+
+    Returns:
+        pd.DataFrame: One row per path with its `seconds` and `peak_memory_mb`
+    """
+    report = []
+    for typed in [False, True]:
+        tracemalloc.start()
+        started_at = time.perf_counter()
+        transform_apple_health_data(data, typed=typed)
+        seconds = time.perf_counter() - started_at
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        report.append({"path": "typed" if typed else "inferred",
+                      "seconds": seconds, "peak_memory_mb": peak / 1e6})
+    report = pd.DataFrame(report)
+    logger.info(f"Apple Health transform comparison:\n{report}")
+    return report
+
+
+def transform_apple_health_data_long(data: pd.DataFrame, deduplicate: bool = True) -> pd.DataFrame:
+    """Tidies up data into a narrow table with one row per sample, instead of pivoting every metric into its own column
+
+    Args:
+        data (pd.DataFrame): A pandas DataFrame returned from `extract_apple_health_data`
+        deduplicate (bool, optional): True to drop the samples that a higher priority source already recorded (see `deduplicate_sources`). Defaults to True.
+
+    Returns:
+        pd.DataFrame: A pandas DataFrame with `metric`, `source_name`, `start_date`, `end_date`, `creation_date`, `value` and `unit` columns
+    """
+
+    try:
+        started_at = time.perf_counter()
+        data = _type_apple_health_records(data)
+        if deduplicate:
+            data = deduplicate_sources(data)
+
+        long_df = data[['type', 'sourceName', 'startDate', 'endDate', 'creationDate', 'value', 'unit']].rename(
+            columns={'type': 'metric'})
+        long_df.columns = [camel_to_snake(col) for col in long_df.columns]
+        long_df.reset_index(drop=True, inplace=True)
+
+        logger.success(
+            f"Transformed Apple Health data to long format in {time.perf_counter() - started_at:.2f}s")
+        logger.opt(lazy=True).debug("Transformed Apple Health dataframe: {}", lambda: long_df)
+
+        return long_df
+    except Exception as e:
+        logger.error(f"Could not transform Apple Health data to long format: {e}")
+        record_stage_error(e)
         return data
 
 
+def _aggregate_sleep(sleep_df: pd.DataFrame) -> pd.DataFrame:
+    """Aggregates Apple Watch sleep samples (`creation_date`, `start_date`, `end_date`) into one row per night"""
+    # calulate time between date(s)
+    sleep_df = sleep_df[['creation_date', 'start_date', 'end_date']].copy()
+    sleep_df['time_asleep'] = sleep_df['end_date'] - sleep_df['start_date']
+    # rem is the number of sleep cycles over 90 minutes (divded by 90 if they were longer than 1 cycle)
+    sleep_df['rem_cycles'] = sleep_df['time_asleep'] // datetime.timedelta(minutes=90)
+
+    # records are grouped by creation date, so lets used that to sum up the values we need here
+    # total time asleep as a sum of the asleep time
+    # awake and bed times are max's and min's
+    # sleep count is the number of times the Apple Watch detected movement
+    sleep_df = sleep_df.groupby('creation_date').agg(total_time_asleep=('time_asleep', 'sum'),
+                                                     bed_time=(
+        'start_date', 'min'),
+        awake_time=(
+        'end_date', 'max'),
+        sleep_counts=(
+        'creation_date', 'count'),
+        rem_cycles=(
+        'rem_cycles', 'sum'))
+
+    # Time in Bed will be different to Apple's reported figure -
+    # as Apple uses the time you place your iPhone down as an additional
+    # datapoint, which of course, is incorrect if you try to maintain
+    # some device separation in the evenings.
+    # For now - we will just use Apple Watch data here
+    sleep_df['time_in_bed'] = sleep_df['awake_time'] - sleep_df['bed_time']
+
+    # Convert to seconds
+    sleep_df['total_time_asleep'] = sleep_df['total_time_asleep'].dt.total_seconds()
+    sleep_df['time_in_bed'] = sleep_df['time_in_bed'].dt.total_seconds()
+
+    # Compute `restless_time`
+    sleep_df['restless_time'] = sleep_df['time_in_bed'] - \
+        sleep_df['total_time_asleep']
+
+    # Rename columns to include _seconds indicating the value is in seconds
+    sleep_df.rename(columns={'total_time_asleep': 'total_time_asleep_seconds',
+                             'time_in_bed': 'time_in_bed_seconds', 'restless_time': 'restless_time_seconds'}, inplace=True)
+
+    # Make creation_date a column instead of the index
+    sleep_df.reset_index(inplace=True)
+    return sleep_df
+
+
 def split_apple_health_data(data: pd.DataFrame) -> pd.DataFrame:
     """Splits Apple Health data into two separate dataframes: one for sleep data and one for everything else
 
@@ -89,60 +240,120 @@ def split_apple_health_data(data: pd.DataFrame) -> pd.DataFrame:
         sleep_df = sleep_df[['creation_date', 'start_date', 'end_date',
                              'sleep_analysis', 'apple_sleeping_wrist_temperature', 'sleep_duration_goal', 'source_name']]
 
-        # calulate time between date(s)
-        sleep_df['time_asleep'] = sleep_df['end_date'] - sleep_df['start_date']
-
-        # records are grouped by creation date, so lets used that to sum up the values we need here
-        # total time asleep as a sum of the asleep time
-        # awake and bed times are max's and min's
-        # sleep count is the number of times the Apple Watch detected movement
-        # rem is the number of sleep cycles over 90 minutes (divded by 90 if they were longer than 1 cycle)
-        sleep_df = sleep_df.groupby('creation_date').agg(total_time_asleep=('time_asleep', 'sum'),
-                                                         bed_time=(
-            'start_date', 'min'),
-            awake_time=(
-            'end_date', 'max'),
-            sleep_counts=(
-            'creation_date', 'count'),
-            rem_cycles=pd.NamedAgg(column='time_asleep', aggfunc=lambda x: (x // datetime.timedelta(minutes=90)).sum()))
-
-        # Time in Bed will be different to Apple's reported figure -
-        # as Apple uses the time you place your iPhone down as an additional
-        # datapoint, which of course, is incorrect if you try to maintain
-        # some device separation in the evenings.
-        # For now - we will just use Apple Watch data here
-        sleep_df['time_in_bed'] = sleep_df['awake_time'] - sleep_df['bed_time']
-
-        # Convert to seconds
-        sleep_df['total_time_asleep'] = sleep_df['total_time_asleep'].dt.total_seconds()
-        sleep_df['time_in_bed'] = sleep_df['time_in_bed'].dt.total_seconds()
-
-        # Compute `restless_time`
-        sleep_df['restless_time'] = sleep_df['time_in_bed'] - \
-            sleep_df['total_time_asleep']
-
-        # Rename columns to include _seconds indicating the value is in seconds
-        sleep_df.rename(columns={'total_time_asleep': 'total_time_asleep_seconds',
-                                 'time_in_bed': 'time_in_bed_seconds', 'restless_time': 'restless_time_seconds'}, inplace=True)
-
-        # Make creation_date a column instead of the index
-        sleep_df.reset_index(inplace=True)
+        sleep_df = _aggregate_sleep(sleep_df)
 
         logger.success("Split Apple Health data")
-        logger.debug(f"Sleep dataframe shape: {sleep_df.shape}")
-        logger.debug(f"Sleep dataframe head: {sleep_df.head()}")
-        logger.debug(f"Sleep dataframe dtypes: {sleep_df.dtypes}")
-        logger.debug(f"Activity dataframe head: {activity_df}")
-        logger.debug(f"Activity dataframe shape: {activity_df.shape}")
-        logger.debug(f"Activity dataframe dtypes: {activity_df.dtypes}")
+        logger.opt(lazy=True).debug("Sleep dataframe shape: {}", lambda: sleep_df.shape)
+        logger.opt(lazy=True).debug("Sleep dataframe head: {}", lambda: sleep_df.head())
+        logger.opt(lazy=True).debug("Sleep dataframe dtypes: {}", lambda: sleep_df.dtypes)
+        logger.opt(lazy=True).debug("Activity dataframe head: {}", lambda: activity_df)
+        logger.opt(lazy=True).debug("Activity dataframe shape: {}", lambda: activity_df.shape)
+        logger.opt(lazy=True).debug("Activity dataframe dtypes: {}", lambda: activity_df.dtypes)
 
         return sleep_df, activity_df
     except Exception as e:
         logger.error(
             f"Could not split Apple Health data into Sleep and Activity Data: {e}")
+        record_stage_error(e)
         return None, None
 
 
+def split_apple_health_records(data: pd.DataFrame) -> pd.DataFrame:
+    """Splits long Apple Health records into nightly sleep data and all other samples
+
+    Args:
+        data (pd.DataFrame): A pandas DataFrame returned from `transform_apple_health_data_long`
+
+    Returns:
+        pd.DataFrame, pd.DataFrame: Two pandas DataFrames: one for sleep data and one with all other samples (still in long format)
+    """
+
+    try:
+        is_sleep = data["metric"] == "SleepAnalysis"
+        sleep_df = _aggregate_sleep(data[is_sleep & data["source_name"].str.contains("Watch", regex=False)])
+        activity_df = data[~is_sleep]
+
+        logger.success("Split Apple Health records")
+        logger.opt(lazy=True).debug("Sleep dataframe shape: {}", lambda: sleep_df.shape)
+        logger.opt(lazy=True).debug("Activity dataframe shape: {}", lambda: activity_df.shape)
+
+        return sleep_df, activity_df
+    except Exception as e:
+        logger.error(
+            f"Could not split Apple Health records into Sleep and Activity Data: {e}")
+        record_stage_error(e)
+        return None, None
+
+
+def transform_apple_workouts(workouts: pd.DataFrame, statistics: pd.DataFrame = None) -> pd.DataFrame:
+    """Tidies up Apple Health workouts and adds their statistics as columns
+
+    Args:
+        workouts (pd.DataFrame): The "workouts" stream returned from `extract_apple_health_export`
+        statistics (pd.DataFrame, optional): The "workout_statistics" stream returned from `extract_apple_health_export`. Defaults to None.
+
+    Returns:
+        pd.DataFrame: One row per workout with snake_case columns, plus a `<statistic>_<sum|average|minimum|maximum>` column per statistic
+    """
+    try:
+        if workouts.empty:
+            # An export without workouts still loads an (empty) table with the workout columns
+            workouts = pd.DataFrame(columns=list(APPLE_WORKOUT_SCHEMA))
+        data = apply_schema(workouts, APPLE_WORKOUT_SCHEMA, APPLE_HEALTH_DATE_FORMAT)
+        data['workoutActivityType'] = data['workoutActivityType'].cat.rename_categories(
+            lambda activity_type: activity_type.replace('HKWorkoutActivityType', ''))
+
+        if statistics is not None and not statistics.empty:
+            statistics = apply_schema(statistics, APPLE_WORKOUT_STATISTICS_SCHEMA, APPLE_HEALTH_DATE_FORMAT)
+            statistics['type'] = statistics['type'].cat.rename_categories(_shorten_type)
+            measures = [measure for measure in ['sum', 'average', 'minimum', 'maximum']
+                        if measure in statistics.columns]
+            # one column per (statistic, measure) that any workout has
+            statistics = statistics.pivot_table(index=['workoutStartDate', 'workoutSourceName'], columns='type',
+                                                values=measures, observed=True).dropna(axis=1, how='all')
+            statistics.columns = [f"{camel_to_snake(statistic)}_{measure}" for measure, statistic in statistics.columns]
+            statistics = statistics.reset_index().rename(
+                columns={'workoutStartDate': 'startDate', 'workoutSourceName': 'sourceName'})
+            # join on the plain source names, the two categoricals have different categories
+            statistics['sourceName'] = statistics['sourceName'].astype(str)
+            data['sourceName'] = data['sourceName'].astype(str)
+            data = data.merge(statistics, on=['startDate', 'sourceName'], how='left')
+
+        data.columns = [camel_to_snake(col) for col in data.columns]
+
+        logger.success(f"Transformed {len(data)} Apple Health workouts")
+        logger.opt(lazy=True).debug("Workouts dataframe dtypes: {}", lambda: data.dtypes)
+        return data
+    except Exception as e:
+        logger.error(f"Could not transform Apple Health workouts: {e}")
+        record_stage_error(e)
+        return workouts
+
+
+def transform_apple_activity_summaries(data: pd.DataFrame) -> pd.DataFrame:
+    """Tidies up Apple Health activity summaries (the daily activity rings)
+
+    Args:
+        data (pd.DataFrame): The "activity_summaries" stream returned from `extract_apple_health_export`
+
+    Returns:
+        pd.DataFrame: One row per day with snake_case columns
+    """
+    try:
+        if data.empty:
+            data = pd.DataFrame(columns=list(APPLE_ACTIVITY_SUMMARY_SCHEMA))
+        data = apply_schema(data, APPLE_ACTIVITY_SUMMARY_SCHEMA, APPLE_ACTIVITY_SUMMARY_DATE_FORMAT)
+        data.columns = [camel_to_snake(col) for col in data.columns]
+
+        logger.success(f"Transformed {len(data)} Apple Health activity summaries")
+        logger.opt(lazy=True).debug("Activity summaries dataframe dtypes: {}", lambda: data.dtypes)
+        return data
+    except Exception as e:
+        logger.error(f"Could not transform Apple Health activity summaries: {e}")
+        record_stage_error(e)
+        return data
+
+
 def transform_strong_data(data: pd.DataFrame) -> pd.DataFrame:
     """Tidies up data to prepare for loading into Postgres
 
@@ -154,28 +365,32 @@ def transform_strong_data(data: pd.DataFrame) -> pd.DataFrame:
     """
 
     try:
-        # proper type to dates
-        for col in ['Date']:
-            data[col] = pd.to_datetime(data[col])
+        # compact dtypes and dates parsed with a fixed format
+        data = apply_schema(data, STRONG_SCHEMA, STRONG_DATE_FORMAT, utc=False)
 
-        # Convert Duration to seconds
-        data['Duration'] = pd.to_timedelta(
-            data['Duration']).dt.total_seconds().astype(int)
+        # Convert Duration to seconds. Only the distinct durations (one per workout) need to be parsed.
+        durations = data['Duration'].cat.categories
+        data['Duration'] = data['Duration'].map(
+            dict(zip(durations, pd.to_timedelta(durations).total_seconds()))).astype(int)
 
         # rename columns
         data.columns = [camel_to_snake(col) for col in data.columns]
         data.rename(columns={'date': 'created_at'}, inplace=True)
 
-        # Add a column for workout_id. workout_id is the concatenation of the `date` and `workout_name` columns
-        data['workout_id'] = data['created_at'].astype(
-            str) + "_" + data['workout_name'].astype(str)
+        # Add a column for workout_id. workout_id is the concatenation of the `date` and `workout_name` columns,
+        # built once per workout instead of once per set
+        workouts = data.groupby(['created_at', 'workout_name'], sort=False, observed=True, dropna=False)
+        data['workout_id'] = pd.Categorical.from_codes(
+            workouts.ngroup().to_numpy(),
+            categories=[f"{created_at}_{workout_name}" for created_at, workout_name in workouts.size().index])
 
         logger.success("Transformed Strong data")
-        logger.debug(f"Strong dataframe shape: {data.shape}")
-        logger.debug(f"Strong dataframe head: {data.head()}")
-        logger.debug(f"Strong dataframe dtypes: {data.dtypes}")
+        logger.opt(lazy=True).debug("Strong dataframe shape: {}", lambda: data.shape)
+        logger.opt(lazy=True).debug("Strong dataframe head: {}", lambda: data.head())
+        logger.opt(lazy=True).debug("Strong dataframe dtypes: {}", lambda: data.dtypes)
 
         return data
     except Exception as e:
         logger.error(f"Could not transform Strong data: {e}")
+        record_stage_error(e)
         return data
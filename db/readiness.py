@@ -0,0 +1,106 @@
+import json
+import os
+import time
+import urllib.request
+
+from loguru import logger
+from sqlalchemy import text
+
+from db.utils import get_engine
+
+# Have to use the container name as the host name because that is the name of the service in the docker-compose.yml file
+METABASE_URL = os.getenv("METABASE_URL", "http://metabase:3000/")
+
+# Seconds to wait for a dependency before giving up
+READINESS_TIMEOUT = float(os.getenv("READINESS_TIMEOUT", 300))
+# The admin account is created by hand through the Metabase UI, so allow more time for it
+METABASE_SETUP_TIMEOUT = float(os.getenv("METABASE_SETUP_TIMEOUT", 1800))
+
+
+def wait_for(check, name: str, timeout: float = READINESS_TIMEOUT, initial_delay: float = 0.5, max_delay: float = 15.0) -> bool:
+    """Polls `check` with exponential backoff until it succeeds or `timeout` seconds have passed
+
+    Returns as soon as the dependency is ready, so startup waits as long as the dependency needs and no longer.
+
+    Args:
+        check (callable): Takes no arguments and returns a truthy value once the dependency is ready. Exceptions count as not ready.
+        name (str): The name of the dependency, for logging
+        timeout (float, optional): The overall deadline in seconds. Defaults to `READINESS_TIMEOUT`.
+        initial_delay (float, optional): Seconds before the second attempt, doubled after every failed attempt. Defaults to 0.5.
+        max_delay (float, optional): The longest delay between two attempts. Defaults to 15.0.
+
+    Returns:
+        bool: True if the dependency became ready before the deadline
+    """
+    started_at = time.monotonic()
+    deadline = started_at + timeout
+    delay = initial_delay
+    attempts = 0
+    while True:
+        attempts += 1
+        try:
+            if check():
+                logger.success(
+                    f"{name} is ready after {time.monotonic() - started_at:.1f} seconds ({attempts} attempts)")
+                return True
+            reason = "not ready"
+        except Exception as e:
+            reason = str(e)
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            logger.error(
+                f"{name} was not ready after {timeout:.0f} seconds: {reason}")
+            return False
+        logger.info(
+            f"Waiting for {name} ({reason}), retrying in {min(delay, remaining):.1f} seconds")
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, max_delay)
+
+
+def _get_json(url: str) -> dict:
+    with urllib.request.urlopen(url, timeout=5) as response:
+        return json.loads(response.read())
+
+
+def postgres_ready() -> bool:
+    """True once the pipeline's PostgreSQL DB accepts queries"""
+    with get_engine("db").connect() as conn:
+        return conn.execute(text("select 1")).scalar() == 1
+
+
+def metabase_db_ready() -> bool:
+    """True once the Metabase backend DB accepts queries"""
+    with get_engine("metabase").connect() as conn:
+        return conn.execute(text("select 1")).scalar() == 1
+
+
+def metabase_http_ready(url: str = METABASE_URL) -> bool:
+    """True once Metabase reports itself healthy on `/api/health`"""
+    return _get_json(url.rstrip("/") + "/api/health").get("status") == "ok"
+
+
+def metabase_setup_complete(url: str = METABASE_URL) -> bool:
+    """True once the Metabase admin account has been created"""
+    return bool(_get_json(url.rstrip("/") + "/api/session/properties").get("has-user-setup"))
+
+
+def wait_for_postgres(timeout: float = READINESS_TIMEOUT) -> bool:
+    """Waits for the pipeline's PostgreSQL DB, returning True if it is ready to use"""
+    return wait_for(postgres_ready, "PostgreSQL", timeout)
+
+
+def wait_for_metabase(url: str = METABASE_URL, timeout: float = READINESS_TIMEOUT, setup_timeout: float = METABASE_SETUP_TIMEOUT) -> bool:
+    """Waits for the Metabase backend DB, the Metabase server and the creation of its admin account, in that order
+
+    Args:
+        url (str, optional): The Metabase base URL. Defaults to `METABASE_URL`.
+        timeout (float, optional): The deadline of the backend DB and the server. Defaults to `READINESS_TIMEOUT`.
+        setup_timeout (float, optional): The deadline of the admin account creation. Defaults to `METABASE_SETUP_TIMEOUT`.
+
+    Returns:
+        bool: True if Metabase is ready to use
+    """
+    return wait_for(metabase_db_ready, "Metabase backend DB", timeout) \
+        and wait_for(lambda: metabase_http_ready(url), "Metabase", timeout) \
+        and wait_for(lambda: metabase_setup_complete(url), "Metabase admin account", setup_timeout, max_delay=30.0)
@@ -0,0 +1,250 @@
+import pandas as pd
+from loguru import logger
+from sqlalchemy import text
+from sqlalchemy.engine.base import Connection
+
+def _downsampled_table() -> dict:
+    """The definition of a table of downsampled metrics (see `datapipelines.downsample`), one row per metric and bucket"""
+    return {
+        "columns": {
+            "metric": "text",
+            "start_date": "timestamp with time zone",
+            "min_value": "real",
+            "max_value": "real",
+            "mean_value": "real",
+            "sum_value": "double precision",
+            "sample_count": "integer",
+            "record_key": "bigint not null",
+        },
+        "extra_column_type": "double precision",
+        "partition_column": "start_date",
+        "unique": ["record_key", "start_date"],
+        "indexes": [("btree", ["metric", "start_date"])],
+    }
+
+
+# Managed definitions of the tables the pipeline loads into
+#   columns: explicit column types. Frame columns that are not listed (e.g. newly seen Apple Health metrics) are added with `extra_column_type`.
+#   partition_column: the table is range partitioned by month on this column
+#   unique: the key incremental loads upsert on. Postgres requires it to include the partition column.
+#   indexes: (method, columns) tuples, created on the partitioned table and inherited by every partition
+TABLES = {
+    "apple_health_activity_raw": {
+        "columns": {
+            "end_date": "timestamp with time zone",
+            "creation_date": "timestamp with time zone",
+            "start_date": "timestamp with time zone",
+            "source_name": "text",
+            "record_key": "bigint not null",
+        },
+        "extra_column_type": "real",
+        "partition_column": "end_date",
+        "unique": ["record_key", "end_date"],
+        "indexes": [("brin", ["end_date"]), ("btree", ["start_date"])],
+    },
+    "apple_health_records": {
+        "columns": {
+            "metric": "text",
+            "source_name": "text",
+            "start_date": "timestamp with time zone",
+            "end_date": "timestamp with time zone",
+            "creation_date": "timestamp with time zone",
+            "value": "real",
+            "unit": "text",
+            "record_key": "bigint not null",
+        },
+        "extra_column_type": "text",
+        "partition_column": "start_date",
+        "unique": ["record_key", "start_date"],
+        "indexes": [("brin", ["start_date"]), ("btree", ["metric", "start_date"])],
+    },
+    "apple_health_sleep_raw": {
+        "columns": {
+            "creation_date": "timestamp with time zone",
+            "bed_time": "timestamp with time zone",
+            "awake_time": "timestamp with time zone",
+            "sleep_counts": "integer",
+            "rem_cycles": "integer",
+            "total_time_asleep_seconds": "double precision",
+            "time_in_bed_seconds": "double precision",
+            "restless_time_seconds": "double precision",
+            "record_key": "bigint not null",
+        },
+        "extra_column_type": "double precision",
+        "partition_column": "bed_time",
+        "unique": ["record_key", "bed_time"],
+        "indexes": [("btree", ["bed_time"])],
+    },
+    "apple_health_workouts": {
+        "columns": {
+            "workout_activity_type": "text",
+            "duration": "real",
+            "duration_unit": "text",
+            "total_distance": "real",
+            "total_distance_unit": "text",
+            "total_energy_burned": "real",
+            "total_energy_burned_unit": "text",
+            "source_name": "text",
+            "source_version": "text",
+            "device": "text",
+            "creation_date": "timestamp with time zone",
+            "start_date": "timestamp with time zone",
+            "end_date": "timestamp with time zone",
+            "record_key": "bigint not null",
+        },
+        "extra_column_type": "double precision",
+        "partition_column": "start_date",
+        "unique": ["record_key", "start_date"],
+        "indexes": [("brin", ["start_date"]), ("btree", ["workout_activity_type"])],
+    },
+    "apple_health_activity_summaries": {
+        "columns": {
+            "date_components": "timestamp with time zone",
+            "active_energy_burned": "real",
+            "active_energy_burned_goal": "real",
+            "active_energy_burned_unit": "text",
+            "apple_move_time": "real",
+            "apple_move_time_goal": "real",
+            "apple_exercise_time": "real",
+            "apple_exercise_time_goal": "real",
+            "apple_stand_hours": "real",
+            "apple_stand_hours_goal": "real",
+            "record_key": "bigint not null",
+        },
+        "extra_column_type": "text",
+        "partition_column": "date_components",
+        "unique": ["record_key", "date_components"],
+        "indexes": [("btree", ["date_components"])],
+    },
+    "apple_health_metrics_minute": _downsampled_table(),
+    "apple_health_metrics_hour": _downsampled_table(),
+    "apple_health_metrics_day": _downsampled_table(),
+    "strong_app_raw": {
+        "columns": {
+            "created_at": "timestamp",
+            "workout_name": "text",
+            "duration": "integer",
+            "exercise_name": "text",
+            "set_order": "smallint",
+            "weight": "real",
+            "reps": "real",
+            "distance": "real",
+            "seconds": "real",
+            "notes": "text",
+            "workout_notes": "text",
+            "r_p_e": "real",
+            "workout_id": "text",
+            "record_key": "bigint not null",
+        },
+        "extra_column_type": "text",
+        "partition_column": "created_at",
+        "unique": ["record_key", "created_at"],
+        "indexes": [("brin", ["created_at"]), ("btree", ["workout_name"]), ("btree", ["exercise_name"])],
+    },
+}
+
+
+def is_managed(table_name: str) -> bool:
+    """True if `table_name` has a managed definition in `TABLES`"""
+    return table_name in TABLES
+
+
+def ensure_table(conn: Connection, table_name: str, migrate=None):
+    """Creates a managed table with its default partition and indexes, unless it already exists
+
+    A table of the same name that was created by `DataFrame.to_sql` (not partitioned) or that is partitioned on another
+    column than its definition is migrated: its rows are copied to a temporary table, the old table is replaced by the
+    managed one and `migrate` moves the rows back, all in the caller's transaction. Tables that views depend on are
+    never replaced.
+
+    Args:
+        conn (Connection): SQLAlchemy connection object
+        table_name (str): A table from `TABLES`
+        migrate (callable, optional): Takes `conn` and the name of the temporary table, and writes its rows to the
+            managed table. Defaults to None, which refuses to replace an existing table.
+
+    Raises:
+        RuntimeError: If the existing table has to be replaced but can't be migrated
+    """
+    table = TABLES[table_name]
+    existing = conn.execute(text("""select c.relkind = 'p', pg_get_partkeydef(c.oid)
+from pg_class c join pg_namespace n on n.oid = c.relnamespace
+where n.nspname = 'public' and c.relname = :table_name"""), {"table_name": table_name}).first()
+    partition_keys = {f'RANGE ({table["partition_column"]})', f'RANGE ("{table["partition_column"]}")'}
+
+    old_table = None
+    if existing is not None and (not existing[0] or existing[1] not in partition_keys):
+        if migrate is None:
+            raise RuntimeError(
+                f"The {table_name} table is not partitioned by {table['partition_column']} and no migration was given")
+        views = conn.execute(text("""select distinct v.relname
+from pg_depend d
+join pg_rewrite r on r.oid = d.objid
+join pg_class v on v.oid = r.ev_class
+where d.refobjid = cast(:table_name as regclass) and v.oid <> d.refobjid"""), {"table_name": f'public."{table_name}"'}).scalars().all()
+        if views:
+            raise RuntimeError(
+                f"The {table_name} table can't be migrated to its managed definition, views depend on it: {', '.join(views)}")
+
+        logger.warning(
+            f"Migrating the {table_name} table to its managed definition, partitioned by {table['partition_column']}")
+        old_table = f"_migrate_{table_name}"
+        conn.execute(text(
+            f'create temporary table "{old_table}" on commit drop as select * from public."{table_name}"'))
+        conn.execute(text(f'drop table public."{table_name}"'))
+
+    columns = ", ".join(f'"{column}" {data_type}' for column,
+                        data_type in table["columns"].items())
+    unique = ", ".join(f'"{column}"' for column in table["unique"])
+    conn.execute(text(f"""create table if not exists public."{table_name}" (
+    {columns}
+    , unique ({unique})
+) partition by range ("{table["partition_column"]}")"""))
+    # Rows outside of every monthly partition (e.g. a NULL partition column) land here
+    conn.execute(text(
+        f'create table if not exists public."{table_name}_default" partition of public."{table_name}" default'))
+
+    for method, index_columns in table["indexes"]:
+        index_name = f"{table_name}_{'_'.join(index_columns)}_{method}_idx"
+        index_columns = ", ".join(f'"{column}"' for column in index_columns)
+        conn.execute(text(
+            f'create index if not exists "{index_name}" on public."{table_name}" using {method} ({index_columns})'))
+
+    if old_table is not None:
+        migrate(conn, old_table)
+
+
+def ensure_columns(conn: Connection, table_name: str, columns: list):
+    """Adds the `columns` that a managed table does not have yet, with its `extra_column_type`"""
+    existing = set(conn.execute(text("""select column_name from information_schema.columns
+where table_schema = 'public' and table_name = :table_name"""), {"table_name": table_name}).scalars())
+    for column in columns:
+        if column not in existing:
+            conn.execute(text(
+                f'alter table public."{table_name}" add column if not exists "{column}" {TABLES[table_name]["extra_column_type"]}'))
+            logger.info(f"Added column {column} to the {table_name} table")
+
+
+def ensure_partitions(conn: Connection, table_name: str, start, end):
+    """Creates the monthly partitions of a managed table that cover `start` through `end`"""
+    if pd.isnull(start) or pd.isnull(end):
+        return
+    start, end = pd.Timestamp(start), pd.Timestamp(end)
+    if start.tzinfo is not None:
+        start, end = start.tz_convert("UTC").tz_localize(None), end.tz_convert("UTC").tz_localize(None)
+
+    for month in pd.period_range(start, end, freq="M"):
+        lower = month.start_time.strftime("%Y-%m-%d")
+        upper = (month + 1).start_time.strftime("%Y-%m-%d")
+        conn.execute(text(f"""create table if not exists public."{table_name}_p{month.strftime('%Y_%m')}"
+partition of public."{table_name}" for values from ('{lower} 00:00:00+00') to ('{upper} 00:00:00+00')"""))
+
+
+def prepare_table(conn: Connection, table_name: str, data: pd.DataFrame, migrate=None):
+    """Makes sure a managed table, its columns and its partitions can take the rows of `data`, see `ensure_table` for `migrate`"""
+    ensure_table(conn, table_name, migrate=migrate)
+    ensure_columns(conn, table_name, data.columns)
+    partition_column = TABLES[table_name]["partition_column"]
+    if not data.empty:
+        ensure_partitions(conn, table_name, data[partition_column].min(),
+                          data[partition_column].max())
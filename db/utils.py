@@ -1,32 +1,109 @@
 import os
+import threading
 
 from loguru import logger
 from sqlalchemy import create_engine
+from sqlalchemy.engine import Engine
 from sqlalchemy.engine.base import Connection
 
+# Connection pool settings shared by every engine in the registry
+#   DB_POOL_SIZE: connections kept open per engine
+#   DB_MAX_OVERFLOW: extra connections opened when the pool is exhausted, closed again once returned
+#   DB_POOL_RECYCLE: seconds after which a pooled connection is replaced, so idle connections outlive no server timeout
+#   DB_POOL_PRE_PING: "1" to test a pooled connection before handing it out, so a restarted DB doesn't fail the next load
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 5))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 10))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", 1800))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "1") == "1"
+
+# One engine (and connection pool) per database for the whole process
+_engines = {}
+_engines_lock = threading.Lock()
+
+
+def _db_url() -> str:
+    # Have to use 'db' as the host name because that is the name of the service in the docker-compose.yml file
+    # POSTGRES_HOST overrides it outside of docker-compose, e.g. to benchmark against a local Postgres
+    return f"postgresql://{os.getenv('POSTGRES_USER')}:{os.getenv('POSTGRES_PASSWORD')}@{os.getenv('POSTGRES_HOST', 'db')}:{os.getenv('POSTGRES_PORT')}/{os.getenv('POSTGRES_DB')}"
+
+
+def _metabase_db_url() -> str:
+    return f"postgresql://{os.getenv('MB_DB_USER')}:{os.getenv('MB_DB_PASS')}@{os.getenv('MB_DB_HOST')}:{os.getenv('MB_DB_PORT')}/{os.getenv('MB_DB_DBNAME')}"
+
+
+def get_engine(name: str = "db", url: str = None) -> Engine:
+    """Returns the process-wide engine registered under `name`, creating it on first use
+
+    Every caller of the same `name` shares one connection pool, so opening a connection reuses an idle pooled one
+    instead of paying a new TCP and authentication handshake. Safe to call from parallel pipeline stages.
+
+    Args:
+        name (str, optional): "db" for the pipeline DB, "metabase" for the Metabase backend DB or any other registry key. Defaults to "db".
+        url (str, optional): The database URL, only needed for names other than "db" and "metabase". Defaults to None.
+
+    Returns:
+        `sqlalchemy.engine.Engine`: The shared SQLAlchemy engine
+    """
+    with _engines_lock:
+        if name not in _engines:
+            if url is None:
+                url = {"db": _db_url, "metabase": _metabase_db_url}[name]()
+            _engines[name] = create_engine(url,
+                                           pool_size=DB_POOL_SIZE,
+                                           max_overflow=DB_MAX_OVERFLOW,
+                                           pool_recycle=DB_POOL_RECYCLE,
+                                           pool_pre_ping=DB_POOL_PRE_PING)
+            logger.info(
+                f"Created the {name} engine (pool size {DB_POOL_SIZE}, max overflow {DB_MAX_OVERFLOW})")
+        return _engines[name]
+
+
+def pool_status() -> dict:
+    """Reports the connection pool usage of every engine in the registry
+
+    Returns:
+        dict: Per engine name, the pool size and the number of checked in, checked out and overflow connections
+    """
+    with _engines_lock:
+        engines = dict(_engines)
+    return {name: {
+        "size": engine.pool.size(),
+        "checked_in": engine.pool.checkedin(),
+        "checked_out": engine.pool.checkedout(),
+        "overflow": engine.pool.overflow(),
+    } for name, engine in engines.items()}
+
+
+def dispose_engines():
+    """Closes every pooled connection and empties the registry, e.g. before exiting or after forking a process"""
+    with _engines_lock:
+        for name, engine in _engines.items():
+            engine.dispose()
+            logger.info(f"Disposed the {name} engine")
+        _engines.clear()
+
 
 def init_db_connection() -> Connection:
-    """Creates a SQLAlchemy connection object used to interact with a PostgreSQL DB
+    """Checks out a SQLAlchemy connection from the shared pool of the PostgreSQL DB
+
+    Closing the connection returns it to the pool.
 
     Returns:
         `sqlalchemy.engine.base.Connection`: SQLAlchemy connection object
     """
-    # Have to use 'db' as the host name because that is the name of the service in the docker-compose.yml file
-    url = f"postgresql://{os.getenv('POSTGRES_USER')}:{os.getenv('POSTGRES_PASSWORD')}@db:{os.getenv('POSTGRES_PORT')}/{os.getenv('POSTGRES_DB')}"
     try:
-        engine = create_engine(url)
-        conn = engine.connect()
+        conn = get_engine("db").connect()
         return conn
     except Exception as e:
         logger.error(f"Could not connect to DB: {str(e)}")
 
 def init_metabase_db_connection() -> Connection:
-    """Creates a SQLAlchemy connection object used to interact a postgres DB
+    """Checks out a SQLAlchemy connection from the shared pool of the Metabase backend postgres DB
+
+    Closing the connection returns it to the pool.
 
     Returns:
         `sqlalchemy.engine.base.Connection`: SQLAlchemy connection object
     """
-    engine = create_engine(
-        url=f"postgresql://{os.getenv('MB_DB_USER')}:{os.getenv('MB_DB_PASS')}@{os.getenv('MB_DB_HOST')}:{os.getenv('MB_DB_PORT')}/{os.getenv('MB_DB_DBNAME')}")
-    conn = engine.connect()
-    return conn
\ No newline at end of file
+    conn = get_engine("metabase").connect()
+    return conn
@@ -1,30 +1,177 @@
-import time
+import os
+import sys
 
 from loguru import logger
 
-from datapipelines.extract import (extract_apple_health_data,
+from datapipelines.dag import Stage, run_pipeline
+from datapipelines.downsample import (DOWNSAMPLE_TABLES,
+                                      downsample_apple_health_data)
+from datapipelines.extract import (extract_apple_health_export,
                                    extract_strong_app_data)
-from datapipelines.load import load_apple_health_data, load_strong_app_data
+from datapipelines.load import (create_apple_health_wide_view,
+                                create_pipeline_tables, get_table_watermark,
+                                load_apple_health_data, load_env,
+                                load_strength, load_strong_app_data,
+                                load_strong_star)
+from datapipelines.sleep import sessionize_sleep
 from datapipelines.transform import (split_apple_health_data,
+                                     split_apple_health_records,
+                                     transform_apple_activity_summaries,
                                      transform_apple_health_data,
+                                     transform_apple_health_data_long,
+                                     transform_apple_workouts,
                                      transform_strong_data)
+from db.readiness import wait_for_postgres
+from db.utils import dispose_engines, pool_status
 
-# Create a new logger
-logger.add("logs/log_{time}.log", rotation="500 MB", compression="zip")
-
-# Extract data
-apple_data = extract_apple_health_data(start_date="2023-09-05")
-strong_data = extract_strong_app_data(start_date="2023-01-01")
-
-# Transform data
-apple_health_df = transform_apple_health_data(apple_data)
-apple_health_sleep_df, apple_health_activity_df = split_apple_health_data(
-    apple_health_df)
-strong_df = transform_strong_data(strong_data)
-
-# Load data
-load_apple_health_data(apple_health_sleep_df,
-                       table_name="apple_health_sleep_raw")
-load_apple_health_data(apple_health_activity_df,
-                       table_name="apple_health_activity_raw")
-load_strong_app_data(strong_data)
+# "wide" pivots every metric into a column of `apple_health_activity_raw`
+# "long" stores one row per sample in `apple_health_records` and generates the wide view on demand
+APPLE_STORAGE_MODE = os.getenv("APPLE_STORAGE_MODE", "wide")
+
+# `export.xml`, or the `export.zip` from the iPhone, which is read without unzipping it
+APPLE_EXPORT_PATH = os.getenv(
+    "APPLE_EXPORT_PATH", "./data/apple_health_export/export.xml")
+
+# Number of stages that may run at the same time
+PIPELINE_MAX_WORKERS = int(os.getenv("PIPELINE_MAX_WORKERS", 4))
+
+# Number of processes that parse shards of the Apple Health XML export
+APPLE_EXTRACT_WORKERS = int(
+    os.getenv("APPLE_EXTRACT_WORKERS", os.cpu_count() or 1))
+
+
+def transform_apple(apple_export):
+    """Transforms extracted Apple Health records into an activity DataFrame for the configured storage mode
+
+    Nightly sleep data comes from `sessionize_sleep`, which needs the raw sleep stages, so it is dropped here.
+    """
+    if APPLE_STORAGE_MODE == "long":
+        return split_apple_health_records(transform_apple_health_data_long(apple_export["records"]))[1]
+    return split_apple_health_data(transform_apple_health_data(apple_export["records"]))[1]
+
+
+def sessionize_apple_sleep(apple_export):
+    return sessionize_sleep(apple_export["records"])
+
+
+def transform_workouts(apple_export):
+    return transform_apple_workouts(apple_export["workouts"], apple_export["workout_statistics"])
+
+
+def transform_activity_summaries(apple_export):
+    return transform_apple_activity_summaries(apple_export["activity_summaries"])
+
+
+# Tables loaded from the Strong extract, each with its own watermark
+STRONG_TABLES = ["strong_app_raw", "fact_set", "strength_state"]
+
+
+def extract_strong(**kwargs):
+    """Extracts only the Strong sets at or after the earliest watermark of the tables loaded from them
+
+    A table that was never loaded (e.g. a newly deployed one) or that missed a run makes every table re-read its sets,
+    which is safe since they all upsert.
+    """
+    watermarks = [get_table_watermark(table_name) for table_name in STRONG_TABLES]
+    since = None if any(watermark is None for watermark in watermarks) else min(watermarks)
+    return extract_strong_app_data(since=since, **kwargs)
+
+
+def load_strong(strong_df):
+    return load_strong_app_data(strong_df, mode="incremental")
+
+
+def load_apple_sleep(apple_health_sleep_df):
+    return load_apple_health_data(apple_health_sleep_df,
+                                  table_name="apple_health_sleep_raw", mode="incremental")
+
+
+def load_apple_workouts(apple_health_workouts_df):
+    return load_apple_health_data(apple_health_workouts_df,
+                                  table_name="apple_health_workouts", mode="incremental")
+
+
+def load_apple_activity_summaries(apple_health_activity_summaries_df):
+    return load_apple_health_data(apple_health_activity_summaries_df,
+                                  table_name="apple_health_activity_summaries", mode="incremental")
+
+
+def load_apple_downsampled(downsampled):
+    """Loads every resolution of `downsample_apple_health_data` into its own table, returning the rows written"""
+    written = [load_apple_health_data(downsampled[resolution], table_name=table_name, mode="incremental")
+               for resolution, table_name in DOWNSAMPLE_TABLES.items()]
+    return sum(rows for rows in written if rows is not None)
+
+
+def load_apple_activity(apple_health_activity_df):
+    if APPLE_STORAGE_MODE == "long":
+        written = load_apple_health_data(apple_health_activity_df,
+                                         table_name="apple_health_records", mode="incremental")
+        create_apple_health_wide_view()
+        return written
+    return load_apple_health_data(apple_health_activity_df,
+                                  table_name="apple_health_activity_raw", mode="incremental")
+
+
+# Stages only depend on the stages whose results they use, so the Apple and Strong branches run side by side
+stages = [
+    # Extract data. A single pass returns every Apple Health element type (records, workouts, activity summaries, ...)
+    # as its own DataFrame. The stage runs on a thread: a process stage would pickle all of those DataFrames back to
+    # this process, and the sharded parse already runs on its own process pool.
+    Stage("extract_apple", extract_apple_health_export,
+          kwargs={"path": APPLE_EXPORT_PATH, "start_date": "2023-09-05", "workers": APPLE_EXTRACT_WORKERS}),
+    Stage("extract_strong", extract_strong,
+          kwargs={"start_date": "2023-01-01"}),
+
+    # Transform data
+    Stage("transform_apple", transform_apple, depends_on=("extract_apple",)),
+    Stage("downsample_apple", downsample_apple_health_data,
+          depends_on=("transform_apple",)),
+    Stage("sessionize_sleep", sessionize_apple_sleep,
+          depends_on=("extract_apple",)),
+    Stage("transform_workouts", transform_workouts,
+          depends_on=("extract_apple",)),
+    Stage("transform_activity_summaries", transform_activity_summaries,
+          depends_on=("extract_apple",)),
+    Stage("transform_strong", transform_strong_data,
+          depends_on=("extract_strong",)),
+
+    # Load data
+    Stage("load_apple_sleep", load_apple_sleep,
+          depends_on=("sessionize_sleep",)),
+    Stage("load_apple_activity", load_apple_activity,
+          depends_on=("transform_apple",)),
+    Stage("load_apple_downsampled", load_apple_downsampled,
+          depends_on=("downsample_apple",)),
+    Stage("load_apple_workouts", load_apple_workouts,
+          depends_on=("transform_workouts",)),
+    Stage("load_apple_activity_summaries", load_apple_activity_summaries,
+          depends_on=("transform_activity_summaries",)),
+    Stage("load_strong", load_strong,
+          depends_on=("transform_strong",)),
+    Stage("load_strong_star", load_strong_star,
+          depends_on=("transform_strong",)),
+    Stage("load_strength", load_strength,
+          depends_on=("transform_strong",)),
+]
+
+if __name__ == "__main__":
+    # Debug messages (e.g. DataFrame previews) are only formatted when LOG_LEVEL is DEBUG
+    log_level = os.getenv("LOG_LEVEL", "INFO")
+    logger.remove()
+    logger.add(sys.stderr, level=log_level)
+    # Create a new logger
+    logger.add("logs/log_{time}.log", rotation="500 MB",
+               compression="zip", level=log_level)
+
+    load_env()
+    try:
+        # Extracting and transforming don't need the DB, but fail fast before parsing the exports if it never comes up
+        if not wait_for_postgres() or not create_pipeline_tables():
+            raise SystemExit(1)
+        # Every stage's duration, rows, peak memory and bytes written go to the `pipeline_runs` table
+        run_pipeline(stages, max_workers=PIPELINE_MAX_WORKERS,
+                     persist_metrics=True)
+        logger.info(f"DB connection pools: {pool_status()}")
+    finally:
+        dispose_engines()
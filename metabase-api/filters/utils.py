@@ -1,8 +1,15 @@
+import threading
 import uuid
 
 from loguru import logger
 from metabase_api import Metabase_API
 
+from db.readiness import READINESS_TIMEOUT, wait_for
+
+# Table metadata fetched from Metabase during this run, by table name. Each entry indexes the table's fields by name.
+_table_metadata_cache = {}
+_table_metadata_lock = threading.Lock()
+
 
 def field_base_type_to_widget_type(base_type: str) -> str:
     """Converts a field base type to a widget type."""
@@ -20,14 +27,89 @@ def field_base_type_to_widget_type(base_type: str) -> str:
     return base_type_to_widget_type[base_type]
 
 
+def get_table_fields(mb: Metabase_API, table_name: str) -> dict:
+    """Gets the fields of a table indexed by field name, fetching the table metadata from Metabase only once per run
+
+    Args:
+        mb (Metabase_API): An instance of the Metabase_API class
+        table_name (str): The name of the table
+
+    Returns:
+        dict: The field metadata dictionaries of the table, by field name
+    """
+    with _table_metadata_lock:
+        if table_name not in _table_metadata_cache:
+            table_metadata = mb.get_table_metadata(table_name=table_name)
+            _table_metadata_cache[table_name] = {
+                field["name"]: field for field in table_metadata["fields"]}
+            logger.debug(f"Fetched the metadata of the {table_name} table")
+        return _table_metadata_cache[table_name]
+
+
+def invalidate_table_metadata(table_name: str = None):
+    """Forgets the cached metadata of `table_name`, or of every table when None, so the next lookup fetches it again"""
+    with _table_metadata_lock:
+        if table_name is None:
+            _table_metadata_cache.clear()
+        else:
+            _table_metadata_cache.pop(table_name, None)
+
+
+def _missing_fields(mb: Metabase_API, db_id: int, table_field_tuples: list) -> list:
+    """The (table, field) tuples of `table_field_tuples` that Metabase doesn't know about yet"""
+    metadata = mb.get(f"/api/database/{db_id}/metadata")
+    fields = {table["name"]: {field["name"] for field in table.get("fields", [])}
+              for table in metadata["tables"]}
+    return [(table_name, field_name) for table_name, field_name in table_field_tuples
+            if field_name not in fields.get(table_name, ())]
+
+
+def sync_database_schema(mb: Metabase_API, db_id: int = 2, table_field_tuples: list = None, timeout: float = READINESS_TIMEOUT) -> bool:
+    """Makes Metabase re-scan the schema of a database (e.g. after the pipeline created new tables or columns) and invalidates the metadata cache
+
+    The sync runs in the background in Metabase, so this polls the database metadata with backoff until every field in
+    `table_field_tuples` shows up before the cache is invalidated.
+
+    Args:
+        mb (Metabase_API): An instance of the Metabase_API class
+        db_id (int, optional): The Metabase ID of the database. Defaults to 2.
+        table_field_tuples (list, optional): The (table, field) tuples to wait for. Defaults to None, which doesn't wait.
+        timeout (float, optional): Seconds to wait for the fields. Defaults to `READINESS_TIMEOUT`.
+
+    Returns:
+        bool: True if the sync started and every expected field showed up before the deadline
+    """
+    try:
+        # metabase_api returns False instead of raising when the request fails
+        if mb.post(f"/api/database/{db_id}/sync_schema") is False:
+            raise RuntimeError("request failed")
+        logger.success(f"Started a schema sync of database {db_id}")
+    except Exception as e:
+        logger.error(f"Could not sync the schema of database {db_id}: {e}")
+        invalidate_table_metadata()
+        return False
+
+    def synced() -> bool:
+        missing = _missing_fields(mb, db_id, table_field_tuples)
+        if missing:
+            raise LookupError(
+                "missing " + ", ".join(f"{table_name}.{field_name}" for table_name, field_name in missing))
+        return True
+
+    ready = wait_for(synced, f"Metabase schema sync of database {db_id}", timeout) if table_field_tuples else True
+    invalidate_table_metadata()
+    return ready
+
+
 def get_field_mappings(mb: Metabase_API, table_field_tuples: list) -> list:
-    """Gets the field mappings for a given list of table and field tuples."""
+    """Gets the field mappings for a given list of table and field tuples.
+
+    Every table's metadata is fetched once and shared by all calls, see `get_table_fields()`.
+    """
     field_mapping_list = []
     for table_name, field_name in table_field_tuples:
-        # Get the field metadata
-        table_metadata = mb.get_table_metadata(table_name=table_name)
-        field_dictionary = [dictionary for dictionary in table_metadata["fields"]
-                            if dictionary["name"] == field_name][0]
+        # Get the field metadata, copied so the cached metadata stays untouched
+        field_dictionary = dict(get_table_fields(mb, table_name)[field_name])
         # Extract the field metadata we want
         field_dictionary["field_id"] = field_dictionary["id"]
         field_dictionary["field_name"] = field_name
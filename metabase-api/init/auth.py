@@ -1,23 +1,19 @@
 import os
-import time
 
 import pandas as pd
 from dotenv import load_dotenv
 from loguru import logger
 from metabase_api import Metabase_API
 
+from db.readiness import METABASE_URL, wait_for_metabase
 from db.utils import init_metabase_db_connection
 
-# Set the environment variables
-dotenv_path = os.path.join(os.path.dirname(__file__), '..', 'db', '.env')
-
-admin_creation_delay = 275
-
 
 def is_initialized():
     try:
-        conn = init_metabase_db_connection()
-        df = pd.read_sql("select * from report_card limit 1", conn)
+        # Return the connection to the shared pool right away
+        with init_metabase_db_connection() as conn:
+            df = pd.read_sql("select * from report_card limit 1", conn)
         if df.empty:
             logger.warning(
                 "Existing Metabase questions not found, initializing...")
@@ -29,9 +25,12 @@ def is_initialized():
         return False
 
 
-def auth():
+def auth(skip_if_initialized: bool = True):
     """Authenticates with the Metabase API.
 
+    Args:
+        skip_if_initialized (bool, optional): True to return None when Metabase questions already exist. Defaults to True.
+
     Returns:
         Metabase_API: An instance of the Metabase_API class.
     """
@@ -43,17 +42,14 @@ def auth():
     except:
         logger.error("Could not load .env file")
 
-    # If Metabase questions not initialized then wait 5 minutes for user to completed admin creation through the Metabase UI
-    if not is_initialized():
-        for i in range(admin_creation_delay):
-            time.sleep(1)
-            i = admin_creation_delay - i
-            if i % 25 == 0:
-                logger.info(
-                    f"Waiting for Metabase to start... {i} seconds remaining")
+    # Wait until the Metabase backend, server and admin account are up, however long that takes
+    if not wait_for_metabase():
+        logger.error("Metabase is not ready, initialization skipped")
+        return None
+
+    if not skip_if_initialized or not is_initialized():
         try:
-            # Have to use the container name as the host name because that is the name of the service in the docker-compose.yml file
-            mb = Metabase_API(domain="http://metabase:3000/",
+            mb = Metabase_API(domain=METABASE_URL,
                               email=os.getenv("MB_ADMIN_EMAIL"), password=os.getenv("MB_ADMIN_PASSWORD"))
             logger.success("Connected to Metabase API")
         except Exception as e:
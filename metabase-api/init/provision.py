@@ -0,0 +1,192 @@
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from loguru import logger
+from metabase_api import Metabase_API
+
+# Maximum number of Metabase API calls in flight at the same time
+PROVISION_WORKERS = int(os.getenv("PROVISION_WORKERS", 8))
+
+# Provisioned cards carry this marker and the hash of their definition in their description
+MANAGED_MARKER = "Managed by metabase-api"
+
+
+def card_hash(payload: dict) -> str:
+    """Hashes the parts of a card payload that define the question
+
+    Template tag IDs are random on every build, so only the tag names, types and fields are hashed.
+
+    Args:
+        payload (dict): A card payload returned by a question builder with `dry_run=True`
+
+    Returns:
+        str: The SHA-256 hex digest of the card definition
+    """
+    native = payload["dataset_query"]["native"]
+    definition = {
+        "name": payload["name"],
+        "display": payload["display"],
+        "collection_id": payload.get("collection_id"),
+        "database": payload["dataset_query"]["database"],
+        "query": native["query"],
+        "template_tags": {name: {key: value for key, value in tag.items() if key != "id"}
+                          for name, tag in native.get("template-tags", {}).items()},
+        "visualization_settings": payload.get("visualization_settings"),
+    }
+    return hashlib.sha256(json.dumps(definition, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def _description(payload: dict) -> str:
+    return f"{MANAGED_MARKER} (sha256:{card_hash(payload)})"
+
+
+def ensure_collections(mb: Metabase_API, collection_names: list, parent_collection_name: str = "Root"):
+    """Creates the collections in `collection_names` that don't exist yet"""
+    existing = {collection["name"] for collection in mb.get("/api/collection/") or []
+                if not collection.get("archived")}
+    for collection_name in collection_names:
+        if collection_name in existing:
+            continue
+        try:
+            mb.create_collection(
+                collection_name, parent_collection_name=parent_collection_name)
+            logger.success(
+                f"Created collection - '{collection_name}' under '{parent_collection_name}' collection")
+        except Exception as e:
+            logger.error(f"Could not create collection - '{collection_name}': {e}")
+
+
+def plan_cards(desired: list, current: list) -> dict:
+    """Diffs the desired card payloads against the cards that exist in Metabase
+
+    A current card matches a desired one by name and collection. Matched cards are updated when the hash in their
+    description differs (cards made before provisioning have no hash, so they are updated once and adopted). Managed
+    cards that match no desired card, and duplicates of a matched card, are archived. Cards that users made by hand
+    are never touched.
+
+    Args:
+        desired (list): Card payloads returned by the question builders with `dry_run=True`
+        current (list): The cards returned by `GET /api/card`
+
+    Returns:
+        dict: "create" (payloads), "update" ((card id, payload) tuples), "archive" (cards) and "unchanged" (cards)
+    """
+    plan = {"create": [], "update": [], "archive": [], "unchanged": []}
+    by_key = {}
+    for card in current:
+        if card.get("archived"):
+            continue
+        by_key.setdefault((card["name"], card.get("collection_id")), []).append(card)
+
+    desired_keys = set()
+    for payload in desired:
+        key = (payload["name"], payload.get("collection_id"))
+        desired_keys.add(key)
+        matches = by_key.get(key, [])
+        if not matches:
+            plan["create"].append(payload)
+            continue
+        card, duplicates = matches[0], matches[1:]
+        if card.get("description") == _description(payload):
+            plan["unchanged"].append(card)
+        else:
+            plan["update"].append((card["id"], payload))
+        plan["archive"].extend(duplicates)
+
+    for key, cards in by_key.items():
+        if key not in desired_keys:
+            plan["archive"].extend(card for card in cards
+                                   if (card.get("description") or "").startswith(MANAGED_MARKER))
+    return plan
+
+
+def _create_card(mb: Metabase_API, payload: dict):
+    # metabase_api returns False instead of raising when the request fails
+    if mb.post("/api/card/", json=dict(payload, description=_description(payload))) is False:
+        raise RuntimeError("request failed")
+    logger.success(f"Created question - {payload['name']}")
+
+
+def _update_card(mb: Metabase_API, card_id: int, payload: dict):
+    status = mb.put(f"/api/card/{card_id}", json=dict(payload, description=_description(payload)))
+    if status != 200:
+        raise RuntimeError(f"status code {status}")
+    logger.success(f"Updated question - {payload['name']}")
+
+
+def _archive_card(mb: Metabase_API, card: dict):
+    status = mb.put(f"/api/card/{card['id']}", json={"archived": True})
+    if status != 200:
+        raise RuntimeError(f"status code {status}")
+    logger.success(f"Archived question - {card['name']}")
+
+
+def _wait_for_calls(futures: dict) -> list:
+    """Waits for the API calls in `futures` (future: action) and logs the failed ones, returning their actions"""
+    failed = []
+    for future, action in futures.items():
+        try:
+            future.result()
+        except Exception as e:
+            logger.error(f"Could not {action}: {e}")
+            failed.append(action)
+    return failed
+
+
+def provision(mb: Metabase_API, questions: list, collection_names: list = None, dry_run: bool = False, max_workers: int = PROVISION_WORKERS) -> dict:
+    """Brings the Metabase questions in line with the question builders, changing only what differs
+
+    Safe to run on every deploy: the builders are run with `dry_run=True` to get the desired cards, which are diffed
+    against the current cards (see `plan_cards()`). Building the payloads and the create, update and archive calls
+    each run on a thread pool of `max_workers`. Cards are only archived once every create and update succeeded.
+
+    Args:
+        mb (Metabase_API): An instance of the Metabase_API class
+        questions (list): Question builders, e.g. `apple_calories`, that accept `mb` and `dry_run`
+        collection_names (list, optional): Collections to create if they don't exist yet. Defaults to None.
+        dry_run (bool, optional): True to only log the plan. Defaults to False.
+        max_workers (int, optional): The maximum number of concurrent API calls. Defaults to `PROVISION_WORKERS`.
+
+    Returns:
+        dict: The plan returned by `plan_cards()`, plus the "failed" API calls unless `dry_run` is True
+    """
+    if collection_names and not dry_run:
+        ensure_collections(mb, collection_names)
+
+    def build(question):
+        try:
+            return question(mb, dry_run=True)
+        except Exception as e:
+            logger.error(f"Could not build question - {question.__name__}: {e}")
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # Field metadata is cached per table, so concurrent builders share the lookups
+        payloads = list(executor.map(build, questions))
+        desired = [payload for payload in payloads if payload is not None]
+        plan = plan_cards(desired, mb.get("/api/card/") or [])
+        if len(desired) < len(payloads):
+            # A card that failed to build would look removed, so don't archive anything this time
+            logger.warning("Some questions could not be built, skipping archival")
+            plan["archive"] = []
+        logger.info(
+            f"Provisioning plan: {len(plan['create'])} to create, {len(plan['update'])} to update, {len(plan['archive'])} to archive, {len(plan['unchanged'])} unchanged")
+        if dry_run:
+            return plan
+
+        futures = {}
+        for payload in plan["create"]:
+            futures[executor.submit(_create_card, mb, payload)] = f"create {payload['name']}"
+        for card_id, payload in plan["update"]:
+            futures[executor.submit(_update_card, mb, card_id, payload)] = f"update {payload['name']}"
+        plan["failed"] = _wait_for_calls(futures)
+
+        if plan["failed"] and plan["archive"]:
+            # The cards of a failed create or update are missing or outdated, so keep their predecessors for now
+            logger.warning("Some questions could not be created or updated, skipping archival")
+            plan["archive"] = []
+        plan["failed"] += _wait_for_calls({executor.submit(_archive_card, mb, card): f"archive {card['name']}"
+                                           for card in plan["archive"]})
+
+    return plan
@@ -2,10 +2,12 @@ from init.questions.utils import (create_sql_timeseries_question,
                                   set_visualization_settings)
 from metabase_api import Metabase_API
 from queries.apple.activity import query_calories_burned
-from queries.apple.sleep import query_rem_cycles, query_sleep_hours
+from queries.apple.heart_rate import query_heart_rate
+from queries.apple.sleep import (query_rem_cycles, query_sleep_hours,
+                                 query_sleep_stages)
 
 
-def apple_calories(mb: Metabase_API):
+def apple_calories(mb: Metabase_API, dry_run: bool = False):
     query = query_calories_burned()
     visualization_settings = set_visualization_settings(
         x_axis_title="Time Period",
@@ -14,11 +16,23 @@ def apple_calories(mb: Metabase_API):
         metrics=["total_calories_burned",
                  "active_calories_burned", "resting_calories_burned"]
     )
-    create_sql_timeseries_question(mb, query=query, question_name="Calories Burned Over Time",
-                                   display="line", db_id=2, collection_id=3, table_id=40, visualization_settings=visualization_settings)
+    return create_sql_timeseries_question(mb, query=query, question_name="Calories Burned Over Time",
+                                          display="line", db_id=2, collection_id=3, table_id=40, visualization_settings=visualization_settings, dry_run=dry_run)
 
 
-def apple_sleep_hours(mb: Metabase_API):
+def apple_heart_rate(mb: Metabase_API, dry_run: bool = False):
+    query = query_heart_rate()
+    visualization_settings = set_visualization_settings(
+        x_axis_title="Time Period",
+        y_axis_title="Beats per Minute",
+        dimensions=["time_period"],
+        metrics=["average_heart_rate", "min_heart_rate", "max_heart_rate"]
+    )
+    return create_sql_timeseries_question(mb, query=query, question_name="Heart Rate Over Time",
+                                          display="line", db_id=2, collection_id=3, table_id=40, visualization_settings=visualization_settings, dry_run=dry_run)
+
+
+def apple_sleep_hours(mb: Metabase_API, dry_run: bool = False):
     query = query_sleep_hours()
     visualization_settings = set_visualization_settings(
         x_axis_title="Time Period",
@@ -27,11 +41,11 @@ def apple_sleep_hours(mb: Metabase_API):
         metrics=["hours_of_sleep", "average_hours_of_sleep",
                  "hours_of_time_in_bed", "average_hours_of_time_in_bed", "average_rem_cycles"]
     )
-    create_sql_timeseries_question(mb, query=query, question_name="Hours of Sleep Over Time",
-                                   display="line", db_id=2, collection_id=3, table_id=40, visualization_settings=visualization_settings)
+    return create_sql_timeseries_question(mb, query=query, question_name="Hours of Sleep Over Time",
+                                          display="line", db_id=2, collection_id=3, table_id=40, visualization_settings=visualization_settings, dry_run=dry_run)
 
 
-def apple_rem_cycles(mb: Metabase_API):
+def apple_rem_cycles(mb: Metabase_API, dry_run: bool = False):
     query = query_rem_cycles()
     visualization_settings = set_visualization_settings(
         x_axis_title="Time Period",
@@ -39,5 +53,18 @@ def apple_rem_cycles(mb: Metabase_API):
         dimensions=["time_period"],
         metrics=["average_rem_cycles", "rem_cycles"]
     )
-    create_sql_timeseries_question(mb, query=query, question_name="REM Cycles Over Time",
-                                   display="line", db_id=2, collection_id=3, table_id=40, visualization_settings=visualization_settings)
+    return create_sql_timeseries_question(mb, query=query, question_name="REM Cycles Over Time",
+                                          display="line", db_id=2, collection_id=3, table_id=40, visualization_settings=visualization_settings, dry_run=dry_run)
+
+
+def apple_sleep_stages(mb: Metabase_API, dry_run: bool = False):
+    query = query_sleep_stages()
+    visualization_settings = set_visualization_settings(
+        x_axis_title="Time Period",
+        y_axis_title="Average Hours",
+        dimensions=["time_period"],
+        metrics=["average_hours_of_core_sleep", "average_hours_of_deep_sleep",
+                 "average_hours_of_rem_sleep", "average_hours_awake"]
+    )
+    return create_sql_timeseries_question(mb, query=query, question_name="Sleep Stages Over Time",
+                                          display="bar", db_id=2, collection_id=3, table_id=40, visualization_settings=visualization_settings, dry_run=dry_run)
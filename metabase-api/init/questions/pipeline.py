@@ -0,0 +1,44 @@
+from init.questions.utils import (create_sql_timeseries_question,
+                                  get_collection_id,
+                                  set_visualization_settings)
+from metabase_api import Metabase_API
+from queries.pipeline.health import (query_stage_duration,
+                                     query_stage_peak_memory,
+                                     query_stage_throughput)
+
+# Created by provisioning (see `COLLECTIONS` in main.py), so its ID differs between Metabase instances
+COLLECTION_NAME = "Pipeline Health"
+
+
+def pipeline_stage_duration(mb: Metabase_API, dry_run: bool = False):
+    query = query_stage_duration()
+    visualization_settings = set_visualization_settings(
+        x_axis_title="Time Period",
+        y_axis_title="Avg. Duration (s)",
+        dimensions=["time_period", "stage"],
+        metrics=["average_duration_seconds"]
+    )
+    return create_sql_timeseries_question(mb, query=query, question_name="Stage Duration Over Time",
+                                          display="line", db_id=2, collection_id=get_collection_id(mb, COLLECTION_NAME), table_id=48, visualization_settings=visualization_settings, dry_run=dry_run)
+
+
+def pipeline_stage_peak_memory(mb: Metabase_API, dry_run: bool = False):
+    query = query_stage_peak_memory()
+    visualization_settings = set_visualization_settings(
+        x_axis_title="Time Period",
+        y_axis_title="Peak RSS (MB)",
+        dimensions=["time_period", "stage"],
+        metrics=["peak_rss_mb"]
+    )
+    return create_sql_timeseries_question(mb, query=query, question_name="Stage Peak Memory Over Time",
+                                          display="line", db_id=2, collection_id=get_collection_id(mb, COLLECTION_NAME), table_id=48, visualization_settings=visualization_settings, dry_run=dry_run)
+
+
+def pipeline_stage_throughput(mb: Metabase_API, dry_run: bool = False):
+    query = query_stage_throughput()
+    visualization_settings = set_visualization_settings(
+        dimensions=["time_period", "stage"],
+        metrics=["rows_in_per_second", "rows_out", "megabytes_written", "failed_runs"]
+    )
+    return create_sql_timeseries_question(mb, query=query, question_name="Stage Throughput and Failures",
+                                          display="table", db_id=2, collection_id=get_collection_id(mb, COLLECTION_NAME), table_id=48, visualization_settings=visualization_settings, dry_run=dry_run)
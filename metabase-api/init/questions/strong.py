@@ -6,9 +6,10 @@ from queries.strong.lifting import (query_count_by_workout_type,
                                     query_duration_by_workout_type,
                                     query_sets_by_exercise_type,
                                     query_sets_by_workout_type)
+from queries.strong.strength import query_estimated_one_rep_max, query_rep_prs
 
 
-def strong_workout_duration_by_type(mb: Metabase_API):
+def strong_workout_duration_by_type(mb: Metabase_API, dry_run: bool = False):
     query = query_duration_by_workout_type()
     visualization_settings = set_visualization_settings(
         x_axis_title="Workout Type",
@@ -17,11 +18,11 @@ def strong_workout_duration_by_type(mb: Metabase_API):
         metrics=["average_workout_length_minutes",
                  "median_workout_length_minutes"]
     )
-    create_sql_question(mb, query=query, question_name="Workout Duration by Type",
-                        display="bar", db_id=2, collection_id=2, table_id=48, visualization_settings=visualization_settings, timestamp_field_name="created_at")
+    return create_sql_question(mb, query=query, question_name="Workout Duration by Type",
+                               display="bar", db_id=2, collection_id=2, table_id=48, visualization_settings=visualization_settings, timestamp_field_name="created_at", dry_run=dry_run)
 
 
-def strong_sets_by_workout_type(mb: Metabase_API):
+def strong_sets_by_workout_type(mb: Metabase_API, dry_run: bool = False):
     query = query_sets_by_workout_type()
     visualization_settings = set_visualization_settings(
         x_axis_title="Time Period",
@@ -29,21 +30,21 @@ def strong_sets_by_workout_type(mb: Metabase_API):
         dimensions=["time_period", "workout_name"],
         metrics=["number_of_sets"]
     )
-    create_sql_timeseries_question(mb, query=query, question_name="Sets Over Time",
-                                   display="line", db_id=2, collection_id=2, table_id=48, visualization_settings=visualization_settings)
+    return create_sql_timeseries_question(mb, query=query, question_name="Sets Over Time",
+                                          display="line", db_id=2, collection_id=2, table_id=48, visualization_settings=visualization_settings, dry_run=dry_run)
 
 
-def strong_volume_by_exercise_type(mb: Metabase_API):
+def strong_volume_by_exercise_type(mb: Metabase_API, dry_run: bool = False):
     query = query_sets_by_exercise_type()
     visualization_settings = set_visualization_settings(
         dimensions=["time_period", "exercise_name"],
         metrics=["time_period", "exercise_name"]
     )
-    create_sql_timeseries_question(mb, query=query, question_name="Sets by Exercise Type Over Time",
-                                   display="table", db_id=2, collection_id=2, table_id=48, visualization_settings=visualization_settings)
+    return create_sql_timeseries_question(mb, query=query, question_name="Sets by Exercise Type Over Time",
+                                          display="table", db_id=2, collection_id=2, table_id=48, visualization_settings=visualization_settings, dry_run=dry_run)
 
 
-def strong_count_by_workout_type(mb: Metabase_API):
+def strong_count_by_workout_type(mb: Metabase_API, dry_run: bool = False):
     query = query_count_by_workout_type()
     visualization_settings = set_visualization_settings(
         x_axis_title="Time Period",
@@ -51,5 +52,27 @@ def strong_count_by_workout_type(mb: Metabase_API):
         dimensions=["time_period", "workout_name"],
         metrics=["number_of_workout_days"]
     )
-    create_sql_timeseries_question(mb, query=query, question_name="Workouts Over Time by Type",
-                                   display="line", db_id=2, collection_id=2, table_id=48, visualization_settings=visualization_settings)
+    return create_sql_timeseries_question(mb, query=query, question_name="Workouts Over Time by Type",
+                                          display="line", db_id=2, collection_id=2, table_id=48, visualization_settings=visualization_settings, dry_run=dry_run)
+
+
+def strong_estimated_one_rep_max(mb: Metabase_API, dry_run: bool = False):
+    query = query_estimated_one_rep_max()
+    visualization_settings = set_visualization_settings(
+        x_axis_title="Time Period",
+        y_axis_title="Estimated 1RM",
+        dimensions=["time_period", "exercise_name"],
+        metrics=["estimated_1rm_epley"]
+    )
+    return create_sql_timeseries_question(mb, query=query, question_name="Estimated 1RM Over Time",
+                                          display="line", db_id=2, collection_id=2, table_id=48, visualization_settings=visualization_settings, dry_run=dry_run)
+
+
+def strong_rep_prs(mb: Metabase_API, dry_run: bool = False):
+    query = query_rep_prs()
+    visualization_settings = set_visualization_settings(
+        dimensions=["exercise_name", "reps"],
+        metrics=["heaviest_weight", "achieved_at"]
+    )
+    return create_sql_question(mb, query=query, question_name="Rep PRs by Exercise",
+                               display="table", db_id=2, collection_id=2, table_id=48, visualization_settings=visualization_settings, timestamp_field_name="achieved_at", dry_run=dry_run)
@@ -29,7 +29,24 @@ def set_visualization_settings(show_values: bool = True, x_axis_title: str = Non
     return visualization_settings
 
 
-def create_sql_question(mb: Metabase_API, query: str, display: str = "table", question_name: str = "test_card", db_id: int = 2, collection_id: int = 2, table_id: int = 48, visualization_settings: dict = None, timestamp_field_name: str = "created_at"):
+def get_collection_id(mb: Metabase_API, collection_name: str) -> int:
+    """Gets the ID of the collection named `collection_name`, ignoring archived collections
+
+    Raises:
+        LookupError: If no such collection exists
+    """
+    for collection in mb.get("/api/collection/") or []:
+        if collection["name"] == collection_name and not collection.get("archived"):
+            return collection["id"]
+    raise LookupError(f"Collection '{collection_name}' does not exist")
+
+
+def create_sql_question(mb: Metabase_API, query: str, display: str = "table", question_name: str = "test_card", db_id: int = 2, collection_id: int = 2, table_id: int = 48, visualization_settings: dict = None, timestamp_field_name: str = "created_at", dry_run: bool = False):
+    """Creates a native SQL question with a date field filter on `timestamp_field_name`
+
+    Returns:
+        dict: The card payload when `dry_run` is True, nothing is created in Metabase then. Otherwise None.
+    """
     try:
         # Parse the table name from the query
         table_name = query.split("from")[1].strip().split("\n")[0]
@@ -67,6 +84,10 @@ def create_sql_question(mb: Metabase_API, query: str, display: str = "table", qu
         "visualization_settings": visualization_settings
     }
 
+    if dry_run:
+        my_custom_json["collection_id"] = collection_id
+        return my_custom_json
+
     try:
         api_response = mb.create_card(question_name, db_id=db_id, collection_id=collection_id,
                                       table_id=table_id, custom_json=my_custom_json)
@@ -75,7 +96,12 @@ def create_sql_question(mb: Metabase_API, query: str, display: str = "table", qu
         logger.error(f"Could not create question - {question_name}\n{e}")
 
 
-def create_sql_timeseries_question(mb: Metabase_API, query: str, display: str = "table", question_name: str = "test_card", db_id: int = 2, collection_id: int = 2, table_id: int = 48, visualization_settings: dict = None):
+def create_sql_timeseries_question(mb: Metabase_API, query: str, display: str = "table", question_name: str = "test_card", db_id: int = 2, collection_id: int = 2, table_id: int = 48, visualization_settings: dict = None, dry_run: bool = False):
+    """Creates a native SQL question with a `date_granularity` variable and a field filter per `[[ and {{field}} ]]` clause
+
+    Returns:
+        dict: The card payload when `dry_run` is True, nothing is created in Metabase then. Otherwise None.
+    """
     try:
         # Parse the table name from the query
         table_name = query.split("from")[1].strip().split("\n")[0]
@@ -125,6 +151,10 @@ def create_sql_timeseries_question(mb: Metabase_API, query: str, display: str =
     my_custom_json = add_field_filters(
         mappings=field_mappings, my_custom_json=my_custom_json)
 
+    if dry_run:
+        my_custom_json["collection_id"] = collection_id
+        return my_custom_json
+
     try:
         api_response = mb.create_card(question_name, db_id=db_id, collection_id=collection_id,
                                       table_id=table_id, custom_json=my_custom_json)
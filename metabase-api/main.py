@@ -1,11 +1,26 @@
 import os
 
+from filters.utils import sync_database_schema
 from init.auth import auth
 from init.collections import create_collection
-from init.questions.apple import apple_calories, apple_rem_cycles, apple_sleep_hours
+from init.provision import provision
+from init.questions.apple import (
+    apple_calories,
+    apple_heart_rate,
+    apple_rem_cycles,
+    apple_sleep_hours,
+    apple_sleep_stages,
+)
 from init.questions.five_by_five import five_by_five_progressive_overload
+from init.questions.pipeline import (
+    pipeline_stage_duration,
+    pipeline_stage_peak_memory,
+    pipeline_stage_throughput,
+)
 from init.questions.strong import (
     strong_count_by_workout_type,
+    strong_estimated_one_rep_max,
+    strong_rep_prs,
     strong_sets_by_workout_type,
     strong_volume_by_exercise_type,
     strong_workout_duration_by_type,
@@ -15,37 +30,73 @@ from loguru import logger
 # Load environment variables from the .env file
 path = os.path.join(os.path.dirname(__file__), '..', 'init', '.env')
 
-# Authenticate API Session
-mb = auth()
-# If mb is None then the Metabase questions have already been initialized
-if mb:
-    # Create Collection for Strong App
-    create_collection(mb, collection_name="Strong App",
-                      parent_collection_name="Root")
+# "sync" creates, updates and archives only the questions that differ from the builders below, on every run
+# "initialize" creates everything once and skips the run if any question already exists
+PROVISION_MODE = os.getenv("PROVISION_MODE", "sync")
 
-    # Create Collection for Apple Health
-    create_collection(mb, collection_name="Apple Health",
-                      parent_collection_name="Root")
-    
-    # Create Collection for 5x5 program
-    create_collection(mb, collection_name="5x5 Program",
-                      parent_collection_name="Root")
+COLLECTIONS = ["Strong App", "Apple Health", "5x5 Program", "Pipeline Health"]
 
-    # Create Questions
+# The (table, field) tuples the questions below filter on, which the schema sync has to pick up before provisioning
+QUESTION_FIELDS = [
+    ("dim_workout", "created_at"),
+    ("strong_workout_rollup", "bucket_start"),
+    ("strong_workout_rollup", "workout_name"),
+    ("strong_exercise_rollup", "bucket_start"),
+    ("strong_exercise_rollup", "exercise_name"),
+    ("strength_e1rm", "session_at"),
+    ("strength_rep_prs", "achieved_at"),
+    ("apple_activity_rollup", "bucket_start"),
+    ("apple_health_metrics_day", "start_date"),
+    ("apple_sleep_rollup", "bucket_start"),
+    ("strength_state", "last_session_at"),
+    ("pipeline_runs", "started_at"),
+    ("pipeline_runs", "stage"),
+]
 
+QUESTIONS = [
     # Inside the Strong App Collection
-    strong_workout_duration_by_type(mb)
-    strong_sets_by_workout_type(mb)
-    strong_volume_by_exercise_type(mb)
-    strong_count_by_workout_type(mb)
-
+    strong_workout_duration_by_type,
+    strong_sets_by_workout_type,
+    strong_volume_by_exercise_type,
+    strong_count_by_workout_type,
+    strong_estimated_one_rep_max,
+    strong_rep_prs,
     # Inside the Apple Health Collection
-    apple_calories(mb)
-    apple_sleep_hours(mb)
-    apple_rem_cycles(mb)
-
+    apple_calories,
+    apple_heart_rate,
+    apple_sleep_hours,
+    apple_rem_cycles,
+    apple_sleep_stages,
     # Inside the 5x5 Program Collection
-    five_by_five_progressive_overload(mb)
+    five_by_five_progressive_overload,
+    # Inside the Pipeline Health Collection
+    pipeline_stage_duration,
+    pipeline_stage_peak_memory,
+    pipeline_stage_throughput,
+]
+
+# Authenticate API Session
+mb = auth(skip_if_initialized=PROVISION_MODE != "sync")
+# If mb is None then the Metabase questions have already been initialized
+if mb:
+    # Pick up the tables and columns the pipeline created since Metabase's last sync before looking up their fields
+    sync_database_schema(mb, table_field_tuples=QUESTION_FIELDS)
+
+    if PROVISION_MODE == "sync":
+        plan = provision(mb, QUESTIONS, collection_names=COLLECTIONS)
+        if plan["failed"]:
+            logger.error(f"Could not provision every metabase question, {len(plan['failed'])} API calls failed")
+        else:
+            logger.success("Successfully provisioned all metabase questions")
+    else:
+        # Create the Collections
+        for collection_name in COLLECTIONS:
+            create_collection(mb, collection_name=collection_name,
+                              parent_collection_name="Root")
+
+        # Create Questions
+        for question in QUESTIONS:
+            question(mb)
 
-    # Success message
-    logger.success("Successfully initialized all metabase questions")
+        # Success message
+        logger.success("Successfully initialized all metabase questions")
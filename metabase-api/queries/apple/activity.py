@@ -3,6 +3,9 @@
 def add_apple_activity_field_filters_to_sql(query: str) -> str:
     """Replaces generic `where 1=1` with Metabase field filters for the Apple Health Activity Data.
 
+    The date filter is on the start of each rollup bucket, so it selects whole buckets of the chosen granularity (see
+    `BUCKET_COLUMN` in `datapipelines/rollups.py`).
+
     Args:
         query (str): The SQL query to be modified.
 
@@ -10,18 +13,19 @@ def add_apple_activity_field_filters_to_sql(query: str) -> str:
         str: The modified SQL query with Strong App field filters.
     """
 
-    return query.replace("where 1=1", "where 1=1\n    [[ and {{end_date}} ]]")
+    return query.replace("where 1=1", "where 1=1\n    [[ and {{bucket_start}} ]]")
 
 
 def query_calories_burned():
+    # Reads the pre-aggregated bucket of the selected granularity instead of scanning `apple_health_activity_raw`
     query = """select 
-    date_trunc({{date_granularity}}, end_date) as time_period
-    , sum(active_energy_burned) as active_calories_burned
-    , sum(basal_energy_burned) as resting_calories_burned
-    , sum(active_energy_burned) + sum(basal_energy_burned) as total_calories_burned
-from apple_health_activity_raw
+    bucket_start as time_period
+    , active_energy_burned as active_calories_burned
+    , basal_energy_burned as resting_calories_burned
+    , active_energy_burned + basal_energy_burned as total_calories_burned
+from apple_activity_rollup
 where 1=1
-group by time_period
+    and granularity = lower({{date_granularity}})
 order by time_period desc
 """
     query = add_apple_activity_field_filters_to_sql(query)
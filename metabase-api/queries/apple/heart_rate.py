@@ -0,0 +1,31 @@
+# Description: Metabase queries for the downsampled Apple Health metrics
+
+def add_apple_metrics_field_filters_to_sql(query: str) -> str:
+    """Replaces generic `where 1=1` with Metabase field filters for the downsampled Apple Health metrics.
+
+    Args:
+        query (str): The SQL query to be modified.
+
+    Returns:
+        str: The modified SQL query with downsampled metric field filters.
+    """
+
+    return query.replace("where 1=1", "where 1=1\n    [[ and {{start_date}} ]]")
+
+
+def query_heart_rate():
+    # Reads the fixed-size daily aggregates instead of every heart rate sample. The hourly and per-minute tables
+    # (`apple_health_metrics_hour`, `apple_health_metrics_minute`) keep the detail for shorter ranges.
+    query = """select 
+    date_trunc(lower({{date_granularity}}), start_date) as time_period
+    , min(min_value) as min_heart_rate
+    , sum(sum_value) / sum(sample_count) as average_heart_rate
+    , max(max_value) as max_heart_rate
+from apple_health_metrics_day
+where 1=1
+    and metric = 'heart_rate'
+group by 1
+order by time_period desc
+"""
+    query = add_apple_metrics_field_filters_to_sql(query)
+    return query.strip()
@@ -3,6 +3,9 @@
 def add_apple_sleep_field_filters_to_sql(query: str) -> str:
     """Replaces generic `where 1=1` with Metabase field filters for the Apple Health Activity Data.
 
+    The date filter is on the start of each rollup bucket, so it selects whole buckets of the chosen granularity (see
+    `BUCKET_COLUMN` in `datapipelines/rollups.py`).
+
     Args:
         query (str): The SQL query to be modified.
 
@@ -10,20 +13,21 @@ def add_apple_sleep_field_filters_to_sql(query: str) -> str:
         str: The modified SQL query with Strong App field filters.
     """
 
-    return query.replace("where 1=1", "where 1=1\n    [[ and {{creation_date}} ]]")
+    return query.replace("where 1=1", "where 1=1\n    [[ and {{bucket_start}} ]]")
 
 
 def query_sleep_hours():
+    # Reads the pre-aggregated bucket of the selected granularity instead of scanning `apple_health_sleep_raw`
     query = """select 
-    date_trunc({{date_granularity}}, creation_date) as time_period
-    , sum(total_time_asleep_seconds) / 3600.0 as hours_of_sleep
-    , avg(total_time_asleep_seconds) / 3600.0 as average_hours_of_sleep
-    , sum(time_in_bed_seconds) / 3600.0 as hours_of_time_in_bed
-    , avg(time_in_bed_seconds) / 3600.0 as average_hours_of_time_in_bed
-    , avg(rem_cycles) as average_rem_cycles
-from apple_health_sleep_raw
+    bucket_start as time_period
+    , total_time_asleep_seconds / 3600.0 as hours_of_sleep
+    , total_time_asleep_seconds / nights / 3600.0 as average_hours_of_sleep
+    , time_in_bed_seconds / 3600.0 as hours_of_time_in_bed
+    , time_in_bed_seconds / nights / 3600.0 as average_hours_of_time_in_bed
+    , rem_cycles * 1.0 / nights as average_rem_cycles
+from apple_sleep_rollup
 where 1=1
-group by time_period
+    and granularity = lower({{date_granularity}})
 order by time_period desc
 """
     query = add_apple_sleep_field_filters_to_sql(query)
@@ -32,12 +36,28 @@ order by time_period desc
 
 def query_rem_cycles():
     query = """select 
-    date_trunc({{date_granularity}}, creation_date) as time_period
-    , sum(rems) as rem_cycles
-    , avg(rem_cycles) as average_rem_cycles
-from apple_health_sleep_raw
+    bucket_start as time_period
+    , rem_cycles
+    , rem_cycles * 1.0 / nights as average_rem_cycles
+from apple_sleep_rollup
+where 1=1
+    and granularity = lower({{date_granularity}})
+order by time_period desc
+"""
+    query = add_apple_sleep_field_filters_to_sql(query)
+    return query.strip()
+
+
+def query_sleep_stages():
+    query = """select 
+    bucket_start as time_period
+    , core_seconds / nights / 3600.0 as average_hours_of_core_sleep
+    , deep_seconds / nights / 3600.0 as average_hours_of_deep_sleep
+    , rem_seconds / nights / 3600.0 as average_hours_of_rem_sleep
+    , awake_seconds / nights / 3600.0 as average_hours_awake
+from apple_sleep_rollup
 where 1=1
-group by time_period
+    and granularity = lower({{date_granularity}})
 order by time_period desc
 """
     query = add_apple_sleep_field_filters_to_sql(query)
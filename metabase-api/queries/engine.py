@@ -0,0 +1,147 @@
+# Description: Runs the Metabase SQL templates of this package without Metabase, with an in-process result cache
+import json
+import os
+import re
+import threading
+from collections import OrderedDict
+
+import pandas as pd
+from loguru import logger
+from sqlalchemy import inspect, text
+from sqlalchemy.engine.base import Connection
+
+from db.utils import init_db_connection
+
+# Number of query results kept in memory, the least recently used ones are evicted first
+QUERY_CACHE_SIZE = int(os.getenv("QUERY_CACHE_SIZE", 128))
+
+# Rows fetched per round trip from the server-side cursor
+QUERY_CHUNK_SIZE = int(os.getenv("QUERY_CHUNK_SIZE", 10_000))
+
+# Every load of the pipeline moves its table's row in this table (see `datapipelines.incremental.set_watermark`),
+# so its newest `updated_at` changes whenever any data changes
+WATERMARK_TABLE = "pipeline_watermarks"
+
+# Values of the questions' variables when none are given, the same as the defaults of their Metabase cards
+DEFAULT_PARAMS = {"date_granularity": "Week"}
+
+_OPTIONAL_CLAUSE = re.compile(r"\[\[\s*(.*?)\s*\]\]", re.DOTALL)
+_FIELD_FILTER = re.compile(r"\band\s+{{\s*(\w+)\s*}}")
+_VARIABLE = re.compile(r"{{\s*(\w+)\s*}}")
+
+_result_cache = OrderedDict()
+_result_cache_lock = threading.Lock()
+
+
+def render_query(query: str, params: dict = None) -> tuple:
+    """Expands the Metabase template syntax of a query into plain SQL with bind parameters
+
+    - `{{variable}}` becomes the bind parameter `:variable`
+    - `[[ ... ]]` optional clauses are kept when every variable inside them has a value and dropped otherwise
+    - `[[ and {{field}} ]]` field filters become a condition on the column of the same name: a `(start, end)` tuple
+      filters a range (either end may be None), a list matches any of its values, anything else must be equal
+
+    Args:
+        query (str): A query from this package, e.g. `query_calories_burned()`
+        params (dict, optional): {variable name: value}. Defaults to None, which only uses `DEFAULT_PARAMS`.
+
+    Raises:
+        ValueError: If a variable outside of an optional clause has no value
+
+    Returns:
+        tuple: The SQL and its bind parameters
+    """
+    params = {name: value for name, value in {**DEFAULT_PARAMS, **(params or {})}.items() if value is not None}
+    bind = {}
+
+    def field_filter(name: str) -> str:
+        value = params[name]
+        if isinstance(value, tuple):
+            conditions = []
+            for suffix, operator, bound in [("start", ">=", value[0]), ("end", "<", value[1])]:
+                if bound is not None:
+                    bind[f"{name}_{suffix}"] = bound
+                    conditions.append(f"{name} {operator} :{name}_{suffix}")
+            return " and ".join(conditions) or "true"
+        if isinstance(value, (list, set)):
+            bind[name] = list(value)
+            return f"{name} = any(:{name})"
+        bind[name] = value
+        return f"{name} = :{name}"
+
+    def variable(match) -> str:
+        name = match.group(1)
+        if name not in params:
+            raise ValueError(f"No value for the required variable {name}")
+        bind[name] = params[name]
+        return f":{name}"
+
+    def optional_clause(match) -> str:
+        clause = match.group(1)
+        if not all(name in params for name in _VARIABLE.findall(clause)):
+            return ""
+        clause = _FIELD_FILTER.sub(lambda field: f"and {field_filter(field.group(1))}", clause)
+        return _VARIABLE.sub(variable, clause)
+
+    sql = _VARIABLE.sub(variable, _OPTIONAL_CLAUSE.sub(optional_clause, query))
+    # drop the lines that only held a dropped optional clause
+    sql = "\n".join(line.rstrip() for line in sql.splitlines() if line.strip())
+    return sql, bind
+
+
+def data_version(conn: Connection) -> str:
+    """Identifies the current state of the pipeline's data: the time of the latest load, None before the first one"""
+    if not inspect(conn).has_table(WATERMARK_TABLE, schema="public"):
+        return None
+    version = conn.execute(text(f"select max(updated_at) from public.{WATERMARK_TABLE}")).scalar()
+    return str(version) if version is not None else None
+
+
+def clear_query_cache():
+    """Forgets every cached query result"""
+    with _result_cache_lock:
+        _result_cache.clear()
+
+
+def run_query(query: str, params: dict = None, use_cache: bool = True, chunk_size: int = QUERY_CHUNK_SIZE) -> pd.DataFrame:
+    """Runs a query from this package against the pipeline DB, without Metabase
+
+    Results are fetched through a server-side cursor in chunks of `chunk_size` rows and cached by the rendered SQL, its
+    parameters and the data version. A finished load changes the data version, so results are never served stale.
+
+    Args:
+        query (str): A query from this package, e.g. `query_calories_burned()`
+        params (dict, optional): The values of the query's variables and field filters, see `render_query`. Defaults to None.
+        use_cache (bool, optional): True to serve and keep results in the cache. Defaults to True.
+        chunk_size (int, optional): Rows fetched per round trip. Defaults to `QUERY_CHUNK_SIZE`.
+
+    Returns:
+        pd.DataFrame: The query result, None if the query failed
+    """
+    try:
+        sql, bind = render_query(query, params)
+        conn = init_db_connection()
+        try:
+            key = (sql, json.dumps(bind, sort_keys=True, default=str), data_version(conn))
+            if use_cache:
+                with _result_cache_lock:
+                    if key in _result_cache:
+                        _result_cache.move_to_end(key)
+                        return _result_cache[key].copy()
+
+            # stream_results makes psycopg2 use a named (server-side) cursor, so the result is never buffered twice
+            streaming = conn.execution_options(stream_results=True, max_row_buffer=chunk_size)
+            chunks = list(pd.read_sql(text(sql), streaming, params=bind, chunksize=chunk_size))
+        finally:
+            conn.close()
+        data = pd.concat(chunks, ignore_index=True) if chunks else pd.DataFrame()
+
+        if use_cache:
+            with _result_cache_lock:
+                _result_cache[key] = data.copy()
+                while len(_result_cache) > QUERY_CACHE_SIZE:
+                    _result_cache.popitem(last=False)
+        logger.opt(lazy=True).debug("Ran query with {} rows: {}", lambda: len(data), lambda: sql)
+        return data
+    except Exception as e:
+        logger.error(f"Could not run query: {e}")
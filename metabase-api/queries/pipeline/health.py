@@ -0,0 +1,61 @@
+# Description: Metabase queries for the pipeline's own run metrics
+
+def add_pipeline_field_filters_to_sql(query: str) -> str:
+    """Replaces generic `where 1=1` with Metabase field filters for the pipeline run metrics.
+
+    Args:
+        query (str): The SQL query to be modified.
+
+    Returns:
+        str: The modified SQL query with pipeline run field filters.
+    """
+
+    return query.replace("where 1=1", "where 1=1\n    [[ and {{started_at}} ]]\n    [[ and {{stage}} ]]")
+
+
+def query_stage_duration():
+    query = """select
+    date_trunc(lower({{date_granularity}}), started_at) as time_period
+    , stage
+    , avg(duration_seconds) as average_duration_seconds
+    , max(duration_seconds) as max_duration_seconds
+from pipeline_runs
+where 1=1
+    and status = 'succeeded'
+group by 1, 2
+order by time_period desc
+"""
+    query = add_pipeline_field_filters_to_sql(query)
+    return query.strip()
+
+
+def query_stage_peak_memory():
+    query = """select
+    date_trunc(lower({{date_granularity}}), started_at) as time_period
+    , stage
+    , max(peak_rss_mb) as peak_rss_mb
+from pipeline_runs
+where 1=1
+    and status = 'succeeded'
+group by 1, 2
+order by time_period desc
+"""
+    query = add_pipeline_field_filters_to_sql(query)
+    return query.strip()
+
+
+def query_stage_throughput():
+    query = """select
+    date_trunc(lower({{date_granularity}}), started_at) as time_period
+    , stage
+    , sum(rows_in) / nullif(sum(duration_seconds), 0) as rows_in_per_second
+    , sum(rows_out) as rows_out
+    , sum(bytes_written) / 1048576.0 as megabytes_written
+    , count(*) filter (where status = 'failed') as failed_runs
+from pipeline_runs
+where 1=1
+group by 1, 2
+order by time_period desc
+"""
+    query = add_pipeline_field_filters_to_sql(query)
+    return query.strip()
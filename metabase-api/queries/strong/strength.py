@@ -0,0 +1,34 @@
+# Description: Metabase queries for the strength tables the pipeline maintains from the Strong App Data
+from queries.strong.lifting import add_strong_field_filters_to_sql
+
+
+def query_estimated_one_rep_max():
+    # One row per exercise and session in `strength_e1rm`, so no sets are scanned
+    query = """select
+    date_trunc(lower({{date_granularity}}), session_at) as time_period
+    , exercise_name
+    , max(e1rm_epley) as estimated_1rm_epley
+    , max(e1rm_brzycki) as estimated_1rm_brzycki
+from strength_e1rm
+where 1=1
+group by 1, 2
+order by time_period desc, exercise_name
+"""
+    query = add_strong_field_filters_to_sql(
+        query, fields=("session_at", "exercise_name"))
+    return query.strip()
+
+
+def query_rep_prs():
+    query = """select
+    exercise_name
+    , reps
+    , weight as heaviest_weight
+    , achieved_at
+from strength_rep_prs
+where 1=1
+order by exercise_name, reps
+"""
+    query = add_strong_field_filters_to_sql(
+        query, fields=("achieved_at", "exercise_name"))
+    return query.strip()